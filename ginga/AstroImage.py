@@ -47,6 +47,10 @@ class AstroImage(BaseImage):
         BaseImage.__init__(self, data_np=data_np, metadata=metadata,
                            logger=logger)
         
+        # optional grids for fast coordinate lookups (see make_coord_grid())
+        self._coord_grids = {}
+        self._coord_grid_gen = 0
+
         # wcsclass specifies a pluggable WCS module
         self.wcs = wcsclass(self.logger)
 
@@ -76,15 +80,22 @@ class AstroImage(BaseImage):
 
         # Try to make a wcs object on the header
         self.wcs.load_header(hdu.header, fobj=fobj)
+        self.clear_coord_grids()
 
-    def load_file(self, filepath, numhdu=None, naxispath=None):
+    def load_file(self, filepath, numhdu=None, naxispath=None,
+                  memmap=False):
+        """Load an image from a FITS file.  If `memmap` is True, the
+        file is memory mapped and pixels are only read from disk as they
+        are accessed (e.g. when a region of the image is rendered).
+        """
         self.logger.debug("Loading file '%s' ..." % (filepath))
         self.clear_metadata()
 
         ahdr = self.get_header()
         
         data, naxispath = self.io.load_file(filepath, ahdr, numhdu=numhdu,
-                                            naxispath=naxispath)
+                                            naxispath=naxispath,
+                                            memmap=memmap)
         self.naxispath = naxispath
         self.revnaxis = list(naxispath)
         self.revnaxis.reverse()
@@ -106,6 +117,7 @@ class AstroImage(BaseImage):
         #   to pass additional information to the wcs class
         #self.wcs.load_header(hdu.header, fobj=fobj)
         self.wcs.load_header(ahdr)
+        self.clear_coord_grids()
 
 
     def load_buffer(self, data, dims, dtype, byteswap=False,
@@ -118,6 +130,7 @@ class AstroImage(BaseImage):
 
     def set_wcs(self, wcs):
         self.wcs = wcs
+        self.clear_coord_grids()
         
     def set_io(self, io):
         self.io = io
@@ -182,6 +195,7 @@ class AstroImage(BaseImage):
         # Try to make a wcs object on the header
         if hasattr(self, 'wcs'):
             self.wcs.load_header(hdr)
+            self.clear_coord_grids()
         
     def set_keywords(self, **kwds):
         """Set an item in the fits header, if any."""
@@ -201,6 +215,7 @@ class AstroImage(BaseImage):
         if hasattr(self, 'wcs'):
             header = self.get_header()
             self.wcs.load_header(header)
+            self.clear_coord_grids()
 
     def clear_metadata(self):
         self.metadata = {}
@@ -271,6 +286,80 @@ class AstroImage(BaseImage):
         return self.wcs.radectopix(ra_deg, dec_deg, coords=coords,
                                    naxispath=self.revnaxis)
 
+    def pixtoradec_many(self, idxs, coords='data'):
+        """Like pixtoradec(), for an N x 2 array of (x, y) pixel
+        coordinates, which are transformed in one call to the WCS.
+        Returns an N x 2 array of (ra, dec) in degrees.
+        """
+        idxs = numpy.asarray(idxs, dtype=numpy.float_).reshape((-1, 2))
+        if len(self.revnaxis) > 0:
+            extra = numpy.empty((len(idxs), len(self.revnaxis)))
+            extra[:] = self.revnaxis
+            idxs = numpy.hstack((idxs, extra))
+        return self.wcs.pixtoradec_many(idxs, coords=coords)
+
+    def radectopix_many(self, radec, coords='data'):
+        """Like radectopix(), for an N x 2 array of (ra, dec) in
+        degrees.  Returns an N x 2 array of (x, y).
+        """
+        radec = numpy.asarray(radec, dtype=numpy.float_).reshape((-1, 2))
+        return self.wcs.radectopix_many(radec, coords=coords,
+                                        naxispath=self.revnaxis)
+
+    def clear_coord_grids(self):
+        """Discard the coordinate grids (e.g. because the WCS changed)."""
+        self._coord_grids = {}
+        self._coord_grid_gen += 1
+
+    def coord_grid_needed(self, system):
+        """Returns True if a coordinate grid for `system` has not been
+        made yet, in which case the caller should call make_coord_grid()
+        (e.g. in a background thread).  Returns True only once.
+        """
+        if system in self._coord_grids:
+            return False
+        # mark it as under way
+        self._coord_grids[system] = None
+        return True
+
+    def get_coord_grid(self, system):
+        """Returns the coordinate grid for `system`, or None if it has
+        not been made.
+        """
+        return self._coord_grids.get(system, None)
+
+    def make_coord_grid(self, system, spacing=64, tolerance=0.01):
+        """Make a grid over the image for interpolating the coordinates
+        in `system` of any pixel to within `tolerance` arcsec (see
+        wcs.CoordGrid), for use by info_xy().
+        """
+        gen = self._coord_grid_gen
+        revnaxis = list(self.revnaxis)
+
+        def coords_fn(idxs):
+            if len(revnaxis) > 0:
+                extra = numpy.empty((len(idxs), len(revnaxis)))
+                extra[:] = revnaxis
+                idxs = numpy.hstack((idxs, extra))
+            return self.wcs.pixtosystem_many(idxs, system=system,
+                                             coords='data')
+
+        wd, ht = self.get_size()
+        time_start = time.time()
+        try:
+            grid = wcs.CoordGrid(coords_fn, -0.5, -0.5, wd - 0.5, ht - 0.5,
+                                 spacing=spacing, tolerance=tolerance)
+        except Exception, e:
+            self.logger.warn("Error making coordinate grid: %s" % (str(e)))
+            return None
+        self.logger.debug("coordinate grid of %d cells made in %.4f sec" % (
+            grid.get_num_cells(), time.time() - time_start))
+
+        # don't keep it if the WCS changed while we were making it
+        if gen == self._coord_grid_gen:
+            self._coord_grids[system] = grid
+        return grid
+
     def dispos(self, dra0, decd0, dra, decd):
         """
         Source/credit: Skycat
@@ -496,11 +585,12 @@ class AstroImage(BaseImage):
         for image in imagelist:
             wd, ht = image.get_size()
             # for each image calculate ra/dec in the corners
-            for x, y in ((0, 0), (wd-1, 0), (wd-1, ht-1), (0, ht-1)):
-                ra, dec = image.pixtoradec(x, y)
-                # and then calculate the pixel position relative to the
-                # base image
-                x0, y0 = image0.radectopix(ra, dec)
+            corners = ((0, 0), (wd-1, 0), (wd-1, ht-1), (0, ht-1))
+            radec = image.pixtoradec_many(corners)
+            # and then calculate the pixel positions relative to the
+            # base image
+            pix = image0.radectopix_many(radec)
+            for (x, y), (x0, y0) in zip(corners, pix):
                 #x0, y0 = int(x0), int(y0)
                 x0, y0 = int(round(x0)), int(round(y0))
 
@@ -560,6 +650,7 @@ class AstroImage(BaseImage):
 
         if update_wcs:
             self.wcs.rotate(deg)
+            self.clear_coord_grids()
 
     def match_wcs(self, img_coords, ref_coords):
         """Adjust WCS (CRVAL{1,2} and CD{1,2}_{1,2}) using a rotation
@@ -578,95 +669,15 @@ class AstroImage(BaseImage):
         res = wcs_m.calc_match()
         return wcs_m, res
         
-    def mosaic(self, filelist):
+    def mosaic(self, filelist, **kwdargs):
         """Creates a new mosaic image from the images in filelist.
+        The images are reprojected onto the pixel grid of the first one.
+        See ginga.util.mosaic.make_mosaic() for the keyword arguments.
         """
+        # NOTE: imported here, as ginga.util.mosaic imports us
+        from ginga.util import mosaic
 
-        image0 = AstroImage(logger=self.logger)
-        image0.load_file(filelist[0])
-
-        xmin, ymin, xmax, ymax = 0, 0, 0, 0
-
-        idxs = []
-        for filepath in filelist:
-            # Create and load the image
-            self.logger.debug("Examining file '%s' ..." % (filepath))
-            image = AstroImage(logger=self.logger)
-            image.load_file(filepath)
-
-            wd, ht = image.get_size()
-            # for each image calculate ra/dec in the corners
-            for x, y in ((0, 0), (wd-1, 0), (wd-1, ht-1), (0, ht-1)):
-
-                # for each image calculate ra/dec in the corners
-                ra, dec = image.pixtoradec(x, y)
-                # and then calculate the pixel position relative to the
-                # base image
-                x0, y0 = image0.radectopix(ra, dec)
-                x0, y0 = int(round(x0)), int(round(y0))
-
-                # running calculation of min and max pixel coordinates
-                xmin, ymin = min(xmin, x0), min(ymin, y0)
-                xmax, ymax = max(xmax, x0), max(ymax, y0)
-                 
-        # calc necessary dimensions of final image
-        width, height = xmax-xmin+1, ymax-ymin+1
-        slop = 0
-        width, height = width+slop, height+slop
-
-        # amount of offset to add to each image
-        xoff, yoff = abs(min(0, xmin)), abs(min(0, ymin))
-
-        pa_deg = image0.get_wcs_rotation_deg()
-
-        metadata = image0.get_metadata()
-        header = image0.get_header()
-        ## for kwd in ('CD1_1', 'CD1_2', 'CD2_1', 'CD2_2'):
-        ##     try:
-        ##         del header[kwd]
-        ##     except KeyError:
-        ##         pass
-        
-        # new array to hold the mosaic
-        self.logger.debug("Creating empty mosaic image of %dx%d" % (
-            (width, height)))
-        newdata = numpy.zeros((height, width))
-
-        # Create new image with empty data
-        mosaic = AstroImage(newdata, metadata=metadata,
-                            logger=self.logger)
-        pa = numpy.radians(pa_deg)
-        cpa = numpy.cos(pa)
-        spa = numpy.sin(pa)
-        mosaic.update_keywords({ 'NAXIS1': width,
-                                 'NAXIS2': height,
-                                 'PC1_1': cpa,
-                                 'PC1_2': -spa,
-                                 'PC2_1': spa,
-                                 'PC2_2': cpa,
-                                 })
-
-        # Update the WCS reference pixel with the relocation info
-        crpix1 = mosaic.get_keyword('CRPIX1')
-        crpix2 = mosaic.get_keyword('CRPIX2')
-        crpix1n, crpix2n = crpix1 + xoff, crpix2 + yoff
-        self.logger.debug("CRPIX %f,%f -> %f,%f" % (
-            crpix1, crpix2, crpix1n, crpix2n))
-        mosaic.update_keywords({ 'CRPIX1': crpix1n,
-                                 'CRPIX2': crpix2n })
-
-        # drop each image in the right place in the new data array
-        for filepath in filelist:
-            # Create and load the image
-            image = AstroImage(logger=self.logger)
-            image.load_file(filepath)
-
-            mosaic.mosaic_inline([ image ])
-        
-        header = mosaic.get_header()
-        kwds = list(header.keys())
-        kwds.sort()
-        return mosaic
+        return mosaic.make_mosaic(filelist, self.logger, **kwdargs)
     
     def mosaic_inline(self, imagelist):
         """Drops new images into the current image (if there is room),
@@ -738,10 +749,15 @@ class AstroImage(BaseImage):
             else:
                 args = [data_x, data_y] + self.revnaxis
     
-                lon_deg, lat_deg = self.wcs.pixtosystem(#(data_x, data_y),
-                    args,
-                                                        system=system,
-                                                        coords='data')
+                res = None
+                if settings.get('wcs_use_grid', False):
+                    grid = self.get_coord_grid(system)
+                    if grid != None:
+                        res = grid.pixtosystem(data_x, data_y)
+                if res == None:
+                    res = self.wcs.pixtosystem(#(data_x, data_y),
+                        args, system=system, coords='data')
+                lon_deg, lat_deg = res
 
                 if format == 'sexagesimal':
                     if system in ('galactic', 'ecliptic'):
@@ -7,9 +7,9 @@
 # This is open-source software licensed under a BSD license.
 # Please see the file LICENSE.txt for details.
 #
+import math
 import numpy
 import time
-import threading
 
 from ginga.misc import Bunch
 
@@ -19,18 +19,62 @@ have_scipy = True
 autocut_methods = ('minmax', 'histogram', 'stddev', 'zscale')
 try:
     import scipy.ndimage.filters
-    import scipy.optimize as optimize
     #import scipy.misc
 except ImportError:
     have_scipy = False
-    autocut_methods = ('minmax', 'histogram', 'stddev')
-
-# Lock to work around a non-threadsafe bug in scipy
-_lock = threading.RLock()
 
 class AutoCutsError(Exception):
     pass
 
+# Number of values binned at a time by histogram_finite()
+hist_block_size = 1 << 20
+
+def histogram_finite(data, numbins, minval=None, maxval=None):
+    """Bin the finite values of `data` into `numbins` equal sized bins
+    spanning `minval` to `maxval` (by default, the minimum and maximum
+    finite values).  Values outside of the range are counted in the end
+    bins; NaNs and Infs are skipped.
+
+    Returns a bunch with the histogram (`dist`), the bin edges (`bins`),
+    the cumulative distribution (`cdf`) and the number of values binned
+    (`num`).
+    """
+    data = numpy.ravel(data)
+    if data.dtype.kind == 'f':
+        finite = numpy.isfinite(data)
+        if not finite.all():
+            data = data[finite]
+
+    num = len(data)
+    if minval == None:
+        if num > 0:
+            minval = data.min()
+        else:
+            minval = 0.0
+    if maxval == None:
+        if num > 0:
+            maxval = data.max()
+        else:
+            maxval = minval
+    minval, maxval = float(minval), float(maxval)
+    if maxval <= minval:
+        # same as numpy.histogram() in this case
+        minval, maxval = minval - 0.5, maxval + 0.5
+
+    bins = numpy.linspace(minval, maxval, numbins+1)
+    dist = numpy.zeros(numbins, dtype=numpy.intp)
+    scale = numbins / (maxval - minval)
+
+    # bin in blocks to limit the size of the temporary arrays
+    for i in xrange(0, num, hist_block_size):
+        idx = (data[i:i+hist_block_size] - minval) * scale
+        idx = idx.astype(numpy.intp)
+        numpy.clip(idx, 0, numbins-1, out=idx)
+        dist += numpy.bincount(idx, minlength=numbins)
+
+    cdf = numpy.cumsum(dist)
+    return Bunch.Bunch(dist=dist, bins=bins, cdf=cdf, num=num)
+
 class AutoCutsBase(object):
 
     def __init__(self, logger):
@@ -60,7 +104,14 @@ class AutoCutsBase(object):
         # methods on a large image, so in those cases we can optionally
         # take a crop of size (radius*2)x(radius*2) from the center of
         # the image and calculate the cut levels on that
+        x0, y0, x1, y1 = self.get_crop_bbox(data, cropradius=cropradius)
+        data = data[y0:y1, x0:x1]
+        return data
 
+    def get_crop_bbox(self, data, cropradius=512):
+        """Returns the bounds (x0, y0, x1, y1) of the crop used by
+        get_crop().
+        """
         height, width = data.shape[:2]
         x, y = width // 2, height // 2
         if x > cropradius:
@@ -76,8 +127,7 @@ class AutoCutsBase(object):
             y0 = 0
             y1 = height-1
 
-        data = data[y0:y1, x0:x1]
-        return data
+        return (x0, y0, x1, y1)
     
     def cut_levels(self, data, loval, hival, vmin=0.0, vmax=255.0):
         self.logger.debug("loval=%.2f hival=%.2f" % (loval, hival))
@@ -153,11 +203,20 @@ class Histogram(AutoCutsBase):
             ]
     
     def calc_cut_levels(self, image, params=None):
-        data = image.get_data()
         if params == None:
             params = self.params
-        
-        bnch = self.calc_histogram(data, **params)
+        usecrop = params.get('usecrop', True)
+        pct = params.get('pct', 0.999)
+        numbins = params.get('numbins', 2048)
+
+        region = None
+        if usecrop:
+            region = self.get_crop_bbox(image.get_data())
+
+        # The histogram (and its cumulative distribution) is cached on
+        # the image, so that changing pct does not require re-binning
+        hist = image.get_histogram(numbins=numbins, region=region)
+        bnch = self.calc_histogram_cutoffs(hist, pct)
         loval, hival = bnch.loval, bnch.hival
 
         return loval, hival    
@@ -172,48 +231,30 @@ class Histogram(AutoCutsBase):
         self.logger.debug("Median analysis array is %dx%d" % (
             width, height))
 
-        total_px = width * height
-        dsum = numpy.sum(data)
-        if numpy.isnan(dsum) or numpy.isinf(dsum):
-            # Oh crap, the array has a NaN or Inf value.
-            # We have to workaround this by making a copy of the array
-            # and substituting for the problem values, otherwise numpy's
-            # histogram() cannot handle it
-            self.logger.warn("NaN's found in data, using workaround for histogram")
-            data = data.copy()
-            # TODO: calculate a reasonable replacement value
-            data[numpy.isinf(data)] = 0.0
-            minval = numpy.nanmin(data)
-            maxval = numpy.nanmax(data)
-            substval = (minval + maxval)/2.0
-            data[numpy.isnan(data)] = substval
-            data[numpy.isinf(data)] = substval
-            ## dsum = numpy.sum(data)
-            ## if numpy.isnan(dsum) or numpy.isinf(dsum):
-            ##     print "NaNs STILL PRESENT"
-
-            dist, bins = numpy.histogram(data, bins=numbins,
-                                         density=False)
-        else:
-            dist, bins = numpy.histogram(data, bins=numbins,
-                                         density=False)
+        hist = histogram_finite(data, numbins)
+        return self.calc_histogram_cutoffs(hist, pct)
 
+    def calc_histogram_cutoffs(self, hist, pct):
+        """Calculate the cut levels that retain fraction `pct` of the
+        pixels, given a histogram bunch as returned by histogram_finite().
+        Only the cumulative distribution is searched, so this is cheap
+        to repeat for different values of `pct`.
+        """
+        dist, bins, cdf = hist.dist, hist.bins, hist.cdf
+        total_px = hist.num
         cutoff = int((float(total_px)*(1.0-pct))/2.0)
         top = len(dist)-1
         self.logger.debug("top=%d cutoff=%d" % (top, cutoff))
-        #print "DIST: %s\nBINS: %s" % (str(dist), str(bins))
-
-        # calculate low cutoff
-        cumsum = numpy.cumsum(dist)
-        li = numpy.flatnonzero(cumsum > cutoff)
-        if len(li) > 0:
-            i = li[0]
-            count_px = cumsum[i]
+
+        # calculate low cutoff: first bin where the count exceeds cutoff
+        i = numpy.searchsorted(cdf, cutoff, side='right')
+        if i <= top:
+            count_px = cdf[i]
         else:
             i = 0
             count_px = 0
         if i > 0:
-            nprev = cumsum[i-1]
+            nprev = cdf[i-1]
         else:
             nprev = 0
         loidx = i
@@ -229,21 +270,14 @@ class Histogram(AutoCutsBase):
         self.logger.debug("loval=%f val1=%f val2=%f interp=%f" % (
             loval, val1, val2, interp))
 
-        # calculate high cutoff
-        revdist = dist[::-1]
-        cumsum = numpy.cumsum(revdist)
-        li = numpy.flatnonzero(cumsum > cutoff)
-        if len(li) > 0:
-            i = li[0]
-            count_px = cumsum[i]
-        else:
-            i = 0
-            count_px = 0
-        if i > 0:
-            nprev = cumsum[i-1]
+        # calculate high cutoff: last bin where the count from the top
+        # exceeds cutoff
+        j = min(numpy.searchsorted(cdf, total_px - cutoff, side='left'), top)
+        if j > 0:
+            count_px = total_px - cdf[j-1]
         else:
-            nprev = 0
-        j = top - i
+            count_px = total_px
+        nprev = total_px - cdf[j]
         hiidx = j+1
 
         # interpolate between last two high bins
@@ -358,6 +392,13 @@ class ZScale(AutoCutsBase):
         self.kind = 'zscale'
         self.params.update(contrast=None, num_points=None, 
                            num_per_row=None)
+
+        # parameters for the line fit (as in IRAF)
+        self.krej = 2.5
+        self.max_iter = 5
+        self.grow = 0.01
+        self.min_pix = 5
+        self.min_fraction = 0.5
         
     def get_params_metadata(self):
         return [
@@ -467,6 +508,11 @@ class ZScale(AutoCutsBase):
         cutout = data[0:ymax:yskip, 0:xmax:xskip]
         # flatten and trim off excess
         cutout = cutout.flat[0:num_points]
+        # NaNs and Infs would spoil the ranking
+        if cutout.dtype.kind == 'f':
+            cutout = cutout[numpy.isfinite(cutout)]
+            if len(cutout) == 0:
+                return (0.0, 0.0)
 
         # actual number of points selected
         num_pix = len(cutout)
@@ -478,64 +524,33 @@ class ZScale(AutoCutsBase):
         cutout = numpy.sort(cutout)
 
         # flat distribution?
-        data_min = numpy.nanmin(cutout)
-        data_max = numpy.nanmax(cutout)
+        data_min = cutout[0]
+        data_max = cutout[-1]
         if (data_min == data_max) or (contrast == 0.0):
             return (data_min, data_max)
 
         # compute the midpoint and median
-        midpoint = (num_pix // 2)
+        midpoint = (num_pix - 1) // 2
         if num_pix % 2 != 0:
             median = cutout[midpoint]
         else:
-            median = 0.5 * (cutout[midpoint-1] + cutout[midpoint])
+            median = 0.5 * (cutout[midpoint] + cutout[midpoint+1])
         self.logger.debug("num_pix=%d midpoint=%d median=%.4f" % (
             num_pix, midpoint, median))
 
-        # zscale fitting function:
-        # I(x) = slope * (x - midpoint) + intercept
-        def fitting(x, slope, intercept):
-            y = slope * (x - midpoint) + intercept
-            return y
-
-        # compute a least squares fit 
-        X = numpy.array(range(num_pix))
-        Y = cutout
-        sigma = numpy.array([ 1.0 ]* num_pix)
-        guess = numpy.array([0.0, 0.0])
-
-        # Curve fit
-        with _lock:
-            # NOTE: without this mutex, optimize.curvefit causes a fatal error
-            # sometimes--it appears not to be thread safe.
-            # The error is:
-            # "SystemError: null argument to internal routine"
-            # "Fatal Python error: GC object already tracked"
-            try:
-                p, cov = optimize.curve_fit(fitting, X, Y, guess, sigma)
-
-            except Exception, e:
-                self.logger.debug("curve fitting failed: %s" % (str(e)))
-                cov = None
-            
-        if cov == None:
-            self.logger.debug("curve fitting failed")
-            return (float(data_min), float(data_max))
-
-        slope, intercept = p
+        # fit a line to the sorted sample, with iterative rejection
+        num_chosen, slope = self.fit_line(cutout)
+        self.logger.debug("slope=%f chosen=%d" % (slope, num_chosen))
 
-        num_chosen = 0
-        self.logger.debug("intercept=%f slope=%f chosen=%d" % (
-            intercept, slope, num_chosen))
-
-        ## if num_chosen < (num_pix // 2):
-        ##     self.logger.debug("more than half pixels rejected--falling back to min/max of sample")
-        ##     return (data_min, data_max)
+        if num_chosen < self.min_fraction * num_pix:
+            self.logger.debug("more than half pixels rejected--falling back to min/max of sample")
+            return (float(data_min), float(data_max))
 
-        # finally, compute the range
+        # finally, compute the range, extending the line from the
+        # median to the first and last (0-based) ranks
         falloff = slope / contrast
         z1 = median - midpoint * falloff
-        z2 = median + (num_pix - midpoint) * falloff
+        z2 = median + (num_pix - 1 - midpoint) * falloff
 
         # final sanity check on cut levels
         locut = max(z1, data_min)
@@ -546,6 +561,70 @@ class ZScale(AutoCutsBase):
 
         return (float(locut), float(hicut))
 
+    def fit_line(self, samples):
+        """Fit a straight line to `samples` (as a function of index),
+        iteratively rejecting points more than `krej` sigma from the fit,
+        along with `grow` fraction of their neighbors, as in IRAF's zscale.
+        The fit is done in closed form, so no lock is needed to call this
+        from several threads at once.
+
+        Returns a tuple of (number of points retained, slope).
+        """
+        num_pix = len(samples)
+        min_pix = max(self.min_pix, int(num_pix * self.min_fraction))
+        ngrow = max(1, int(num_pix * self.grow))
+
+        # normalize the x coordinate to the range -1..1 to improve the
+        # conditioning of the fit
+        xscale = 2.0 / max(num_pix - 1, 1)
+        x = numpy.arange(num_pix, dtype=numpy.float64) * xscale - 1.0
+        y = samples.astype(numpy.float64)
+        xx, xy = x * x, x * y
+
+        # the good points are selected by weights of 1.0 and 0.0, which
+        # lets each sum be done with a dot product instead of indexing
+        weight = numpy.ones(num_pix, dtype=numpy.float64)
+        num_good = num_pix
+        intercept = slope = 0.0
+
+        for niter in xrange(self.max_iter):
+            if num_good < min_pix:
+                break
+
+            # closed form least squares fit over the good points
+            n = float(num_good)
+            sum_x, sum_y = numpy.dot(weight, x), numpy.dot(weight, y)
+            sum_xx, sum_xy = numpy.dot(weight, xx), numpy.dot(weight, xy)
+            delta = n * sum_xx - sum_x * sum_x
+            if delta == 0.0:
+                break
+            intercept = (sum_xx * sum_y - sum_x * sum_xy) / delta
+            slope = (n * sum_xy - sum_x * sum_y) / delta
+
+            # reject points too far from the fit, and their neighbors
+            resid = y - (x * slope + intercept)
+            mean = numpy.dot(weight, resid) / n
+            sigma = math.sqrt(max(numpy.dot(weight, resid * resid) / n -
+                                  mean * mean, 0.0))
+            idx = numpy.flatnonzero(numpy.abs(resid) > self.krej * sigma)
+            # mark the run of ngrow points centered on each one as bad,
+            # by accumulating +1 at the start and -1 past the end of
+            # each run
+            lo = (idx - ngrow // 2).clip(0, num_pix)
+            hi = (lo + ngrow).clip(0, num_pix)
+            runs = (numpy.bincount(lo, minlength=num_pix+1) -
+                    numpy.bincount(hi, minlength=num_pix+1))
+            newweight = (runs.cumsum()[:num_pix] == 0).astype(numpy.float64)
+
+            num_newgood = int(newweight.sum())
+            if (num_newgood == num_good) and (newweight == weight).all():
+                # converged
+                break
+            weight, num_good = newweight, num_newgood
+
+        # slope of the fit in units of the original index
+        return (num_good, slope * xscale)
+
 
 autocuts_table = {
     'clip': Clip,
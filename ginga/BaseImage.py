@@ -8,10 +8,11 @@
 # Please see the file LICENSE.txt for details.
 #
 import math
+import mmap
 import numpy
 import logging
 
-from ginga.misc import Bunch, Callback
+from ginga.misc import Bunch, Callback, LRUCache
 from ginga import AutoCuts
 
 class ImageError(Exception):
@@ -19,6 +20,17 @@ class ImageError(Exception):
 
 class BaseImage(Callback.Callbacks):
 
+    # Images smaller than this on their largest side are not worth
+    # building a resolution pyramid for
+    pyramid_min_size = 1024
+
+    # Maximum number of pixels examined when statistics on the data
+    # are sampled (see enable_stats_sampling())
+    stats_sample_size = 1000000
+
+    # Number of region histograms kept (see get_histogram())
+    histogram_cache_len = 8
+
     def __init__(self, data_np=None, metadata=None, logger=None):
 
         Callback.Callbacks.__init__(self)
@@ -35,12 +47,18 @@ class BaseImage(Callback.Callbacks):
             self.update_metadata(metadata)
         self.order = ''
 
-        self._set_minmax()
+        # optional multi-resolution pyramid (see enable_pyramid())
+        self._use_pyramid = False
+        self._pyramid = None
+
+        # statistics are calculated on demand (see get_stats())
+        self._sample_stats = None
+        self._stats = None
 
         self.autocuts = AutoCuts.Histogram(self.logger)
 
         # For callbacks
-        for name in ('modified', ):
+        for name in ('modified', 'region-modified'):
             self.enable_callback(name)
 
     @property
@@ -129,10 +147,49 @@ class BaseImage(Callback.Callbacks):
         if metadata:
             self.update_metadata(metadata)
             
-        self._set_minmax()
+        # any pyramid levels and statistics are now stale
+        self._pyramid = None
+        self._stats = None
 
         self.make_callback('modified')
 
+    def update_region(self, x1, y1, x2, y2, data_np=None):
+        """Update the pixels in the region from (x1, y1) up to but not
+        including (x2, y2) in place.  If `data_np` is given it is copied
+        into the region, otherwise the caller has already modified the
+        data there (e.g. through a shared array).
+
+        Only the statistics and the parts of the pyramid levels covering
+        the region are discarded, and the 'region-modified' callback is
+        invoked with the region instead of 'modified', so that viewers
+        can redraw just the part of the image that changed.
+        """
+        data = self.get_data()
+        ht, wd = data.shape[:2]
+        x1, y1 = max(int(x1), 0), max(int(y1), 0)
+        x2, y2 = min(int(x2), wd), min(int(y2), ht)
+        if (x2 <= x1) or (y2 <= y1):
+            return
+
+        if data_np is not None:
+            data[y1:y2, x1:x2, ...] = data_np
+
+        self._stats = None
+
+        # refresh the region in the pyramid levels that have been made
+        if self._pyramid != None:
+            levels = self._pyramid
+            for level in xrange(1, len(levels)):
+                step = 2 ** level
+                # rows and columns of this level that sample the region
+                ya, yb = -(-y1 // step), (y2 - 1) // step + 1
+                xa, xb = -(-x1 // step), (x2 - 1) // step + 1
+                if (ya < yb) and (xa < xb):
+                    levels[level][ya:yb, xa:xb] = \
+                        data[ya*step:yb*step:step, xa*step:xb*step:step]
+
+        self.make_callback('region-modified', x1, y1, x2, y2)
+
     def get_slice(self, c):
         data = self.get_data()
         return data[..., self.order.index(c.upper())]
@@ -154,37 +211,181 @@ class BaseImage(Callback.Callbacks):
         cs = cs.upper()
         return [ self.order.index(c) for c in cs ]
         
-    def _set_minmax(self):
-        data = self.get_data()
-        try:
-            self.maxval = numpy.nanmax(data)
-            self.minval = numpy.nanmin(data)
-        except Exception:
-            self.maxval = 0
-            self.minval = 0
+    def _is_mapped(self, data):
+        # follow the chain of array views to see whether the data is
+        # backed by a memory-mapped file
+        while data is not None:
+            if isinstance(data, (numpy.memmap, mmap.mmap)):
+                return True
+            data = getattr(data, 'base', None)
+        return False
+
+    def enable_stats_sampling(self, tf):
+        """Controls whether the statistics on the image (see get_stats())
+        are calculated from an evenly spaced subset of at most
+        `stats_sample_size` pixels rather than all of them.  If `tf` is
+        None (the default), only data memory mapped from a file is
+        sampled.
+        """
+        self._sample_stats = tf
+        self._stats = None
 
-        # TODO: see if there is a faster way to ignore infinity
-        try:
-            if numpy.isfinite(self.maxval):
-                self.maxval_noinf = self.maxval
+    def _get_stats_data(self):
+        data = self.get_data()
+        sample = self._sample_stats
+        if sample == None:
+            # Reading all of a mapped file just to find the min/max
+            # would defeat the purpose of mapping it
+            sample = self._is_mapped(data)
+        if not sample:
+            return (data, False)
+        ht, wd = data.shape[:2]
+        step = int(math.ceil(math.sqrt(float(wd * ht) /
+                                       self.stats_sample_size)))
+        if step <= 1:
+            return (data, False)
+        self.logger.debug("Sampling statistics from every %d pixels" % (
+            step))
+        return (data[::step, ::step], True)
+
+    def _calc_stats(self):
+        data, sampled = self._get_stats_data()
+        stats = Bunch.Bunch(sampled=sampled, num_nan=0, num_inf=0,
+                            num_finite=data.size, median=None,
+                            histograms=LRUCache.LRUCache(
+                                self.histogram_cache_len,
+                                sizefn=lambda hist: 1))
+        if data.size == 0:
+            stats.setvals(minval=0, maxval=0, minval_noinf=0,
+                          maxval_noinf=0, num_finite=0)
+            return stats
+
+        # Integer data cannot hold NaN or Inf, so skip the checks
+        finite = None
+        if data.dtype.kind in ('f', 'c'):
+            finite = numpy.isfinite(data)
+            num_finite = numpy.count_nonzero(finite)
+            if num_finite == data.size:
+                finite = None
             else:
-                self.maxval_noinf = numpy.nanmax(data[numpy.isfinite(data)])
-        except:
-            self.maxval_noinf = self.maxval
-        
-        try:
-            if numpy.isfinite(self.minval):
-                self.minval_noinf = self.minval
+                stats.num_finite = num_finite
+                notfinite = data[numpy.logical_not(finite)]
+                isnan = numpy.isnan(notfinite)
+                stats.num_nan = numpy.count_nonzero(isnan)
+                stats.num_inf = len(notfinite) - stats.num_nan
+                infs = notfinite[numpy.logical_not(isnan)]
+
+        if finite is None:
+            stats.minval_noinf = stats.minval = data.min()
+            stats.maxval_noinf = stats.maxval = data.max()
+            return stats
+
+        if stats.num_finite > 0:
+            vals = data[finite]
+            stats.minval_noinf = vals.min()
+            stats.maxval_noinf = vals.max()
+            stats.minval, stats.maxval = stats.minval_noinf, stats.maxval_noinf
+        else:
+            # no finite values at all
+            stats.minval = stats.maxval = numpy.nan
+            stats.minval_noinf = stats.maxval_noinf = 0
+
+        if len(infs) > 0:
+            stats.minval = min(stats.minval, infs.min())
+            stats.maxval = max(stats.maxval, infs.max())
+            if stats.num_finite == 0:
+                stats.minval_noinf = stats.minval
+                stats.maxval_noinf = stats.maxval
+        return stats
+
+    def get_stats(self):
+        """Returns a bunch of statistics on the image data: `minval` and
+        `maxval` (ignoring NaNs), `minval_noinf` and `maxval_noinf`
+        (ignoring NaNs and Infs), and the counts `num_nan`, `num_inf` and
+        `num_finite`.  `sampled` is True if these were estimated from a
+        subset of the pixels (see enable_stats_sampling()).
+
+        The statistics are calculated on first use and kept until the
+        data changes.
+        """
+        stats = self._stats
+        if stats == None:
+            stats = self._calc_stats()
+            self._stats = stats
+        return stats
+
+    def get_median(self):
+        """Returns the median of the finite values in the image, which
+        is estimated from at most `stats_sample_size` pixels.
+        """
+        stats = self.get_stats()
+        if stats.median == None:
+            data = self.get_data()
+            ht, wd = data.shape[:2]
+            step = int(math.ceil(math.sqrt(float(wd * ht) /
+                                           self.stats_sample_size)))
+            data = data[::max(step, 1), ::max(step, 1)]
+            if (stats.num_nan + stats.num_inf > 0) or stats.sampled:
+                data = data[numpy.isfinite(data)]
+            if data.size == 0:
+                stats.median = 0
             else:
-                self.minval_noinf = numpy.nanmin(data[numpy.isfinite(data)])
-        except:
-            self.minval_noinf = self.minval
-        
+                stats.median = numpy.median(data)
+        return stats.median
+
+    def get_histogram(self, numbins=2048, region=None, z=None):
+        """Returns the histogram of the finite values in the image, or in
+        `region` (x1, y1, x2, y2) of it, as a bunch (see
+        AutoCuts.histogram_finite()).  If `z` is given, the histogram is
+        of that plane of the data.
+
+        Histograms are kept (for a few regions) until the data changes,
+        together with their cumulative distributions, so that different
+        percentiles can be looked up without binning the data again.
+        """
+        stats = self.get_stats()
+        key = (numbins, region, z)
+        res = stats.histograms.get(key, None)
+        if res != None:
+            return res
+
+        if (region == None) and (z == None):
+            # whole image: the range is already known
+            data, sampled = self._get_stats_data()
+            res = AutoCuts.histogram_finite(data, numbins,
+                                            minval=stats.minval_noinf,
+                                            maxval=stats.maxval_noinf)
+        else:
+            data = self.get_data()
+            if region != None:
+                x1, y1, x2, y2 = region
+                data = data[y1:y2, x1:x2]
+            if z != None:
+                data = data[..., z]
+            res = AutoCuts.histogram_finite(data, numbins)
+        stats.histograms[key] = res
+        return res
+
+    def get_nbytes(self):
+        """Returns the approximate amount of memory held by the image
+        data.  Data memory mapped from a file is not counted, since the
+        system can page it out as needed.
+        """
+        data = self.get_data()
+        if self._is_mapped(data):
+            nbytes = 0
+        else:
+            nbytes = data.nbytes
+        if self._pyramid != None:
+            nbytes += sum(map(lambda level: level.nbytes, self._pyramid[1:]))
+        return nbytes
+
     def get_minmax(self, noinf=False):
+        stats = self.get_stats()
         if not noinf:
-            return (self.minval, self.maxval)
+            return (stats.minval, stats.maxval)
         else:
-            return (self.minval_noinf, self.maxval_noinf)
+            return (stats.minval_noinf, stats.maxval_noinf)
 
     def update_metadata(self, keyDict):
         for key, val in keyDict.items():
@@ -234,6 +435,77 @@ class BaseImage(Callback.Callbacks):
                                   x+radius+1, y+radius+1,
                                   astype=astype)
 
+    def enable_pyramid(self, tf):
+        """Enable or disable the use of a multi-resolution pyramid for
+        scaled cutouts.  The pyramid levels are built lazily, as they are
+        needed, and are discarded whenever the data changes.
+        """
+        self._use_pyramid = tf
+        self._pyramid = None
+
+    def get_pyramid_level(self, level):
+        """Returns the data array for pyramid `level`, where level 0 is
+        the data itself and each successive level is decimated by 2 in
+        both axes from the one before it.
+        """
+        if self._pyramid == None:
+            self._pyramid = [ self.get_data() ]
+        levels = self._pyramid
+        while len(levels) <= level:
+            data = levels[-1]
+            # make a contiguous copy so that indexing into it later is
+            # cache friendly
+            levels.append(numpy.ascontiguousarray(data[::2, ::2]))
+        return levels[level]
+
+    def _calc_pyramid_level(self, iscale_x, iscale_y):
+        # choose the smallest level that still has at least as much
+        # resolution as the requested (inverse) scale
+        if not self._use_pyramid:
+            return 0
+        wd, ht = self.get_size()
+        if max(wd, ht) < self.pyramid_min_size:
+            return 0
+        iscale = min(iscale_x, iscale_y)
+        if iscale < 2.0:
+            return 0
+        level = int(math.floor(math.log(iscale, 2)))
+        # never decimate an axis all the way down to nothing
+        maxlevel = int(math.floor(math.log(min(wd, ht), 2)))
+        return min(level, maxlevel)
+
+    def sample_xy(self, xi, yi, iscale_x=1.0, iscale_y=1.0):
+        """Returns the data sampled at all combinations of the integer
+        index vectors `xi` and `yi`.  If the pyramid is enabled, the
+        inverse scale (data pixels per sample) in each axis is used to
+        pick the level to sample from.
+        """
+        level = self._calc_pyramid_level(iscale_x, iscale_y)
+        if level > 0:
+            # Sample from a decimated level of the pyramid.  Each
+            # index lands within 2**level pixels of the full-resolution
+            # one, which is less than one sample at this scale.
+            data = self.get_pyramid_level(level)
+            xi = xi >> level
+            yi = yi >> level
+            self.logger.debug("using pyramid level %d" % (level))
+        else:
+            data = self.get_data()
+        return data[yi[:, numpy.newaxis], xi]
+
+    def sample_points(self, xi, yi, iscale_x=1.0, iscale_y=1.0):
+        """Like sample_xy(), but `xi` and `yi` are arrays of the same shape
+        giving the integer index of each point to be sampled.
+        """
+        level = self._calc_pyramid_level(iscale_x, iscale_y)
+        if level > 0:
+            data = self.get_pyramid_level(level)
+            xi = xi >> level
+            yi = yi >> level
+        else:
+            data = self.get_data()
+        return data[yi, xi]
+
     def get_scaled_cutout_wdht(self, x1, y1, x2, y2, new_wd, new_ht):
 
         # calculate dimensions of NON-scaled cutout
@@ -245,23 +517,17 @@ class BaseImage(Callback.Callbacks):
         data = self.get_data()
         
         if (new_wd != old_wd) or (new_ht != old_ht):
-            # Is there a more efficient way to do this?
             # Make indexes and scale them
-            yi, xi = numpy.mgrid[0:new_ht, 0:new_wd]
             iscale_x = float(old_wd) / float(new_wd)
             iscale_y = float(old_ht) / float(new_ht)
+            xi = x1 + (numpy.arange(new_wd) * iscale_x).astype('int')
+            yi = y1 + (numpy.arange(new_ht) * iscale_y).astype('int')
 
-            xi *= iscale_x 
-            yi *= iscale_y
-
-            # Cut out the data according to region desired
-            cutout = data[y1:y2+1, x1:x2+1]
-
-            # Now index cutout by scaled indexes
-            ht, wd = cutout.shape[:2]
-            xi = xi.astype('int').clip(0, wd-1)
-            yi = yi.astype('int').clip(0, ht-1)
-            newdata = cutout[yi, xi]
+            # Constrain indexes to the region desired
+            ht, wd = data.shape[:2]
+            xi = xi.clip(x1, min(x2, wd-1))
+            yi = yi.clip(y1, min(y2, ht-1))
+            newdata = self.sample_xy(xi, yi, iscale_x, iscale_y)
 
         else:
             newdata = data[y1:y2+1, x1:x2+1]
@@ -302,13 +568,13 @@ class BaseImage(Callback.Callbacks):
 
     
     def histogram(self, x1, y1, x2, y2, z=None, pct=1.0, numbins=2048):
-        data = self.get_data()
-        if z != None:
-            data = data[y1:y2, x1:x2, z]
+        ht, wd = self.get_data().shape[:2]
+        if (x1 <= 0) and (y1 <= 0) and (x2 >= wd) and (y2 >= ht):
+            region = None
         else:
-            data = data[y1:y2, x1:x2]
-
-        return self.autocuts.calc_histogram(data, pct=pct, numbins=numbins)
+            region = (x1, y1, x2, y2)
+        hist = self.get_histogram(numbins=numbins, region=region, z=z)
+        return self.autocuts.calc_histogram_cutoffs(hist, pct)
 
     def cut_levels(self, loval, hival, vmin=0.0, vmax=255.0):
         data = self.get_data()
@@ -27,7 +27,7 @@ except ImportError:
 # Local application imports
 from ginga import cmap, imap, AstroImage, RGBImage, ImageView
 from ginga.misc import Bunch, Datasrc, Callback, Timer, Task
-from ginga.util import catalog
+from ginga.util import catalog, querycache
 
 #pluginconfpfx = 'plugins'
 pluginconfpfx = None
@@ -87,7 +87,19 @@ class GingaControl(Callback.Callbacks):
                                   sansFont='Sans',
                                   channelFollowsFocus=False,
                                   shareReadout=True,
-                                  numImages=10)
+                                  numImages=10,
+                                  useMemmap=True,
+                                  memoryLimitMB=2048,
+                                  useQueryCache=True,
+                                  queryCacheDir=None,
+                                  queryCacheTTL=86400.0,
+                                  queryCacheMB=500,
+                                  queryCacheOffline=False)
+
+        # Limit on the memory used by the images in all channels
+        # (a channel may also set its own limit)
+        self.memory_budget = Datasrc.MemoryBudget(
+            self._mb_to_bytes(self.settings['memoryLimitMB']))
 
         # Should channel change as mouse moves between windows
         self.channel_follows_focus = self.settings['channelFollowsFocus']
@@ -111,6 +123,20 @@ class GingaControl(Callback.Callbacks):
         self.imgsrv = catalog.ServerBank(self.logger)
         self.dsscnt = 0
 
+        # Cache the results of catalog and image server queries on disk
+        if self.settings['useQueryCache']:
+            cachedir = self.settings['queryCacheDir']
+            if cachedir == None:
+                cachedir = os.path.join(self.prefs.folder, 'querycache')
+            ttl = self.settings['queryCacheTTL']
+            if (ttl != None) and (ttl <= 0):
+                ttl = None
+            cache = querycache.QueryCache(
+                self.logger, cachedir, ttl=ttl,
+                maxsize=self._mb_to_bytes(self.settings['queryCacheMB']),
+                offline=self.settings['queryCacheOffline'])
+            self.imgsrv.set_cache(cache)
+
 
     def get_ServerBank(self):
         return self.imgsrv
@@ -136,6 +162,15 @@ class GingaControl(Callback.Callbacks):
                 return
 
             prefs = fitsimage.get_settings()
+            if (prefs.get('wcs_use_grid', False) and
+                isinstance(image, AstroImage.AstroImage)):
+                # make a grid for fast readout of the coordinates
+                system = prefs.get('wcs_coords', None)
+                if image.coord_grid_needed(system):
+                    self.nongui_do(image.make_coord_grid, system,
+                                   spacing=prefs.get('wcs_grid_spacing', 64),
+                                   tolerance=prefs.get('wcs_grid_tolerance',
+                                                       0.01))
             info = image.info_xy(data_x, data_y, prefs)
 
         except Exception, e:
@@ -383,7 +418,7 @@ class GingaControl(Callback.Callbacks):
 
         raise ControlError("Can't determine file type of '%s'" % (filepath))
 
-    def load_image(self, filepath):
+    def load_image(self, filepath, naxispath=None):
         # Create an image.  Assume type to be an AstroImage unless
         # the MIME association says it is something different.
         try:
@@ -392,14 +427,19 @@ class GingaControl(Callback.Callbacks):
             # Can't determine file type: assume and attempt FITS
             typ, subtyp = 'image', 'fits'
         
+        kwdargs = {}
         if (typ == 'image') and (subtyp != 'fits'):
             image = RGBImage.RGBImage(logger=self.logger)
         else:
             image = AstroImage.AstroImage(logger=self.logger)
+            # map large FITS files rather than reading them in whole
+            kwdargs['memmap'] = self.settings.get('useMemmap', True)
+            if naxispath != None:
+                kwdargs['naxispath'] = naxispath
 
         try:
             self.logger.info("Loading image from %s" % (filepath))
-            image.load_file(filepath)
+            image.load_file(filepath, **kwdargs)
             #self.gui_do(chinfo.fitsimage.onscreen_message, "")
 
         except Exception, e:
@@ -532,7 +572,7 @@ class GingaControl(Callback.Callbacks):
                 self.logger.error("No previous image!")
             else:
                 chinfo.cursor -= 1
-                image = chinfo.datasrc[chinfo.cursor]
+                image = self._get_channel_image(chinfo, chinfo.cursor)
                 self._switch_image(chinfo, image)
             
         return True
@@ -547,7 +587,7 @@ class GingaControl(Callback.Callbacks):
                 self.logger.error("No next image!")
             else:
                 chinfo.cursor += 1
-                image = chinfo.datasrc[chinfo.cursor]
+                image = self._get_channel_image(chinfo, chinfo.cursor)
                 self._switch_image(chinfo, image)
 
         return True
@@ -635,9 +675,56 @@ class GingaControl(Callback.Callbacks):
 
     def get_image(self, chname, fitsname):
         chinfo = self.get_channelInfo(chname)
-        image = chinfo.datasrc[fitsname]
+        image = self._get_channel_image(chinfo, fitsname)
+        return image
+
+    def _get_channel_image(self, chinfo, key):
+        # Fetch an image (by name or index) from a channel, reloading it
+        # if it was spilled from memory
+        datasrc = chinfo.datasrc
+        if isinstance(key, int):
+            key = datasrc.index2key(key)
+        image = datasrc[key]
+        if not datasrc.is_spilled(key):
+            return image
+
+        stub = image
+        self.logger.info("Image '%s' was spilled from memory; reloading from %s" % (
+            key, stub.path))
+        image = self.load_image(stub.path, naxispath=stub.naxispath)
+        image.set(name=key, path=stub.path, chname=chinfo.name)
+        datasrc.restore(key, image)
         return image
 
+    def _spill_image(self, imname, image):
+        # Called when an image is ejected from a channel to meet a memory
+        # limit.  If it can be reloaded, return a stub to hold its place.
+        path = image.get('path', None)
+        if path == None:
+            self.logger.warn("Image '%s' has no path to reload it from; keeping it in memory" % (
+                imname))
+            return None
+        return Bunch.Bunch(name=imname, path=path,
+                           header=image.get_header(),
+                           naxispath=getattr(image, 'naxispath', None))
+
+    def _image_in_view(self, imname, image):
+        # Called to check whether an image may be spilled from memory;
+        # it may not while it is shown in any channel
+        # NOTE: no lock here, this is called with a channel's data
+        # source locked
+        for chinfo in list(self.channel.values()):
+            if ('fitsimage' in chinfo) and \
+                   (chinfo.fitsimage.get_image() == image):
+                return True
+        return False
+
+    def _mb_to_bytes(self, mb):
+        # a limit of zero or less means no limit
+        if mb <= 0:
+            return None
+        return int(mb * 1024 * 1024)
+
     def getfocus_fitsimage(self):
         chinfo = self.get_channelInfo()
         if chinfo == None:
@@ -653,8 +740,8 @@ class GingaControl(Callback.Callbacks):
     def switch_name(self, chname, imname, path=None):
         chinfo = self.get_channelInfo(chname)
         if chinfo.datasrc.has_key(imname):
-            # Image is still in the heap
-            image = chinfo.datasrc[imname]
+            # Image is still in the heap (or can be reloaded from its stub)
+            image = self._get_channel_image(chinfo, imname)
             self.change_channel(chname, image=image)
 
         else:
@@ -784,7 +871,8 @@ class GingaControl(Callback.Callbacks):
                 return name
         return None
                 
-    def add_channel_internal(self, chname, datasrc=None, num_images=1):
+    def add_channel_internal(self, chname, datasrc=None, num_images=1,
+                             memory_limit=None):
         name = chname.lower()
         with self.lock:
             try:
@@ -792,7 +880,12 @@ class GingaControl(Callback.Callbacks):
             except KeyError:
                 self.logger.debug("Adding channel '%s'" % (chname))
                 if datasrc == None:
-                    datasrc = Datasrc.Datasrc(num_images)
+                    datasrc = Datasrc.Datasrc(num_images,
+                                              maxsize=memory_limit,
+                                              sizefn=lambda image: image.get_nbytes(),
+                                              spillfn=self._spill_image,
+                                              keepfn=self._image_in_view,
+                                              budget=self.memory_budget)
 
                 chinfo = Bunch.Bunch(datasrc=datasrc,
                                  name=chname, cursor=0)
@@ -840,10 +933,12 @@ class GingaControl(Callback.Callbacks):
         
         # Make sure these preferences are at least defined
         prefs.setDefaults(switchnew=True, numImages=num_images,
-                          raisenew=True, genthumb=True)
+                          raisenew=True, genthumb=True, memoryLimitMB=0)
 
+        memory_limit = self._mb_to_bytes(prefs['memoryLimitMB'])
         chinfo = self.add_channel_internal(name,
-                                           num_images=prefs['numImages'])
+                                           num_images=prefs['numImages'],
+                                           memory_limit=memory_limit)
 
         with self.lock:
             bnch = self.add_viewer(chname, prefs,
@@ -891,6 +986,10 @@ class GingaControl(Callback.Callbacks):
             self.ds.remove_tab(chname)
             del self.channel[name]
 
+            # release the channel's share of the memory budget
+            if chinfo.datasrc.budget != None:
+                chinfo.datasrc.budget.remove_datasrc(chinfo.datasrc)
+
         self.make_callback('delete-channel', chinfo)
         
     def get_channelNames(self):
@@ -935,6 +1034,20 @@ class GingaControl(Callback.Callbacks):
             errmsg ="Failed to load catalog: %s" % (str(e))
             raise ControlError(errmsg)
 
+    def get_catalogs(self, keys, params, timeout=None,
+                     merge_radius_arcsec=1.0, cb_fn=None):
+        """Query several catalog servers concurrently.  See
+        ServerBank.getCatalogs().
+        """
+        try:
+            return self.imgsrv.getCatalogs(keys, timeout=timeout,
+                                           merge_radius_arcsec=merge_radius_arcsec,
+                                           cb_fn=cb_fn, **params)
+
+        except Exception, e:
+            errmsg ="Failed to load catalogs: %s" % (str(e))
+            raise ControlError(errmsg)
+
 
     def banner(self, raiseTab=True):
         bannerFile = os.path.join(self.iconpath, 'ginga-splash.ppm')
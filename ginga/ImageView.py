@@ -14,7 +14,7 @@ import threading
 import sys, traceback
 import time
 
-from ginga.misc import Callback, Settings
+from ginga.misc import Callback, Settings, LRUCache, Bunch, Task
 from ginga import RGBMap, AstroImage, AutoCuts
 from ginga import cmap, imap, trcalc, version
 
@@ -155,12 +155,30 @@ class ImageViewBase(Callback.Callbacks):
             self.t_.getSetting(name).add_callback('set', self.transform_cb)
 
         # desired rotation angle
-        self.t_.addDefaults(rot_deg=0.0)
+        self.t_.addDefaults(rot_deg=0.0, fast_rotate=True)
         self.t_.getSetting('rot_deg').add_callback('set', self.rotation_change_cb)
 
         # misc
         self.t_.addDefaults(use_embedded_profile=True, auto_orient=False)
 
+        # use a multi-resolution pyramid for zoomed out views of images
+        self.t_.addDefaults(use_pyramid=False)
+
+        # map data values to colors in one pass where possible
+        self.t_.addDefaults(fused_rgbmap=True)
+
+        # for tiled rendering
+        self.t_.addDefaults(use_tiles=False, tile_size=256, tile_cache_mb=64)
+        for name in ('use_tiles', 'tile_size'):
+            self.t_.getSetting(name).add_callback('set', self.tiles_change_cb)
+        self.t_.getSetting('tile_cache_mb').add_callback('set',
+                                                         self.tile_cache_cb)
+
+        # for splitting rendering into bands across a thread pool
+        # (see set_threadpool())
+        self.t_.addDefaults(render_bands=1)
+        self.threadPool = None
+
         # Object that calculates auto cut levels
         name = self.t_.get('autocut_method', 'histogram')
         klass = AutoCuts.get_autocuts(name)
@@ -210,9 +228,16 @@ class ImageViewBase(Callback.Callbacks):
 
         self._cutout = None
         self._rotimg = None
+        # cached window offset grids (see get_rotated_cutout())
+        self._offset_grid = None
+        self._offset_grid_key = None
         self._prergb = None
         self._rgbobj = None
 
+        # cache of rendered RGB tiles (see get_tiled_rgb_object())
+        cache_size = int(self.t_['tile_cache_mb'] * 1024 * 1024)
+        self._tile_cache = LRUCache.LRUCache(cache_size)
+
         # optimization of redrawing
         self.defer_redraw = True
         self.defer_lagtime = 0.025
@@ -407,7 +432,12 @@ class ImageViewBase(Callback.Callbacks):
         If there is no error, this method will invoke the 'image-set'
         callback.
         """
+        if image != self.image:
+            self._tile_cache.clear()
         self.image = image
+        if self.t_['use_pyramid']:
+            image.enable_pyramid(True)
+
         profile = self.image.get('profile', None)
         if (profile != None) and (self.t_['use_embedded_profile']):
             self.apply_profile(profile, redraw=False)
@@ -429,12 +459,51 @@ class ImageViewBase(Callback.Callbacks):
 
         # update our display if the image changes underneath us
         image.add_callback('modified', self._image_updated)
+        image.add_callback('region-modified', self._image_region_updated)
         
         self.make_callback('image-set', image)
 
     def _image_updated(self, image):
+        self._tile_cache.clear()
         self.redraw(whence=0)
         
+    def _image_region_updated(self, image, x1, y1, x2, y2):
+        # only the cached tiles covering the region need to be remade
+        image_id = id(image)
+        self._tile_cache.remove_if(lambda key: self._tile_overlaps(
+            key, image_id, x1, y1, x2, y2))
+        if image == self.image:
+            self.redraw(whence=0)
+
+    def _tile_overlaps(self, key, image_id, x1, y1, x2, y2):
+        # see get_tiled_rgb_object() for the layout of the key
+        if key[0] != image_id:
+            return False
+        scale_x, scale_y, tile_size = key[1], key[2], key[-3]
+        tx, ty = key[-2:]
+        iscale_x, iscale_y = 1.0 / scale_x, 1.0 / scale_y
+        # Range of data pixels sampled by the tile.  A sample taken
+        # from a pyramid level may come from up to one scaled pixel
+        # before the one it stands for.
+        a1 = tx * tile_size * iscale_x - iscale_x - 1
+        a2 = (tx + 1) * tile_size * iscale_x + 1
+        b1 = ty * tile_size * iscale_y - iscale_y - 1
+        b2 = (ty + 1) * tile_size * iscale_y + 1
+        return (a1 < x2) and (a2 > x1) and (b1 < y2) and (b2 > y1)
+
+    def update_data_region(self, x1, y1, x2, y2, data=None):
+        """
+        Update the region from (x1, y1) up to but not including (x2, y2)
+        of the displayed image in place, and redraw just that part of it.
+
+        If data is given it is copied into the region, otherwise the
+        image data has already been modified there.
+        See BaseImage.update_region().
+        """
+        if self.image == None:
+            return
+        self.image.update_region(x1, y1, x2, y2, data_np=data)
+
     def set_data(self, data, metadata=None, redraw=True):
         """
         Sets an image to be displayed by providing raw data.
@@ -665,44 +734,79 @@ class ImageViewBase(Callback.Callbacks):
         
         time_start = time.time()
         win_wd, win_ht = self.get_window_size()
+
+        if self._use_tiled_render():
+            if (whence <= 2) or (self._rgbobj == None):
+                self._rgbobj = self.get_tiled_rgb_object(win_wd, win_ht)
+            self.logger.debug("times: total=%.4f (tiled)" % (
+                time.time() - time_start))
+            return self._rgbobj
         
-        if (whence <= 0) or (self._cutout == None):
-            # Get the smallest slice of data that will fit our display needs.
-            self._cutout = self.get_scaled_cutout(self.image,
-                  self._scale_x, self._scale_y,
-                  self._pan_x, self._pan_y, win_wd, win_ht)
-
-        time_split1 = time.time()
-        if (whence <= 0.5) or (self._rotimg == None):
-            # Apply any viewing transformations or rotations
-            self._rotimg = self.apply_transforms(self._cutout,
-                              self.t_['rot_deg'], 
-                              win_wd, win_ht)
+        if self._use_fast_rotate():
+            if (whence <= 0.5) or (self._rotimg == None):
+                # Sample the scaled, transformed and rotated data for
+                # just the window, in one step
+                self._rotimg = self.get_rotated_cutout(self.image,
+                                                       win_wd, win_ht)
+            time_split1 = time.time()
+
+        else:
+            if (whence <= 0) or (self._cutout == None):
+                # Get the smallest slice of data that will fit our
+                # display needs.
+                self._cutout = self.get_scaled_cutout(self.image,
+                      self._scale_x, self._scale_y,
+                      self._pan_x, self._pan_y, win_wd, win_ht)
+
+            time_split1 = time.time()
+            if (whence <= 0.5) or (self._rotimg == None):
+                # Apply any viewing transformations or rotations
+                self._rotimg = self.apply_transforms(self._cutout,
+                                  self.t_['rot_deg'], 
+                                  win_wd, win_ht)
             
         time_split2 = time.time()
-        if (whence <= 1) or (self._prergb == None):
-            # Apply visual changes prior to color mapping (cut levels, etc)
-            vmax = self.rgbmap.get_hash_size() - 1
-            newdata = self.apply_visuals(self._rotimg, 0, vmax)
-
-            # Result becomes an index array fed to the RGB mapper
-            if not numpy.issubdtype(newdata.dtype, numpy.dtype('uint')):
-                newdata = newdata.astype(numpy.uint)
-            self._prergb = newdata
-                
-        time_split3 = time.time()
-        if (whence <= 2) or (self._rgbobj == None):
-            idx = self._prergb
-            self.logger.debug("shape of index is %s" % (str(idx.shape)))
-
-            # Apply color and intensity mapping.  We produce a group of
-            # ARGB slices which are then rendered by the widget-specific
-            # front end.
-            rgb_order = self.get_rgb_order()
-            image_order = self.image.get_order()
-            rgbobj = self.rgbmap.get_rgbarray(idx, order=rgb_order,
-                                              image_order=image_order)
-            self._rgbobj = rgbobj
+        if self._use_fused_rgbmap(self._rotimg):
+            if (whence <= 2) or (self._rgbobj == None):
+                # Apply cut levels and color mapping in a single pass
+                rgb_order = self.get_rgb_order()
+                self._rgbobj = self.get_rgbarray_fused(self._rotimg,
+                                                       rgb_order)
+            time_split3 = time_split2
+
+        else:
+            if (whence <= 1) or (self._prergb == None):
+                # Apply visual changes prior to color mapping (cut levels,
+                # etc)
+                vmax = self.rgbmap.get_hash_size() - 1
+                if self._use_bands():
+                    newdata = self.apply_visuals_banded(self._rotimg, 0,
+                                                        vmax)
+                else:
+                    newdata = self.apply_visuals(self._rotimg, 0, vmax)
+
+                # Result becomes an index array fed to the RGB mapper
+                if not numpy.issubdtype(newdata.dtype, numpy.dtype('uint')):
+                    newdata = newdata.astype(numpy.uint)
+                self._prergb = newdata
+
+            time_split3 = time.time()
+            if (whence <= 2) or (self._rgbobj == None):
+                idx = self._prergb
+                self.logger.debug("shape of index is %s" % (str(idx.shape)))
+
+                # Apply color and intensity mapping.  We produce a group of
+                # ARGB slices which are then rendered by the widget-specific
+                # front end.
+                rgb_order = self.get_rgb_order()
+                image_order = self.image.get_order()
+                if self._use_bands():
+                    rgbobj = self.get_rgbarray_banded(idx, rgb_order,
+                                                      image_order)
+                else:
+                    rgbobj = self.rgbmap.get_rgbarray(idx, order=rgb_order,
+                                                  image_order=image_order)
+                self._rgbobj = rgbobj
 
         time_end = time.time()
         self.logger.debug("times: total=%.4f cutout=%.4f transform=%.4f index=%.4f rgbmap=%.4f" % (
@@ -714,9 +818,305 @@ class ImageViewBase(Callback.Callbacks):
             ))
         return self._rgbobj
 
-    def get_scaled_cutout(self, image, scale_x, scale_y,
-                          pan_x, pan_y, win_wd, win_ht):
+    def set_threadpool(self, threadPool):
+        """
+        Set a ginga.misc.Task.ThreadPool to be used for rendering in
+        parallel.  The 'render_bands' setting determines how many
+        horizontal bands the window is split into for the cut levels and
+        color mapping stages.
+        """
+        self.threadPool = threadPool
+
+    def _use_bands(self):
+        return (self.threadPool != None) and (self.t_['render_bands'] > 1)
+
+    def do_in_bands(self, func, num_rows):
+        """
+        Call func(y1, y2) for each of a number of horizontal bands that
+        together cover `num_rows` rows.  The bands are processed by the
+        calling thread together with the thread pool, and this method
+        returns when all of them are done.
+        """
+        num_bands = max(1, min(self.t_['render_bands'], num_rows))
+        bands = [ (i * num_rows // num_bands, (i+1) * num_rows // num_bands)
+                  for i in xrange(num_bands) ]
+        cond = threading.Condition()
+        bnch = Bunch.Bunch(bands=bands, remaining=num_bands, errors=[])
+
+        def _work():
+            # process bands until there are none left
+            while True:
+                with cond:
+                    if len(bnch.bands) == 0:
+                        return
+                    y1, y2 = bnch.bands.pop()
+                try:
+                    func(y1, y2)
+                except Exception as e:
+                    bnch.errors.append(e)
+                with cond:
+                    bnch.remaining -= 1
+                    if bnch.remaining <= 0:
+                        cond.notify_all()
+
+        # NOTE: the calling thread works too, so that if all of the
+        # workers are busy (or it is a worker itself) we cannot deadlock
+        for i in xrange(num_bands - 1):
+            task = Task.FuncTask2(_work)
+            task.initialize(self)
+            self.threadPool.addTask(task)
+        _work()
+
+        with cond:
+            while bnch.remaining > 0:
+                cond.wait()
+
+        if len(bnch.errors) > 0:
+            raise bnch.errors[0]
+
+    def apply_visuals_banded(self, data, vmin, vmax):
+        """
+        Like apply_visuals(), but the cut levels are applied in bands
+        (see do_in_bands()) into a single preallocated index array.
+        """
+        if self._invertY:
+            data = numpy.flipud(data)
+        newdata = numpy.empty(data.shape, dtype=numpy.uint)
+
+        loval, hival = self.t_['cuts']
+        def _cut_band(y1, y2):
+            newdata[y1:y2] = self.autocuts.cut_levels(data[y1:y2],
+                                                      loval, hival,
+                                                      vmin=vmin, vmax=vmax)
+
+        self.do_in_bands(_cut_band, data.shape[0])
+        return newdata
+
+    def get_rgbarray_banded(self, idx, rgb_order, image_order):
+        """
+        Like RGBMapper.get_rgbarray(), but the color mapping is done in
+        bands (see do_in_bands()) into a single preallocated RGB array.
+        """
+        ht, wd = idx.shape[:2]
+        outarr = numpy.empty((ht, wd, len(rgb_order)), dtype=numpy.uint8)
+
+        def _map_band(y1, y2):
+            self.rgbmap.get_rgbarray(idx[y1:y2], out=outarr[y1:y2],
+                                     order=rgb_order,
+                                     image_order=image_order)
+
+        self.do_in_bands(_map_band, ht)
+        return RGBMap.RGBPlanes(outarr, rgb_order)
+
+    def _use_fused_rgbmap(self, data):
+        # only for monochrome data and the standard linear cut levels
+        return (self.t_['fused_rgbmap'] and (len(data.shape) == 2) and
+                not isinstance(self.autocuts, AutoCuts.Clip))
+
+    def get_rgbarray_fused(self, data, rgb_order):
+        """
+        Like apply_visuals() followed by RGBMapper.get_rgbarray(), but
+        done in one pass by RGBMapper.get_rgbarray_from_data().
+        """
+        if self._invertY:
+            data = numpy.flipud(data)
+        loval, hival = self.t_['cuts']
+        ht, wd = data.shape[:2]
+        outarr = numpy.empty((ht, wd, len(rgb_order)), dtype=numpy.uint8)
+
+        def _map_band(y1, y2):
+            self.rgbmap.get_rgbarray_from_data(data[y1:y2], loval, hival,
+                                               out=outarr[y1:y2],
+                                               order=rgb_order)
+
+        if self._use_bands():
+            self.do_in_bands(_map_band, ht)
+        else:
+            _map_band(0, ht)
+        return RGBMap.RGBPlanes(outarr, rgb_order)
 
+    def _use_fast_rotate(self):
+        return (self.t_['fast_rotate'] and (self.t_['rot_deg'] != 0.0) and
+                not self.t_makebg)
+
+    def get_offset_grid(self, win_wd, win_ht):
+        """
+        Returns a pair of 2D arrays (off_x, off_y) holding, for every pixel
+        in the window, its offset from the pan position in data pixels at
+        unity scale (i.e. canvas2offset() for every pixel).  Rows are
+        ordered from the bottom of the window up.  The grids depend only
+        on the window size, rotation and transforms, so they are cached.
+        """
+        key = (win_wd, win_ht, self._ctr_x, self._ctr_y, self._originUpper,
+               self.t_['rot_deg'], self.t_['flip_x'], self.t_['flip_y'],
+               self.t_['swap_xy'])
+        if key == self._offset_grid_key:
+            return self._offset_grid
+
+        xs = numpy.arange(win_wd, dtype=numpy.float) - self._ctr_x
+        ys = numpy.arange(win_ht - 1, -1, -1, dtype=numpy.float)
+        if self._originUpper:
+            ys = self._ctr_y - ys
+        else:
+            ys = ys - self._ctr_y
+        off_x, off_y = trcalc.rotate_grid(xs, ys, -self.t_['rot_deg'])
+
+        if self.t_['swap_xy']:
+            off_x, off_y = off_y, off_x
+        if self.t_['flip_y']:
+            numpy.negative(off_y, out=off_y)
+        if self.t_['flip_x']:
+            numpy.negative(off_x, out=off_x)
+
+        self._offset_grid = (off_x, off_y)
+        self._offset_grid_key = key
+        return self._offset_grid
+
+    def get_rotated_cutout(self, image, win_wd, win_ht):
+        """
+        Returns an array the size of the window, holding the image data
+        for the current pan, scale, transforms and rotation.  This fuses
+        the work of get_scaled_cutout() and apply_transforms() into a
+        single gather that only touches the pixels that are visible.
+        Parts of the window outside of the image are filled with zeros.
+        """
+        pan_x, pan_y = self._pan_x, self._pan_y
+        # sets up the reference values used by get_data_xy()
+        x1, y1, x2, y2, scale_x, scale_y = self._calc_cutout_bbox(image,
+                        self._scale_x, self._scale_y, pan_x, pan_y,
+                        win_wd, win_ht)
+
+        off_x, off_y = self.get_offset_grid(win_wd, win_ht)
+
+        # data index of each window pixel (see get_data_xy())
+        iscale_x, iscale_y = 1.0 / scale_x, 1.0 / scale_y
+        xi = numpy.floor(off_x * iscale_x + pan_x).astype(numpy.int)
+        yi = numpy.floor(off_y * iscale_y + pan_y).astype(numpy.int)
+
+        width, height = image.get_size()
+        outside = (xi < 0) | (xi >= width) | (yi < 0) | (yi >= height)
+        xi.clip(0, width-1, out=xi)
+        yi.clip(0, height-1, out=yi)
+        newdata = image.sample_points(xi, yi, iscale_x, iscale_y)
+        newdata[outside] = 0
+
+        self._dst_x, self._dst_y = 0, 0
+        return newdata
+
+    def _use_tiled_render(self):
+        # tiles are kept in unrotated data orientation, so they are only
+        # used when there is no rotation
+        return (self.t_['use_tiles'] and (self.t_['rot_deg'] == 0.0) and
+                not self.t_makebg)
+
+    def get_tiled_rgb_object(self, win_wd, win_ht):
+        """
+        Create and return an RGB slices object for the window, like
+        get_rgb_object(), but assembled from fixed size tiles of the
+        scaled, cut and color mapped image.  Tiles are kept in a bounded
+        LRU cache, so that a pan only needs to compute the newly exposed
+        tiles.
+        """
+        image = self.image
+        pan_x, pan_y = self._pan_x, self._pan_y
+        x1, y1, x2, y2, scale_x, scale_y = self._calc_cutout_bbox(image,
+                        self._scale_x, self._scale_y, pan_x, pan_y,
+                        win_wd, win_ht)
+
+        # area needed, in the grid of scaled pixels
+        sx1, sy1 = int(x1 * scale_x), int(y1 * scale_y)
+        sx2 = int(math.ceil((x2 + 1) * scale_x))
+        sy2 = int(math.ceil((y2 + 1) * scale_y))
+
+        tile_size = self.t_['tile_size']
+        rgb_order = self.get_rgb_order()
+        vmax = self.rgbmap.get_hash_size() - 1
+        loval, hival = self.t_['cuts']
+        # everything that determines the contents of a tile except
+        # its position
+        tile_key = (id(image), scale_x, scale_y, loval, hival,
+                    str(self.autocuts), vmax, rgb_order,
+                    self.rgbmap.get_state_key(), tile_size)
+
+        outarr = numpy.empty((sy2 - sy1, sx2 - sx1, len(rgb_order)),
+                             dtype=numpy.uint8)
+        num_made = 0
+        for ty in xrange(sy1 // tile_size, (sy2 - 1) // tile_size + 1):
+            for tx in xrange(sx1 // tile_size, (sx2 - 1) // tile_size + 1):
+                key = tile_key + (tx, ty)
+                try:
+                    tile = self._tile_cache[key]
+                except KeyError:
+                    tile = self._make_tile(image, tx, ty, tile_size,
+                                           scale_x, scale_y, loval, hival,
+                                           vmax, rgb_order)
+                    self._tile_cache[key] = tile
+                    num_made += 1
+
+                # copy the part of the tile that overlaps the area
+                a1, b1 = tx * tile_size, ty * tile_size
+                ht, wd = tile.shape[:2]
+                xa, ya = max(a1, sx1), max(b1, sy1)
+                xb, yb = min(a1 + wd, sx2), min(b1 + ht, sy2)
+                outarr[ya-sy1:yb-sy1, xa-sx1:xb-sx1] = \
+                                      tile[ya-b1:yb-b1, xa-a1:xb-a1]
+
+        self.logger.debug("tiles: %d made, cache holds %d (%d bytes)" % (
+            num_made, len(self._tile_cache), self._tile_cache.get_size()))
+
+        self._org_scale_x, self._org_scale_y = scale_x, scale_y
+        self._org_xoff = int(pan_x * scale_x) - sx1
+        self._org_yoff = int(pan_y * scale_y) - sy1
+
+        # color mapping is a per-pixel operation, so the transforms can
+        # be applied after it
+        data = self.apply_transforms(outarr, 0.0, win_wd, win_ht)
+        if self._invertY:
+            data = numpy.flipud(data)
+        data = numpy.ascontiguousarray(data)
+        return RGBMap.RGBPlanes(data, rgb_order)
+
+    def _make_tile(self, image, tx, ty, tile_size, scale_x, scale_y,
+                   loval, hival, vmax, rgb_order):
+        width, height = image.get_size()
+        # a scaled pixel maps to the data pixel in which it starts
+        a1, b1 = tx * tile_size, ty * tile_size
+        a2 = min(a1 + tile_size, int(math.ceil(width * scale_x)))
+        b2 = min(b1 + tile_size, int(math.ceil(height * scale_y)))
+        iscale_x, iscale_y = 1.0 / scale_x, 1.0 / scale_y
+        xi = (numpy.arange(a1, a2) * iscale_x).astype('int')
+        yi = (numpy.arange(b1, b2) * iscale_y).astype('int')
+        xi = xi.clip(0, width-1)
+        yi = yi.clip(0, height-1)
+        data = image.sample_xy(xi, yi, iscale_x, iscale_y)
+
+        if self._use_fused_rgbmap(data):
+            rgbobj = self.rgbmap.get_rgbarray_from_data(data, loval, hival,
+                                                        order=rgb_order)
+            return rgbobj.rgbarr
+
+        newdata = self.autocuts.cut_levels(data, loval, hival,
+                                           vmin=0, vmax=vmax)
+        if not numpy.issubdtype(newdata.dtype, numpy.dtype('uint')):
+            newdata = newdata.astype(numpy.uint)
+
+        rgbobj = self.rgbmap.get_rgbarray(newdata, order=rgb_order,
+                                          image_order=image.get_order())
+        return rgbobj.rgbarr
+
+    def tiles_change_cb(self, setting, value):
+        self._tile_cache.clear()
+        self.redraw(whence=0)
+
+    def tile_cache_cb(self, setting, value):
+        self._tile_cache.set_maxsize(int(value * 1024 * 1024))
+
+    def _calc_cutout_bbox(self, image, scale_x, scale_y,
+                          pan_x, pan_y, win_wd, win_ht):
+        """Calculate the bounding box (x1, y1, x2, y2) in the data of the
+        area needed to fill the window.  Returns the bounding box and the
+        (possibly adjusted) scale factors.
+        """
         # Sanity check on the scale
         sx = float(win_wd) / scale_x
         sy = float(win_ht) / scale_y
@@ -757,9 +1157,6 @@ class ImageViewBase(Callback.Callbacks):
         x2 = min(x2, width-1)
         y2 = min(y2, height-1)
 
-        # distance from start of cutout data to pan position
-        xo, yo = pan_x - x1, pan_y - y1
-
         self.logger.debug("approx area covered is %dx%d to %dx%d" % (
             x1, y1, x2, y2))
 
@@ -767,6 +1164,16 @@ class ImageViewBase(Callback.Callbacks):
         self._org_y1 = y1
         self._org_x2 = x2
         self._org_y2 = y2
+        return (x1, y1, x2, y2, scale_x, scale_y)
+
+    def get_scaled_cutout(self, image, scale_x, scale_y,
+                          pan_x, pan_y, win_wd, win_ht):
+
+        x1, y1, x2, y2, scale_x, scale_y = self._calc_cutout_bbox(image,
+                        scale_x, scale_y, pan_x, pan_y, win_wd, win_ht)
+
+        # distance from start of cutout data to pan position
+        xo, yo = pan_x - x1, pan_y - y1
 
         # Cut out data and scale it appropriately
         res = image.get_scaled_cutout(x1, y1, x2, y2, scale_x, scale_y)
@@ -8,6 +8,7 @@
 # Please see the file LICENSE.txt for details.
 #
 import math
+import itertools
 import numpy
 
 from ginga.util import io_rgb
@@ -16,6 +17,10 @@ from ginga.misc import Callback
 class RGBMapError(Exception):
     pass
 
+# global counter for the versions of the color mappings, so that state
+# keys are unique across mappers (see RGBMapper.get_state_key())
+_version_count = itertools.count()
+
 class RGBPlanes(object):
 
     def __init__(self, rgbarr, order):
@@ -67,6 +72,8 @@ class RGBMapper(Callback.Callbacks):
         self.iarr = None
         self.carr = None
         self.sarr = None
+        # bumped whenever the mapping of index values to colors changes
+        self._version = next(_version_count)
 
         # For color scale algorithms
         self.hashalgs = { 'linear': self.calc_linear_hash,
@@ -79,6 +86,12 @@ class RGBMapper(Callback.Callbacks):
         self.expo = 10.0
         self.calc_hash()
 
+        # For the combined lookup table (see get_lut())
+        self._lut = None
+        self._lut_key = None
+        # number of pixels processed at a time by get_rgbarray_from_data()
+        self.block_size = 65536
+
         # For callbacks
         for name in ('changed', ):
             self.enable_callback(name)
@@ -146,8 +159,12 @@ class RGBMapper(Callback.Callbacks):
         arr = numpy.array(self.imap.ilst) * 255.0
         self.iarr = numpy.round(arr).astype('uint')
 
+    def _bump_version(self):
+        self._version = next(_version_count)
+
     def reset_sarr(self, callback=True):
         self.sarr = numpy.array(range(256))
+        self._bump_version()
         if callback:
             self.make_callback('changed')
 
@@ -155,6 +172,7 @@ class RGBMapper(Callback.Callbacks):
         assert len(sarr) == 256, \
                RGBMapError("shift map length %d != 256" % (len(sarr)))
         self.sarr = sarr.astype('uint')
+        self._bump_version()
 
         if callback:
             self.make_callback('changed')
@@ -171,8 +189,16 @@ class RGBMapper(Callback.Callbacks):
             self.arr[1] = self.arr[1][idx]
             self.arr[2] = self.arr[2][idx]
 
+        # NOTE: reset_sarr() bumps the version
         self.reset_sarr(callback=callback)
         
+    def get_state_key(self):
+        """
+        Returns a hashable value that changes whenever the mapping of
+        index values to colors changes.  Useful for caching results.
+        """
+        return self._version
+
     def get_hash_size(self):
         return self.hashsize
 
@@ -276,6 +302,81 @@ class RGBMapper(Callback.Callbacks):
 
         return res
     
+    def get_lut(self, order='RGB'):
+        """
+        Returns a combined lookup table of shape (hashsize, len(order))
+        that maps a hash index straight to the color bytes in `order`,
+        i.e. the hash, shift map, intensity map and color map all in one.
+        The table is rebuilt only when the mapping changes.
+        """
+        order = order.upper()
+        key = (order, self.get_state_key())
+        if key == self._lut_key:
+            return self._lut
+
+        # See _get_rgbarray() for the equivalent steps
+        idx = self.hash.clip(0, 255)
+        idx = self.sarr[idx]
+        idx.clip(0, 255, out=idx)
+
+        lut = numpy.empty((len(idx), len(order)), dtype=numpy.uint8)
+        for i, c in enumerate(order):
+            if c == 'A':
+                lut[:, i] = 255
+            else:
+                lut[:, i] = self.arr['RGB'.index(c)][idx]
+
+        self._lut, self._lut_key = lut, key
+        return lut
+
+    def get_rgbarray_from_data(self, data, loval, hival, out=None,
+                               order='RGB'):
+        """
+        Maps the values in the 2D array `data` straight to colors.  The
+        result is the same as applying AutoCutsBase.cut_levels() with
+        (loval, hival) and then get_rgbarray(), but it is done in a single
+        pass through the combined lookup table (see get_lut()) and the
+        only full size array is the output.  Returns an RGBPlanes object.
+        """
+        ht, wd = data.shape
+        res_shape = (ht, wd, len(order))
+        if out == None:
+            out = numpy.empty(res_shape, dtype=numpy.uint8, order='C')
+        else:
+            assert res_shape == out.shape, \
+                   RGBMapError("Output array shape %s doesn't match result shape %s" % (
+                str(out.shape), str(res_shape)))
+
+        lut = self.get_lut(order)
+        vmax = self.hashsize - 1
+        delta = float(hival - loval)
+
+        # Work on blocks of rows, so that the temporaries are small and
+        # can be reused.  See NOTE [A]
+        rows = max(1, self.block_size // max(wd, 1))
+        work = numpy.empty((rows, wd), dtype=numpy.float)
+        idx = numpy.empty((rows, wd), dtype=numpy.intp)
+        for y1 in xrange(0, ht, rows):
+            y2 = min(y1 + rows, ht)
+            w, ix = work[:y2-y1], idx[:y2-y1]
+
+            numpy.subtract(data[y1:y2], loval, out=w)
+            if delta != 0.0:
+                numpy.multiply(w, vmax / delta, out=w)
+            else:
+                # threshold
+                w[...] = numpy.logical_not(w <= 0.0)
+                numpy.multiply(w, vmax, out=w)
+            # clip to the hash range; fmin() sends NaNs to the top,
+            # as get_hasharray() would do
+            numpy.fmin(w, vmax, out=w)
+            numpy.maximum(w, 0.0, out=w)
+            # truncate to hash index
+            ix[...] = w
+            lut.take(ix, axis=0, out=out[y1:y2], mode='clip')
+
+        return RGBPlanes(out, order)
+
     def get_hasharray(self, idx):
         # NOTE: data is assumed to be in the range 0..hashsize-1 at this point
         # but clip as a precaution
@@ -312,6 +413,7 @@ class RGBMapper(Callback.Callbacks):
         assert len(work) == 256, \
                RGBMapError("shifted shift map is != 256")
         self.sarr = work
+        self._bump_version()
         if callback:
             self.make_callback('changed')
         
@@ -348,6 +450,7 @@ class RGBMapper(Callback.Callbacks):
                RGBMapError("shifted shift map is != 256")
 
         self.sarr = work
+        self._bump_version()
         if callback:
             self.make_callback('changed')
 
@@ -408,12 +511,28 @@ class RGBMapper(Callback.Callbacks):
     def calc_hash(self):
         method = self.hashalgs[self.hashalg]
         method()
+        self._bump_version()
 
     def copy_attributes(self, dst_rgbmap):
         dst_rgbmap.set_cmap(self.cmap)
         dst_rgbmap.set_imap(self.imap)
         dst_rgbmap.set_hash_algorithm(self.hashalg)
 
+    def copy(self):
+        """
+        Return a new RGBMapper with the same color and intensity maps,
+        color scale algorithm and shift map as this one.  Later changes
+        to either one do not affect the other.
+        """
+        rgbmap = self.__class__(self.logger)
+        rgbmap.expo = self.expo
+        rgbmap.set_hash_size(self.hashsize, callback=False)
+        rgbmap.set_hash_algorithm(self.hashalg, callback=False)
+        rgbmap.set_cmap(self.cmap, callback=False)
+        rgbmap.set_imap(self.imap, callback=False)
+        rgbmap.set_sarr(self.sarr, callback=False)
+        return rgbmap
+
     def reset_cmap(self):
         self.recalc()
 
@@ -338,6 +338,7 @@ class GingaView(GtkMain.GtkMain):
         fi = ImageViewCanvasGtk.ImageViewCanvas(logger=self.logger,
                                                 rgbmap=rgbmap,
                                                 settings=settings)
+        fi.set_threadpool(self.threadPool)
         fi.add_callback('motion', self.motion_cb)
         fi.add_callback('cursor-down', self.force_focus_cb)
         fi.add_callback('key-press', self.keypress)
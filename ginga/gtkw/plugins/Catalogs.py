@@ -453,7 +453,7 @@ class CatalogListing(CatalogsBase.CatalogListingBase):
     def _mkcolfnN(self, kwd):
         def fn(*args):
             column, cell, model, iter = args[:4]
-            bnch = model.get_value(iter, 0)
+            bnch = self.starlist[model.get_value(iter, 0)]
             cell.set_property('text', bnch[kwd])
         return fn
 
@@ -469,8 +469,8 @@ class CatalogListing(CatalogsBase.CatalogListingBase):
     def _mksrtfnN(self, key):
         def fn(*args):
             model, iter1, iter2 = args[:3]
-            bnch1 = model.get_value(iter1, 0)
-            bnch2 = model.get_value(iter2, 0)
+            bnch1 = self.starlist[model.get_value(iter1, 0)]
+            bnch2 = self.starlist[model.get_value(iter2, 0)]
             val1, val2 = bnch1[key], bnch2[key]
             if isinstance(val1, str):
                 val1 = val1.lower()
@@ -489,22 +489,26 @@ class CatalogListing(CatalogsBase.CatalogListingBase):
         # rebuild the table
         self.build_table(info)
         
-        # Update the starlist info
-        listmodel = gtk.ListStore(object)
-        for star in starlist:
+        # Update the starlist info.  The model holds star numbers, so
+        # that stars are only looked up when their rows are displayed
+        listmodel = gtk.ListStore(int)
+        for i in xrange(len(starlist)):
             # TODO: find mag range
-            listmodel.append([star])
+            listmodel.append([i])
 
         self.treeview.set_model(listmodel)
 
     def _get_star_path(self, star):
         model = self.treeview.get_model()
+        try:
+            num = self.starlist.index(star)
+        except ValueError:
+            return None
         # find path containing this star in the treeview
         # TODO: is there a more efficient way to do this?
         for path in xrange(len(self.starlist)):
             iter = model.get_iter(path)
-            cstar = model.get_value(iter, 0)
-            if cstar == star:
+            if model.get_value(iter, 0) == num:
                 return path
         return None
 
@@ -513,7 +517,7 @@ class CatalogListing(CatalogsBase.CatalogListingBase):
         res = []
         for idx in xrange(fromidx, toidx):
             iter = model.get_iter(idx)
-            star = model.get_value(iter, 0)
+            star = self.starlist[model.get_value(iter, 0)]
             res.append(star)
         return res
 
@@ -542,7 +546,7 @@ class CatalogListing(CatalogsBase.CatalogListingBase):
         path, column = treeview.get_cursor()
         model = treeview.get_model()
         iter = model.get_iter(path)
-        star = model.get_value(iter, 0)
+        star = self.starlist[model.get_value(iter, 0)]
         self.logger.debug("selected star: %s" % (str(star)))
         self.mark_selection(star, fromtable=True)
         return True
@@ -8,10 +8,11 @@
 # Please see the file LICENSE.txt for details.
 #
 import os
+import numpy
 import gtk
 import gobject
 
-from ginga.gtkw import ImageViewGtk as ImageViewGtk
+from ginga.gtkw import gtksel
 from ginga.gtkw import GtkHelp
 from ginga.misc.plugins import ThumbsBase
 from ginga.misc import Bunch
@@ -27,14 +28,6 @@ class Thumbs(ThumbsBase.ThumbsBase):
         width, height = 300, 300
         cm, im = self.fv.cm, self.fv.im
 
-        tg = ImageViewGtk.ImageViewGtk(logger=self.logger)
-        tg.configure(200, 200)
-        tg.enable_autozoom('on')
-        tg.enable_autocuts('on')
-        tg.enable_auto_orient(True)
-        tg.set_makebg(False)
-        self.thumb_generator = tg
-
         sw = gtk.ScrolledWindow()
         sw.set_border_width(2)
         sw.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
@@ -66,6 +59,27 @@ class Thumbs(ThumbsBase.ThumbsBase):
         container.pack_start(w, fill=True, expand=False)
 
 
+    def make_thumb_widget(self, rgbarr):
+        daht, dawd, depth = rgbarr.shape
+        rgbarr = numpy.ascontiguousarray(rgbarr)
+        try:
+            pixbuf = gtksel.pixbuf_new_from_array(rgbarr,
+                                                  gtk.gdk.COLORSPACE_RGB, 8)
+        except Exception:
+            # pygtk might have been compiled without numpy support
+            rgb_buf = rgbarr.tostring()
+            pixbuf = gtksel.pixbuf_new_from_data(rgb_buf,
+                                                 gtk.gdk.COLORSPACE_RGB,
+                                                 False, 8, dawd, daht, dawd*3)
+        image = gtk.Image()
+        image.set_from_pixbuf(pixbuf)
+        image.show()
+        return image
+
+    def save_thumb_widget(self, imgwin, thumbpath):
+        pixbuf = imgwin.get_pixbuf()
+        pixbuf.save(thumbpath, 'jpeg', { 'quality': '90' })
+
     def _mktt(self, thumbkey, name, metadata):
         return lambda tw, x, y, kbmode, ttw: self.query_thumb(thumbkey, name, metadata, x, y, ttw)
     
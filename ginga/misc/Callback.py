@@ -38,6 +38,16 @@ class Callbacks(object):
             raise CallbackError("No callback category of '%s'" % (
                 name))
 
+    def remove_callback(self, name, fn):
+        """Remove function `fn` from the callbacks for `name`, leaving
+        any others registered for it.
+        """
+        try:
+            self.cb[name] = filter(lambda tup: tup[0] != fn, self.cb[name])
+        except KeyError:
+            raise CallbackError("No callback category of '%s'" % (
+                name))
+
     # TODO: to be deprecated ?
     def set_callback(self, name, fn, *args, **kwdargs):
         if not self.has_callback(name):
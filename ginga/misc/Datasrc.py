@@ -6,61 +6,221 @@
 # Please see the file LICENSE.txt for details.
 #
 import threading
+import itertools
+import bisect
+from collections import OrderedDict
 
 class TimeoutError(Exception):
     pass
 
+# global use counter, so that least recently used items can be compared
+# between data sources
+_use_count = itertools.count()
+
 class Datasrc(object):
+    """A keyed store of data items (e.g. images).
+
+    At most `length` items are held; beyond that the oldest added items
+    are dropped.  If `maxsize` is given, the items are also limited to a
+    total size (as reported by `sizefn`, e.g. in bytes).  Items ejected
+    to meet the size limit are replaced by the return value of `spillfn`
+    (a lightweight stub from which the item can be reloaded), or dropped
+    if there is no `spillfn`.  If `spillfn` returns None the item can't
+    be reloaded, and it is kept.  The most recently added and most
+    recently used items, and any items for which `keepfn(key, item)`
+    returns True (e.g. items in use elsewhere), are never ejected to meet
+    the size limit.
 
-    def __init__(self, length=20):
+    A `MemoryBudget` may be shared by several data sources to enforce a
+    limit on their combined size.
+    """
+
+    def __init__(self, length=20, maxsize=None, sizefn=None, spillfn=None,
+                 keepfn=None, budget=None):
         self.length = length
+        self.maxsize = maxsize
+        self.sizefn = sizefn
+        self.spillfn = spillfn
+        self.keepfn = keepfn
         self.cursor = -1
         self.datums = {}
         self.history = []
         self.sortedkeys = []
+        # resident (not spilled) items, least recently used first
+        self.lru = OrderedDict()
+        self.sizes = {}
+        self.spilled = set([])
+        # resident items that spillfn could not make a stub for
+        self.unspillable = set([])
+        self.cursize = 0
         self.cond = threading.Condition()
         self.newdata = threading.Event()
 
+        self.budget = budget
+        if budget != None:
+            budget.add_datasrc(self)
+
 
     def __getitem__(self, key):
         with self.cond:
             if isinstance(key, int):
-                return self.datums[self.sortedkeys[key]]
-            else:
-                return self.datums[key]
+                key = self.sortedkeys[key]
+            value = self.datums[key]
+            if key in self.lru:
+                self._touch(key)
+            return value
+
 
-        
     def __setitem__(self, key, value):
         with self.cond:
             if key in self.history:
                 self.history.remove(key)
+                self._forget(key)
+            else:
+                bisect.insort(self.sortedkeys, key)
 
             self.history.append(key)
 
-            self.datums[key] = value
+            self._store(key, value)
             self._eject_old()
-            
+
             self.newdata.set()
             self.cond.notify()
-        
+
+        # NOTE: done outside our lock, because the budget will lock
+        # every data source sharing it in turn
+        if self.budget != None:
+            self.budget.enforce()
+
 
     def __len__(self):
         with self.cond:
             return len(self.sortedkeys)
 
 
+    def restore(self, key, value):
+        """Replace the stub of spilled item `key` with `value` (the item
+        reloaded), without changing its place in the history.
+        """
+        with self.cond:
+            if not key in self.spilled:
+                raise KeyError("%s is not spilled" % (str(key)))
+            self._forget(key)
+            self._store(key, value)
+            self._eject_old()
+
+        if self.budget != None:
+            self.budget.enforce()
+
+    def _store(self, key, value):
+        # store a resident item, as the most recently used
+        self.datums[key] = value
+        size = 0
+        if self.sizefn != None:
+            size = self.sizefn(value)
+        self.sizes[key] = size
+        self.cursize += size
+        self._touch(key)
+
+    def _touch(self, key):
+        # mark item as most recently used
+        self.lru.pop(key, None)
+        self.lru[key] = next(_use_count)
+
+    def _forget(self, key):
+        # remove item from the resident or spilled accounting
+        if key in self.lru:
+            del self.lru[key]
+            self.cursize -= self.sizes.pop(key)
+            self.unspillable.discard(key)
+        else:
+            self.spilled.discard(key)
+
+    def _remove(self, key):
+        self._forget(key)
+        del self.datums[key]
+        i = bisect.bisect_left(self.sortedkeys, key)
+        del self.sortedkeys[i]
+
+    def _spill(self, key):
+        # Returns True if the item was spilled (or dropped)
+        if self.spillfn == None:
+            self.history.remove(key)
+            self._remove(key)
+            return True
+
+        stub = self.spillfn(key, self.datums[key])
+        if stub == None:
+            # can't be reloaded--keep it
+            self.unspillable.add(key)
+            return False
+
+        self._forget(key)
+        self.datums[key] = stub
+        self.spilled.add(key)
+        return True
+
+    def _get_spillable(self):
+        # Returns the key of the least recently used item that may be
+        # spilled, or None.  The most recently used item is kept.
+        for key in list(self.lru.keys())[:-1]:
+            if (key == self.history[-1]) or (key in self.unspillable):
+                continue
+            if (self.keepfn != None) and self.keepfn(key, self.datums[key]):
+                continue
+            return key
+        return None
+
     def _eject_old(self):
         while len(self.history) > self.length:
             oldest = self.history.pop(0)
-            del self.datums[oldest]
+            self._remove(oldest)
+
+        if self.maxsize != None:
+            while (self.cursize > self.maxsize) and (len(self.lru) > 1):
+                if not self.spill_lru():
+                    break
 
-        self.sortedkeys = list(self.datums.keys())
-        self.sortedkeys.sort()
+    def spill_lru(self):
+        """Spill the least recently used resident item that may be
+        spilled (see the class description).  Returns True if an item
+        was spilled.
+        """
+        with self.cond:
+            while True:
+                key = self._get_spillable()
+                if key == None:
+                    return False
+                if self._spill(key):
+                    return True
 
+    def lru_stamp(self):
+        """Returns the use count of the least recently used resident
+        item that may be spilled, or None if there is no such item.
+        """
+        with self.cond:
+            key = self._get_spillable()
+            if key == None:
+                return None
+            return self.lru[key]
+
+    def is_spilled(self, key):
+        with self.cond:
+            if isinstance(key, int):
+                key = self.sortedkeys[key]
+            return key in self.spilled
+
+    def remove(self, key):
+        with self.cond:
+            self.history.remove(key)
+            self._remove(key)
 
     def index(self, key):
         with self.cond:
-            return self.sortedkeys.index(key)
+            i = bisect.bisect_left(self.sortedkeys, key)
+            if (i == len(self.sortedkeys)) or (self.sortedkeys[i] != key):
+                raise ValueError("%s is not in list" % (str(key)))
+            return i
 
     def index2key(self, index):
         with self.cond:
@@ -68,10 +228,10 @@ class Datasrc(object):
 
     def youngest(self):
         return self.datums[self.history[-1]]
-    
+
     def oldest(self):
         return self.datums[self.history[0]]
-    
+
     def keys(self, sort='alpha'):
         with self.cond:
             if sort == 'alpha':
@@ -84,7 +244,7 @@ class Datasrc(object):
     def has_key(self, key):
         with self.cond:
             return self.datums.has_key(key)
-        
+
     def wait(self, timeout=None):
         with self.cond:
             self.cond.wait(timeout=timeout)
@@ -99,12 +259,78 @@ class Datasrc(object):
     def get_bufsize(self):
         with self.cond:
             return self.length
-       
-        
+
+
     def set_bufsize(self, length):
         with self.cond:
             self.length = length
             self._eject_old()
 
-        
+    def get_size(self):
+        with self.cond:
+            return self.cursize
+
+    def get_maxsize(self):
+        return self.maxsize
+
+    def set_maxsize(self, maxsize):
+        with self.cond:
+            self.maxsize = maxsize
+            self._eject_old()
+
+
+class MemoryBudget(object):
+    """Enforces a limit on the combined size of several data sources.
+    When the limit is exceeded, the least recently used items across
+    all of the sources are spilled until the total fits again, or no
+    more items may be spilled (see Datasrc).
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.datasrcs = []
+        self.lock = threading.RLock()
+
+    def add_datasrc(self, datasrc):
+        with self.lock:
+            self.datasrcs.append(datasrc)
+
+    def remove_datasrc(self, datasrc):
+        with self.lock:
+            self.datasrcs.remove(datasrc)
+
+    def get_size(self):
+        with self.lock:
+            return sum(map(lambda src: src.get_size(), self.datasrcs))
+
+    def enforce(self):
+        with self.lock:
+            if self.maxsize == None:
+                return
+            cursize = self.get_size()
+            while cursize > self.maxsize:
+                # find the source holding the least recently used item
+                victim, oldest = None, None
+                for datasrc in self.datasrcs:
+                    stamp = datasrc.lru_stamp()
+                    if (stamp != None) and ((oldest == None) or
+                                            (stamp < oldest)):
+                        victim, oldest = datasrc, stamp
+                if victim == None:
+                    # nothing left that can be spilled
+                    break
+                size = victim.get_size()
+                if not victim.spill_lru():
+                    break
+                cursize -= size - victim.get_size()
+
+    def get_maxsize(self):
+        return self.maxsize
+
+    def set_maxsize(self, maxsize):
+        with self.lock:
+            self.maxsize = maxsize
+            self.enforce()
+
+
 #END
@@ -0,0 +1,115 @@
+#
+# LRUCache.py -- a size-bounded, least-recently-used cache
+#
+# Eric Jeschke (eric@naoj.org)
+#
+# Copyright (c) Eric R. Jeschke.  All rights reserved.
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+import threading
+from collections import OrderedDict
+
+
+def _nbytes(value):
+    # default size function: works for numpy arrays
+    return value.nbytes
+
+
+class LRUCache(object):
+    """A thread-safe cache that holds items up to a maximum total size.
+    When the size is exceeded, the least recently used items are ejected
+    until the cache fits again.
+
+    `sizefn` is called with an item to obtain its size; by default it
+    returns the `nbytes` attribute of the item (i.e. numpy arrays).
+    """
+
+    def __init__(self, maxsize, sizefn=None):
+        self.maxsize = maxsize
+        if sizefn == None:
+            sizefn = _nbytes
+        self.sizefn = sizefn
+        self.cursize = 0
+        self.datums = OrderedDict()
+        self.lock = threading.RLock()
+
+    def __getitem__(self, key):
+        with self.lock:
+            # move item to the most recently used end
+            size, value = self.datums.pop(key)
+            self.datums[key] = (size, value)
+            return value
+
+    def get(self, key, *args):
+        try:
+            return self[key]
+        except KeyError:
+            # return a default if there is one
+            if len(args) > 0:
+                return args[0]
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        size = self.sizefn(value)
+        with self.lock:
+            if key in self.datums:
+                self._remove(key)
+            self.datums[key] = (size, value)
+            self.cursize += size
+            self._eject_old()
+
+    def __delitem__(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.datums
+
+    def __len__(self):
+        with self.lock:
+            return len(self.datums)
+
+    def has_key(self, key):
+        return key in self
+
+    def keys(self):
+        """Returns the keys, ordered from least to most recently used."""
+        with self.lock:
+            return list(self.datums.keys())
+
+    def _remove(self, key):
+        size, value = self.datums.pop(key)
+        self.cursize -= size
+        return value
+
+    def _eject_old(self):
+        while (self.cursize > self.maxsize) and (len(self.datums) > 0):
+            key = next(iter(self.datums))
+            self._remove(key)
+
+    def remove_if(self, pred_fn):
+        """Remove all items whose key satisfies `pred_fn`."""
+        with self.lock:
+            for key in [key for key in self.datums.keys() if pred_fn(key)]:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.datums.clear()
+            self.cursize = 0
+
+    def get_size(self):
+        with self.lock:
+            return self.cursize
+
+    def get_maxsize(self):
+        return self.maxsize
+
+    def set_maxsize(self, maxsize):
+        with self.lock:
+            self.maxsize = maxsize
+            self._eject_old()
+
+#END
@@ -7,10 +7,13 @@
 # This is open-source software licensed under a BSD license.
 # Please see the file LICENSE.txt for details.
 #
+import math
+
 from ginga.misc import Bunch, Future
 from ginga import GingaPlugin
 from ginga import cmap, imap
 from ginga import wcs
+from ginga.util import catalog
 
 
 class CatalogsBase(GingaPlugin.LocalPlugin):
@@ -27,9 +30,19 @@ class CatalogsBase(GingaPlugin.LocalPlugin):
         self.plot_max = 500
         self.plot_limit = 100
         self.plot_start = 0
+        # only plot the stars within the visible part of the image
+        self.cull_to_view = True
+        # radius of plotted stars, in data pixels
+        self.star_radius = 10
+        # delay (sec) before replotting the stars after the view changes
+        self.replot_lag = 0.25
 
         # star list
         self.starlist = []
+        # spatial index of the star list
+        self.star_index = None
+        # stars that have plot objects
+        self.plotted = []
         # catalog listing
         self.table = None
         
@@ -41,6 +54,14 @@ class CatalogsBase(GingaPlugin.LocalPlugin):
         self.settings = prefs.createCategory('plugin_Catalogs')
         self.settings.load(onError='silent')
 
+        # other catalog servers to query along with the selected one;
+        # their results are merged, dropping stars found by more than
+        # one server
+        self.fanout_servers = self.settings.get('fanout_servers', [])
+        self.fanout_timeout = self.settings.get('fanout_timeout', 30.0)
+        self.merge_radius_arcsec = self.settings.get('merge_radius_arcsec',
+                                                     1.0)
+
         self.image_server_options = []
         self.image_server_params = None
 
@@ -58,6 +79,10 @@ class CatalogsBase(GingaPlugin.LocalPlugin):
         canvas.setSurface(self.fitsimage)
         self.canvas = canvas
 
+        # for replotting the visible stars when the image is panned or
+        # zoomed, once the view has settled
+        self.replot_task = fv.get_timer()
+        self.replot_task.set_callback('expired', self.replot_timer_cb)
 
     def ok(self):
         return self.close()
@@ -86,6 +111,11 @@ class CatalogsBase(GingaPlugin.LocalPlugin):
         # Raise the params tab
         self._raise_tab(self.w.params)
 
+        # replot the visible stars when the image is panned or zoomed
+        t_ = self.fitsimage.get_settings()
+        for name in ['pan', 'scale']:
+            t_.getSetting(name).add_callback('set', self.view_changed_cb)
+
         self.setfromimage()
         self.resume()
 
@@ -97,6 +127,11 @@ class CatalogsBase(GingaPlugin.LocalPlugin):
         #self.fv.showStatus("Draw a rectangle with the right mouse button")
         
     def stop(self):
+        t_ = self.fitsimage.get_settings()
+        for name in ['pan', 'scale']:
+            t_.getSetting(name).remove_callback('set', self.view_changed_cb)
+        self.replot_task.clear()
+
         # stop catalog operation
         self.clearAll()
         # remove the canvas from the image
@@ -109,6 +144,7 @@ class CatalogsBase(GingaPlugin.LocalPlugin):
             self.table.close()
         except:
             pass
+        self.star_index = None
         self.fv.showStatus("")
         
     def redo(self):
@@ -166,7 +202,16 @@ class CatalogsBase(GingaPlugin.LocalPlugin):
         return True
 
     def btnup(self, canvas, button, data_x, data_y):
-        
+
+        index = self.get_star_index()
+        if index != None:
+            # pick the nearest plotted star
+            for star in index.near(data_x, data_y, self.star_radius):
+                if getattr(star, 'canvobj', None) != None:
+                    self.table.show_selection(star)
+                    return True
+            return True
+
         objs = self.canvas.getItemsAt(data_x, data_y)
         for obj in objs:
             if (obj.tag != None) and obj.tag.startswith('star'):
@@ -307,14 +352,32 @@ class CatalogsBase(GingaPlugin.LocalPlugin):
         self.fv.nongui_do(self.getcatalog, server, params, obj)
 
     def getcatalog(self, server, params, obj):
+        keys = [server] + [key for key in self.fanout_servers
+                           if key != server]
         try:
+            if len(keys) > 1:
+                # query all the servers at once, and show the merged
+                # results as they arrive
+                def update_cb(key, starlist, info):
+                    self.show_catalog(starlist, info, obj)
+
+                starlist, info, errors = self.fv.get_catalogs(
+                    keys, params, timeout=self.fanout_timeout,
+                    merge_radius_arcsec=self.merge_radius_arcsec,
+                    cb_fn=update_cb)
+
+                if len(errors) > 0:
+                    errmsg = "Query exception: %s" % ('; '.join(
+                        ["%s: %s" % (key, str(errors[key]))
+                         for key in keys if key in errors]))
+                    self.logger.error(errmsg)
+                    self.fv.gui_do(self.fv.show_error, errmsg)
+                return
+
             starlist, info = self.fv.get_catalog(server, params)
             self.logger.debug("starlist=%s" % str(starlist))
 
-            starlist = self.filter_results(starlist, obj)
-
-            # Update the GUI
-            self.fv.gui_do(self.update_catalog, starlist, info)
+            self.show_catalog(starlist, info, obj)
         
         except Exception as e:
             errmsg = "Query exception: %s" % (str(e))
@@ -322,8 +385,22 @@ class CatalogsBase(GingaPlugin.LocalPlugin):
             # pop up the error in the GUI under "Errors" tab
             self.fv.gui_do(self.fv.show_error, errmsg)
             
-    def update_catalog(self, starlist, info):
+    def show_catalog(self, starlist, info, filter_obj):
+        starlist = self.filter_results(starlist, filter_obj)
+
+        # index the stars here, off the gui thread
+        image = self.fitsimage.get_image()
+        index = catalog.StarIndex(starlist, image=image)
+
+        # Update the GUI
+        self.fv.gui_do(self.update_catalog, starlist, info, index)
+
+    def update_catalog(self, starlist, info, index=None):
         self.starlist = starlist
+        if index == None:
+            index = catalog.StarIndex(starlist)
+        self.star_index = index
+        self.plotted = []
         self.table.show_table(self, info, starlist)
 
         # Raise the listing tab
@@ -336,15 +413,51 @@ class CatalogsBase(GingaPlugin.LocalPlugin):
 
         # Filter starts by a containing object, if provided
         if filter_obj:
-            stars = []
-            for star in starlist:
-                x, y = image.radectopix(star['ra_deg'], star['dec_deg'])
-                if filter_obj.contains(x, y):
-                    stars.append(star)
-            starlist = stars
+            index = catalog.StarIndex(starlist, image=image)
+            keep = [i for i in xrange(len(starlist))
+                    if filter_obj.contains(index.xs[i], index.ys[i])]
+            if isinstance(starlist, catalog.StarTable):
+                starlist = starlist.take(keep)
+            else:
+                starlist = [starlist[i] for i in keep]
 
         return starlist
 
+    def get_star_index(self, image=None):
+        """Returns the spatial index of the star list, with the pixel
+        positions calculated for `image` (default: the current image).
+        """
+        index = self.star_index
+        if index == None:
+            return None
+        if image == None:
+            image = self.fitsimage.get_image()
+        if (image != None) and (index.image != image):
+            index.set_image(image)
+        return index
+
+    def get_view_bbox(self):
+        """Returns a bounding box (x1, y1, x2, y2) in data coordinates
+        that covers the visible part of the image at any rotation.
+        """
+        pan_x, pan_y = self.fitsimage.get_pan()
+        scale_x, scale_y = self.fitsimage.get_scale_xy()
+        wd, ht = self.fitsimage.get_window_size()
+        # half the window diagonal, plus room for the star markers
+        r = math.sqrt((wd / scale_x)**2 + (ht / scale_y)**2) / 2.0 + \
+            self.star_radius
+        return (pan_x - r, pan_y - r, pan_x + r, pan_y + r)
+
+    def view_changed_cb(self, setting, value):
+        if (not self.cull_to_view) or (self.star_index == None) or \
+               (self.table == None) or (len(self.starlist) == 0):
+            return
+        # Delay the replot until the panning or zooming has stopped
+        self.replot_task.set(self.replot_lag)
+
+    def replot_timer_cb(self, timer):
+        self.fv.gui_do(self.replot_stars)
+
     def clear(self):
         objects = self.canvas.getObjectsByTagpfx('star')
         self.canvas.deleteObjects(objects)
@@ -354,6 +467,7 @@ class CatalogsBase(GingaPlugin.LocalPlugin):
        
     def reset(self):
         self.clear()
+        self.star_index = None
         #self.clearAll()
         self.table.clear()
        
@@ -361,10 +475,15 @@ class CatalogsBase(GingaPlugin.LocalPlugin):
 
         if not image:
             image = self.fitsimage.get_image()
-        x, y = image.radectopix(obj['ra_deg'], obj['dec_deg'])
+        pos = None
+        if (self.star_index != None) and (self.star_index.image == image):
+            pos = self.star_index.get_xy(obj)
+        if pos == None:
+            pos = image.radectopix(obj['ra_deg'], obj['dec_deg'])
+        x, y = pos
         #print "STAR at %d,%d" % (x, y)
         # TODO: auto-pick a decent radius
-        radius = 10
+        radius = self.star_radius
         color = self.table.get_color(obj)
         #print "color is %s" % str(color)
 
@@ -386,6 +505,7 @@ class CatalogsBase(GingaPlugin.LocalPlugin):
 
         star.set_data(star=obj)
         obj.canvobj = star
+        self.plotted.append(obj)
 
         self.canvas.add(star, tagpfx='star', redraw=False)
 
@@ -417,12 +537,19 @@ class CatalogsBase(GingaPlugin.LocalPlugin):
         self.table.set_minmax(i, length)
 
         # remove references to old plot objects from starlist
-        for j in xrange(len(self.starlist)):
-            obj = self.starlist[j]
+        for obj in self.plotted:
             obj.canvobj = None
+        self.plotted = []
 
         # plot stars in range
         subset = self.table.get_subset_from_starlist(i, i+length)
+        index = self.get_star_index(image)
+        if self.cull_to_view and (index != None):
+            # skip the stars outside the visible part of the image
+            x1, y1, x2, y2 = self.get_view_bbox()
+            visible = set(index.in_box(x1, y1, x2, y2).tolist())
+            subset = filter(lambda obj: index.get_number(obj) in visible,
+                            subset)
         for obj in subset:
             self.plot_star(obj, image=image)
 
@@ -18,10 +18,11 @@ import SocketServer
 import logging
 import time
 import struct
-import array
 import re
 import string
 
+import numpy
+
 from ginga.misc import Bunch
 
 # internal globals
@@ -232,6 +233,9 @@ Where   nbytes | NB  = number of bytes expected or written
                        following the header packet.
     """     
     needs_update = False
+    # unbuffered reads, so that frame data can be read straight from the
+    # socket (see read_into())
+    rbufsize = 0
     # these NEED to be set automatically
     # from the client interaction
     width = None
@@ -499,7 +503,7 @@ Where   nbytes | NB  = number of bytes expected or written
                     text = wcs + mapping
                     text = right_pad(text, SZ_WCSBUF)
                 else:
-                    if (frame < 0) or (fb == None) or (fb.buffer == None) or \
+                    if (frame < 0) or (fb == None) or (fb.buffer is None) or \
                         (len(fb.buffer) == 0):
                         text = "[NOSUCHFRAME]"
                     else:
@@ -553,6 +557,8 @@ Where   nbytes | NB  = number of bytes expected or written
             fb.ct.imtitle = ''
             fb.ct.valid = 0
             fb.ct = self.wcs_update(line, fb)
+            # a new image is coming--it must be displayed in full
+            fb.image = None
         # end of handle_wcs()
     
     def handle_memory(self, pkt):
@@ -586,9 +592,9 @@ Where   nbytes | NB  = number of bytes expected or written
                         len(data), pkt.nbytes))
             #data.reverse()
             #self.logger.debug("DATA=%s" % str(data))
-            buf = data.tostring()
-            pkt.dataout.write(buf)
+            # send straight from the frame buffer
             pkt.dataout.flush()
+            self.request.sendall(data)
             self.logger.debug("end memory read")
 
         else:
@@ -598,27 +604,44 @@ Where   nbytes | NB  = number of bytes expected or written
             self.logger.debug("data bytes=%d needs_update=%s" % (
                 pkt.nbytes, self.needs_update))
             if (fb.width != None) and (fb.height != None):
-                if not self.needs_update:
-                    #del fb.buffer
-                    #fb.buffer = array.array('B', ' ' * fb.width * fb.height)
-                    if len(fb.buffer) != fb.width * fb.height:
-                        fb.buffer = array.array('B', '\000' * fb.width * fb.height)
-                        #self.needs_update = True
+                size = fb.width * fb.height
+                if (fb.buffer is None) or (len(fb.buffer) != size):
+                    fb.buffer = numpy.zeros(size, dtype=numpy.uint8)
+                    fb.shared = False
+                    # new buffer--the frame must be displayed in full
+                    fb.image = None
+                    fb.dirty = None
+                    #self.needs_update = True
+                elif fb.shared or (not fb.buffer.flags.c_contiguous):
+                    # buffer is in use by a displayed image--copy on write
+                    fb.buffer = fb.buffer.copy()
+                    fb.shared = False
                 start = self.x + self.y * fb.width
-                end = start + pkt.nbytes
-                fb.buffer[start:end] = array.array('B', pkt.datain.read(pkt.nbytes))
+                end = min(start + pkt.nbytes, size)
+                # read the data straight into the frame buffer
+                t_bytes = self.read_into(fb.buffer[start:end])
+                if t_bytes < pkt.nbytes:
+                    self.discard(pkt.nbytes - t_bytes)
+                if t_bytes > 0:
+                    # record the rows that have been written
+                    y1 = start // fb.width
+                    y2 = (start + t_bytes - 1) // fb.width + 1
+                    if fb.dirty != None:
+                        y1, y2 = min(y1, fb.dirty[0]), max(y2, fb.dirty[1])
+                    fb.dirty = (y1, y2)
             else:
                 self.logger.warn("uninitialized framebuffer frame=%d" % (
                         self.frame))
-                if not self.needs_update:
+                data = numpy.empty(pkt.nbytes, dtype=numpy.uint8)
+                self.read_into(data)
+                if (not self.needs_update) or (fb.buffer is None) or \
+                       fb.shared:
                     # init the framebuffer
-                    fb.buffer.fromstring(pkt.datain.read(pkt.nbytes))
-                    fb.buffer.reverse()
+                    fb.buffer = data[::-1].copy()
+                    fb.shared = False
                     #self.needs_update = True
                 else:
-                    data = array.array('B', pkt.datain.read(pkt.nbytes))
-                    data.reverse()
-                    fb.buffer += data
+                    fb.buffer = numpy.concatenate((fb.buffer, data[::-1]))
             
             self.needs_update = True
             self.logger.debug("end memory write")
@@ -639,6 +662,29 @@ Where   nbytes | NB  = number of bytes expected or written
             #         fbconfigs[fb.config][1] = width
 
     
+    def read_into(self, buf):
+        """Read data from the client straight into `buf` (a contiguous
+        numpy uint8 array), until it is full or the client stops sending.
+        Returns the number of bytes read.
+        """
+        view = memoryview(buf)
+        nbytes = len(view)
+        t_bytes = 0
+        while t_bytes < nbytes:
+            n = self.request.recv_into(view[t_bytes:], nbytes - t_bytes)
+            if n == 0:
+                break
+            t_bytes += n
+        return t_bytes
+
+    def discard(self, nbytes):
+        """Read and throw away `nbytes` bytes from the client."""
+        while nbytes > 0:
+            m = self.rfile.read(min(nbytes, SZ_FIFOBUF))
+            if len(m) == 0:
+                break
+            nbytes -= len(m)
+
     def handle_imcursor(self, pkt):
         """This part of the protocol is used by IRAF to read the cursor
         position and keystrokes from the display client.
@@ -793,17 +839,7 @@ Where   nbytes | NB  = number of bytes expected or written
             
             if not (packet.tid & IIS_READ):
                 # OK, discard the rest of the data
-                nbytes = packet.nbytes
-                while nbytes > 0:
-                    # for (nbytes = ndatabytes;  nbytes > 0;  nbytes -= n):
-                    if nbytes < SZ_FIFOBUF:
-                        n = nbytes
-                    else:
-                        n = SZ_FIFOBUF
-                    m = self.rfile.read(n)
-                    if m <= 0:
-                        break
-                    nbytes -= n
+                self.discard(packet.nbytes)
             
             # read the next packet
             line = packet.datain.read(size)
@@ -956,9 +992,12 @@ class framebuffer(object):
         self.config = None          # framebuffer config index
                                     # (see fbconfigs dictionary)
         self.wcs = None             # WCS
-        self.image = None           # the image data itself
+        self.image = None           # the image displayed from the buffer
         self.bitmap = None          # the image bitmap
-        self.buffer = None          # used for screen updates
+        self.buffer = None          # used for screen updates (numpy uint8)
+        self.shared = False         # buffer is in use by a displayed image
+        self.dirty = None           # (y1, y2) range of buffer rows written
+                                    # since the frame was last displayed
         self.zoom = 1.0             # zoom level
         self.ct = coord_tran()
         self.chname = None
@@ -42,7 +42,6 @@ import logging
 import threading
 import socket
 import Queue
-import array
 import numpy
 import time
 
@@ -194,7 +193,8 @@ class IRAFBase(GingaPlugin.GlobalPlugin):
 
         # this is just a placeholder so that IIS_RequestHandler will
         # report something in this buffer
-        fb.buffer = array.array('B', ' ')
+        fb.buffer = numpy.zeros(1, dtype=numpy.uint8)
+        fb.shared = False
 
         # Update IRAF "wcs" info so that IRAF can load this image
 
@@ -268,7 +268,9 @@ class IRAFBase(GingaPlugin.GlobalPlugin):
         fb.image = None
         fb.bitmap = None
         fb.zoom = 1.0
-        fb.buffer = array.array('B')
+        fb.buffer = numpy.zeros(0, dtype=numpy.uint8)
+        fb.shared = False
+        fb.dirty = None
         fb.ct = iis.coord_tran()
         #fb.chname = None
         return fb
@@ -294,8 +296,24 @@ class IRAFBase(GingaPlugin.GlobalPlugin):
         fb = self.get_frame(frame)
         self.current_frame = frame
         
+        image = fb.image
+        if ((not reverse) and (fb.dirty != None) and (image != None) and
+            (image.get_size() == (width, height))):
+            # only some rows have been written since the frame was
+            # displayed--update the displayed image in place
+            y1, y2 = fb.dirty
+            fb.dirty = None
+            data = fb.buffer.reshape((height, width))[y1:y2]
+            # Image comes in from IRAF flipped for screen display
+            data = numpy.flipud(data).copy()
+            self.fv.gui_do(self._gui_update_image, image,
+                           height - y2, height - y1, data)
+            return
+
+        fb.dirty = None
+        data = fb.buffer
         if reverse:
-            fb.buffer.reverse()
+            data = data[::-1]
 
         # frames are indexed from 1 in IRAF
         chname = fb.chname
@@ -306,20 +324,21 @@ class IRAFBase(GingaPlugin.GlobalPlugin):
         self.logger.debug("display to %s" %(chname))
 
         try:
-            data = fb.buffer
             byteswap = False
             dims = (fb.height, fb.width)
-            dtype = numpy.uint8
             metadata = {}
 
             image = IRAF_AstroImage(logger=self.logger)
             #image.load_buffer(fb.buffer, dims, dtype, byteswap=byteswap,
             #                  metadata=metadata)
-            data = numpy.fromstring(fb.buffer, dtype=dtype)
             data = data.reshape(dims)
-            # Image comes in from IRAF flipped for screen display
+            # Image comes in from IRAF flipped for screen display.
+            # NOTE: the image shares the frame buffer memory; the IIS
+            # server copies the buffer before writing to it again
             data = numpy.flipud(data)
+            fb.shared = True
             image.set_data(data, metadata=metadata)
+            fb.image = image
             # Save coordinate transform info
             image.set(ct=fb.ct)
 
@@ -371,6 +390,10 @@ class IRAFBase(GingaPlugin.GlobalPlugin):
         # Enqueue image to display datasrc
         self.fv.add_image(fitsname, image, chname=chname)
         self.fv.ds.raise_tab('IRAF')
+
+    def _gui_update_image(self, image, y1, y2, data):
+        wd, ht = image.get_size()
+        image.update_region(0, y1, wd, y2, data_np=data)
         
     def get_cursor(self):
         self.logger.info("get_cursor() called")
@@ -0,0 +1,133 @@
+#
+# LiveMosaic.py -- Live mosaicing plugin for Ginga fits viewer
+#
+# Eric Jeschke (eric@naoj.org)
+#
+# Copyright (c)  Eric R. Jeschke.  All rights reserved.
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+The LiveMosaic plugin builds a mosaic of the images as they arrive in
+the viewer, so that e.g. a night of survey images can be watched as
+they are assembled.
+
+Each image added to one of the source channels is reprojected onto the
+mosaic in a worker thread and blended into it.  The mosaic is shown in
+its own channel ('Mosaic' by default), where only the part of it that
+changed is redrawn as each image is added.
+
+Preferences (in the 'plugin_LiveMosaic' category):
+  mosaic_channel: name of the channel showing the mosaic
+  source_channels: names of the channels to mosaic images from (all
+      channels, if empty)
+  chunk_size: the mosaic grows in blocks of this many pixels on a side
+  method: resampling method ('bilinear' or 'nearest')
+  grid_step: pixel spacing of the exact WCS calculations
+"""
+import Queue
+
+from ginga import GingaPlugin
+from ginga.util import mosaic
+
+
+class LiveMosaic(GingaPlugin.GlobalPlugin):
+
+    def __init__(self, fv):
+        # superclass defines some variables for us, like logger
+        super(LiveMosaic, self).__init__(fv)
+
+        prefs = self.fv.get_preferences()
+        self.settings = prefs.createCategory('plugin_LiveMosaic')
+        self.settings.load(onError='silent')
+        self.chname = self.settings.get('mosaic_channel', 'Mosaic')
+        self.src_chnames = self.settings.get('source_channels', [])
+
+        self.mosaic = mosaic.LiveMosaic(
+            self.logger, name='mosaic',
+            chunk_size=self.settings.get('chunk_size', 1024),
+            method=self.settings.get('method', 'bilinear'),
+            grid_step=self.settings.get('grid_step', 16))
+
+        self.queue = Queue.Queue()
+        self.active = False
+        self.ev_quit = fv.ev_quit
+
+        fv.add_callback('add-image', self.add_image_cb)
+
+    # NO GUI...yet
+    #def build_gui(self, container):
+    #    pass
+
+    def start(self):
+        self.active = True
+        self.fv.nongui_do(self.mosaic_loop)
+
+    def stop(self):
+        self.active = False
+        # wake up the worker, so that it sees we have stopped
+        self.queue.put(None)
+
+    def reset(self):
+        """Start a new mosaic with the next image that arrives."""
+        self.mosaic.reset()
+
+    def add_image_cb(self, viewer, chname, image):
+        if (not self.active) or (chname == self.chname):
+            return
+        if (len(self.src_chnames) > 0) and (chname not in self.src_chnames):
+            return
+        self.queue.put(image)
+
+    def mosaic_loop(self):
+        # reprojects the images queued by add_image_cb()
+        # NOTE: this runs in a worker thread
+        while self.active and not self.ev_quit.isSet():
+            try:
+                image = self.queue.get(block=True, timeout=0.5)
+            except Queue.Empty:
+                continue
+            if image == None:
+                continue
+
+            name = image.get('name', 'NoName')
+            try:
+                res = self.mosaic.reproject(image)
+            except Exception, e:
+                self.logger.error("Failed to reproject image '%s': %s" % (
+                    name, str(e)))
+                continue
+
+            self.fv.gui_do(self.update_mosaic, res)
+
+    def update_mosaic(self, res):
+        # adds a reprojected image to the mosaic
+        # NOTE: this runs in the gui thread
+        try:
+            is_new = (self.mosaic.get_image() == None)
+            info = self.mosaic.blend(res)
+        except Exception, e:
+            self.logger.error("Failed to add image '%s' to mosaic: %s" % (
+                res.name, str(e)))
+            return
+
+        image = self.mosaic.get_image()
+        if is_new:
+            self.fv.add_image(image.get('name'), image, chname=self.chname)
+
+        elif info.grown:
+            # keep the view on the same part of the sky
+            chinfo = self.fv.get_channelInfo(self.chname)
+            fitsimage = chinfo.fitsimage
+            if fitsimage.get_image() == image:
+                dx, dy = info.shift
+                pan_x, pan_y = fitsimage.get_pan()
+                fitsimage.set_pan(pan_x + dx, pan_y + dy)
+
+        self.logger.debug("added image '%s' to mosaic (%d images)" % (
+            res.name, self.mosaic.count))
+
+    def __str__(self):
+        return 'livemosaic'
+
+#END
@@ -12,6 +12,7 @@ from ginga.misc import Bunch
 from ginga.util import iqcalc
 
 import threading
+import multiprocessing
 import numpy
 
 region_default_width = 30
@@ -53,6 +54,11 @@ class PickBase(GingaPlugin.LocalPlugin):
         self.min_ellipse = 0.5
         self.edgew = 0.01
         self.show_candidates = False
+        # number of processes used to evaluate the peaks; if 1, they
+        # are evaluated in vectorized batches in this process, which is
+        # usually fastest
+        self.num_workers = 1
+        self.pool = None
         self.do_record = False
         self.last_report = None
 
@@ -242,7 +248,12 @@ class PickBase(GingaPlugin.LocalPlugin):
         except KeyError:
             # Add canvas layer
             self.fitsimage.add(self.canvas, tag=self.layertag)
-            
+
+        # NOTE: the pool is long-lived, because starting the processes
+        # costs more than the evaluation of a typical pick
+        if (self.num_workers > 1) and (self.pool == None):
+            self.pool = multiprocessing.Pool(self.num_workers)
+
         self.resume()
 
     def pause(self):
@@ -263,6 +274,11 @@ class PickBase(GingaPlugin.LocalPlugin):
             self.fitsimage.deleteObjectByTag(self.layertag)
         except:
             pass
+
+        if self.pool != None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
         self.fv.showStatus("")
         
     def redo(self):
@@ -360,10 +376,18 @@ class PickBase(GingaPlugin.LocalPlugin):
             msg, results, qs = None, None, None
             try:
                 self.update_status("Finding bright peaks...")
-                # Find bright peaks in the cutout
-                peaks = self.iqcalc.find_bright_peaks(data,
-                                                      threshold=self.threshold,
-                                                      radius=self.radius)
+                # Find bright peaks in the cutout, reporting progress as
+                # each tile is scanned
+                peaks = []
+                for tile_peaks in self.iqcalc.iter_bright_peaks(data,
+                                                                threshold=self.threshold,
+                                                                radius=self.radius,
+                                                                pool=self.pool):
+                    if self.ev_intr.isSet():
+                        raise Exception("Peak finding interrupted!")
+                    peaks.extend(tile_peaks)
+                    self.update_status("Finding bright peaks... (%d found)" % (
+                        len(peaks)))
                 num_peaks = len(peaks)
                 if num_peaks == 0:
                     raise Exception("Cannot find bright peaks")
@@ -376,10 +400,16 @@ class PickBase(GingaPlugin.LocalPlugin):
                 # Evaluate those peaks
                 self.update_status("Evaluating %d bright peaks..." % (
                     num_peaks))
+                if self.pool == None:
+                    fwhm_method = 2
+                else:
+                    fwhm_method = 1
                 objlist = self.iqcalc.evaluate_peaks(peaks, data,
                                                      fwhm_radius=self.radius,
+                                                     fwhm_method=fwhm_method,
                                                      cb_fn=cb_fn,
-                                                     ev_intr=self.ev_intr)
+                                                     ev_intr=self.ev_intr,
+                                                     pool=self.pool)
 
                 num_candidates = len(objlist)
                 if num_candidates == 0:
@@ -54,6 +54,14 @@ Examples:
  Transform:
  $ grc channel FOO transform 1 0 1
 
+Image data can be pushed much faster than through load_buffer with the
+binary transport in ginga.util.bufstream, which the plugin serves on
+port 9001:
+
+ from ginga.util import bufstream
+ client = bufstream.BufStreamClient(host='localhost', port=9001)
+ client.load_array('frame1', 'FOO', data, header=header_dict)
+
  
 """
 import sys
@@ -65,6 +73,7 @@ import bz2
 from ginga import GingaPlugin
 from ginga import AstroImage
 from ginga import cmap
+from ginga.util import bufstream
 
 help_msg = sys.modules[__name__].__doc__
 
@@ -79,6 +88,8 @@ class RC(GingaPlugin.GlobalPlugin):
         self.port = 9000
         # If blank, listens on all interfaces
         self.host = ''
+        # What port to listen for binary image data (see bufstream)
+        self.stream_port = bufstream.default_port
 
         self.ev_quit = fv.ev_quit
 
@@ -92,11 +103,45 @@ class RC(GingaPlugin.GlobalPlugin):
         self.server = SimpleXMLRPCServer.SimpleXMLRPCServer((self.host,
                                                              self.port))
         self.server.register_instance(self.robj)
+
+        self.stream_server = bufstream.BufStreamServer(self.logger,
+                                                       self.load_array,
+                                                       host=self.host,
+                                                       port=self.stream_port)
+        self.stream_server.start()
+
         self.fv.nongui_do(self.monitor_shutdown)
         self.fv.nongui_do(self.server.serve_forever, poll_interval=0.1)
         
     def stop(self):
         self.server.shutdown()
+        self.stream_server.stop()
+
+    def load_array(self, data, hdr):
+        """Display an array received by the binary transport (see
+        ginga.util.bufstream).  `data` is wrapped in an image without
+        being copied.
+        NOTE: this is called from the thread serving the connection
+        """
+        imname = str(hdr.get('imname', None) or 'NONAME')
+        chname = hdr.get('chname', None)
+        if chname != None:
+            chname = str(chname)
+        try:
+            image = AstroImage.AstroImage(logger=self.logger)
+            image.set_data(data, metadata=hdr.get('metadata', None))
+            image.set(name=imname)
+            image.update_keywords(hdr.get('header', {}))
+
+        except Exception, e:
+            errmsg = "Error creating image data for '%s': %s" % (
+                imname, str(e))
+            self.logger.error(errmsg)
+            raise GingaPlugin.PluginError(errmsg)
+
+        # Enqueue image to display datasrc
+        self.fv.gui_do(self.fv.add_image, imname, image,
+                       chname=chname)
 
     def monitor_shutdown(self):
         # the thread running this method waits until the entire viewer
@@ -104,6 +149,7 @@ class RC(GingaPlugin.GlobalPlugin):
         # running in a different thread
         self.ev_quit.wait()
         self.server.shutdown()
+        self.stream_server.stop()
 
     def __str__(self):
         return 'rc'
@@ -207,7 +253,7 @@ class GingaWrapper(object):
 
             # Create image container
             image = AstroImage.AstroImage(logger=self.logger)
-            image.load_buffer(data, dims, dtype, byteswap=byteswap,
+            image.load_buffer(data, dims, dtype, byteswap=False,
                               metadata=metadata)
             image.set(name=imname)
             image.update_keywords(header)
@@ -215,12 +261,12 @@ class GingaWrapper(object):
         except Exception, e:
             # Some kind of error unpacking the data
             errmsg = "Error creating image data for '%s': %s" % (
-                fitsname, str(e))
+                imname, str(e))
             self.logger.error(errmsg)
             raise GingaPlugin.PluginError(errmsg)
 
         # Enqueue image to display datasrc
-        self.fv.gui_do(self.fv.add_image, fitsname, image,
+        self.fv.gui_do(self.fv.add_image, imname, image,
                             chname=chname)
         return 0
 
@@ -14,10 +14,14 @@ import threading
 
 from ginga import GingaPlugin
 from ginga.misc import Bunch
+from ginga.util import thumbfarm
 
 
 class ThumbsBase(GingaPlugin.GlobalPlugin):
 
+    # order of the color bands in the arrays passed to make_thumb_widget()
+    thumb_rgb_order = 'RGB'
+
     def __init__(self, fv):
         # superclass defines some variables for us, like logger
         super(ThumbsBase, self).__init__(fv)
@@ -43,6 +47,15 @@ class ThumbsBase(GingaPlugin.GlobalPlugin):
         self.thmbtask.set_callback('expired', self.redo_delay_timer)
         self.lagtime = 4.0
         self.thmblock = threading.RLock()
+        # thumbnails being rendered
+        self.thumbPending = set([])
+
+        # thumbnails are rendered in the background, off the gui thread
+        num_workers = self.settings.get('numThumbWorkers', 2)
+        self.thumb_farm = thumbfarm.ThumbFarm(self.logger,
+                                              num_workers=num_workers,
+                                              width=200, height=200,
+                                              rgb_order=self.thumb_rgb_order)
 
         self.keywords = ['OBJECT', 'FRAMEID', 'UT', 'DATE-OBS']
 
@@ -51,6 +64,12 @@ class ThumbsBase(GingaPlugin.GlobalPlugin):
         fv.set_callback('delete-channel', self.delete_channel)
         fv.add_callback('active-image', self.focus_cb)
 
+    def start(self):
+        self.thumb_farm.start()
+
+    def stop(self):
+        self.thumb_farm.stop()
+
     def add_image(self, viewer, chname, image):
         noname = 'Noname' + str(time.time())
         name = image.get('name', noname)
@@ -74,26 +93,73 @@ class ThumbsBase(GingaPlugin.GlobalPlugin):
         # in the same channel
         thumbkey = (chname.lower(), path)
         with self.thmblock:
-            if self.thumbDict.has_key(thumbkey) or nothumb:
+            if self.thumbDict.has_key(thumbkey) or \
+                   (thumbkey in self.thumbPending) or nothumb:
                 return
 
-        #data = image.get_data()
+        metadata = self.get_thumb_metadata(image)
+        thumbpath = self.get_thumbpath(path)
+
+        # Reflect transforms, colormap, etc.
+        attrs = thumbfarm.get_view_attrs(chinfo.fitsimage)
+        with self.thmblock:
+            self.thumbPending.add(thumbkey)
+        self.thumb_farm.add_job(image, attrs, self._thumb_ready,
+                                self._insert_thumb, thumbkey, thumbname,
+                                chname, name, path, thumbpath, metadata)
+
+    def get_thumb_metadata(self, image):
         # Get metadata for mouse-over tooltip
         header = image.get_header()
         metadata = {}
         for kwd in self.keywords:
             metadata[kwd] = header.get(kwd, 'N/A')
-
-        thumbpath = self.get_thumbpath(path)
-        
-        #self.thumb_generator.set_data(data)
+        return metadata
+
+    def _thumb_ready(self, rgbarr, method, *args, **kwdargs):
+        # NOTE: this is called from a thumbnail worker thread
+        self.fv.gui_do(method, rgbarr, *args, **kwdargs)
+
+    def _save_thumb(self, imgwin, thumbpath):
+        # Save a thumbnail for future browsing
+        try:
+            self.save_thumb_widget(imgwin, thumbpath)
+        except Exception, e:
+            self.logger.error("Error saving thumbnail '%s': %s" % (
+                thumbpath, str(e)))
+
+    def _insert_thumb(self, rgbarr, thumbkey, thumbname, chname, name,
+                      path, thumbpath, metadata, save_thumb=False):
         with self.thmblock:
-            self.thumb_generator.set_image(image)
-            self.copy_attrs(chinfo.fitsimage)
-            imgwin = self.thumb_generator.get_image_as_widget()
+            # thumbs may have been cleared while this one was rendered
+            if thumbkey not in self.thumbPending:
+                return
+            self.thumbPending.discard(thumbkey)
+            if self.thumbDict.has_key(thumbkey):
+                return
+
+        if rgbarr is None:
+            # thumbnail could not be rendered
+            return
+
+        imgwin = self.make_thumb_widget(rgbarr)
+        if save_thumb and (thumbpath != None):
+            self._save_thumb(imgwin, thumbpath)
+
+        self.insert_thumbnail(imgwin, thumbkey, thumbname, chname, name,
+                              path, thumbpath, metadata)
+
+    def _update_thumb(self, rgbarr, thumbkey, name, metadata,
+                      thumbpath=None):
+        if rgbarr is None:
+            # thumbnail could not be rendered; keep the old one
+            return
+
+        imgwin = self.make_thumb_widget(rgbarr)
+        if thumbpath != None:
+            self._save_thumb(imgwin, thumbpath)
 
-        self.insert_thumbnail(imgwin, thumbkey, thumbname, chname, name, path,
-                              thumbpath, metadata)
+        self.update_thumbnail(thumbkey, imgwin, name, metadata)
 
     def update_thumbs(self, nameList):
         
@@ -174,6 +240,7 @@ class ThumbsBase(GingaPlugin.GlobalPlugin):
             self.clearWidget()
             self.thumbList = []
             self.thumbDict = {}
+            self.thumbPending = set([])
         self.reorder_thumbs()
         
     def add_channel(self, viewer, chinfo):
@@ -224,13 +291,6 @@ class ThumbsBase(GingaPlugin.GlobalPlugin):
     def redo_delay_timer(self, timer):
         self.fv.gui_do(self.redo_thumbnail, timer.data.fitsimage)
         
-    def copy_attrs(self, fitsimage):
-        # Reflect transforms, colormap, etc.
-        fitsimage.copy_attributes(self.thumb_generator,
-                                  ['transforms', 'cutlevels',
-                                   'rgbmap'],
-                                  redraw=False)
-
     def have_thumbnail(self, fitsimage, image):
         """Returns True if we already have a thumbnail version of this image
         cached, False otherwise.
@@ -258,11 +318,7 @@ class ThumbsBase(GingaPlugin.GlobalPlugin):
         
         chname = self.fv.get_channelName(fitsimage)
 
-        # Get metadata for mouse-over tooltip
-        header = image.get_header()
-        metadata = {}
-        for kwd in self.keywords:
-            metadata[kwd] = header.get(kwd, 'N/A')
+        metadata = self.get_thumb_metadata(image)
 
         # Look up our version of the thumb
         name = image.get('name', None)
@@ -277,30 +333,15 @@ class ThumbsBase(GingaPlugin.GlobalPlugin):
                 self.add_image(self.fv, chname, image)
                 return
 
-            # Generate new thumbnail
-            # TODO: Can't use set_image() because we will override the saved
-            # cuts settings...should look into fixing this...
-            ## timage = self.thumb_generator.get_image()
-            ## if timage != image:
-            ##     self.thumb_generator.set_image(image)
-            #data = image.get_data()
-            #self.thumb_generator.set_data(data)
-            self.thumb_generator.set_image(image)
-            fitsimage.copy_attributes(self.thumb_generator,
-                                      ['transforms', 'cutlevels',
-                                       'rgbmap'],
-                                      redraw=False)
-
-            # Save a thumbnail for future browsing
-            if save_thumb:
-                thumbpath = self.get_thumbpath(path)
-                if thumbpath != None:
-                    self.thumb_generator.save_image_as_file(thumbpath,
-                                                            format='jpeg')
-
-            imgwin = self.thumb_generator.get_image_as_widget()
+        thumbpath = None
+        if save_thumb:
+            thumbpath = self.get_thumbpath(path)
 
-        self.update_thumbnail(thumbkey, imgwin, name, metadata)
+        # Generate new thumbnail, reflecting transforms, colormap, etc.
+        attrs = thumbfarm.get_view_attrs(fitsimage)
+        self.thumb_farm.add_job(image, attrs, self._thumb_ready,
+                                self._update_thumb, thumbkey, name, metadata,
+                                thumbpath=thumbpath)
 
     def delete_channel(self, viewer, chinfo):
         """Called when a channel is deleted from the main interface.
@@ -320,36 +361,6 @@ class ThumbsBase(GingaPlugin.GlobalPlugin):
             self.thumbList = newThumbList
         self.reorder_thumbs()
 
-    def _make_thumb(self, chname, image, path, thumbkey,
-                    save_thumb=False, thumbpath=None):
-        # This is called by the make_thumbs() as a gui thread
-        with self.thmblock:
-            self.thumb_generator.set_image(image)
-            # Save a thumbnail for future browsing
-            if save_thumb and (thumbpath != None):
-                self.thumb_generator.save_image_as_file(thumbpath,
-                                                        format='jpeg')
-        
-            imgwin = self.thumb_generator.get_image_as_widget()
-
-            # Get metadata for mouse-over tooltip
-            image = self.thumb_generator.get_image()
-
-        header = image.get_header()
-        metadata = {}
-        for kwd in self.keywords:
-            metadata[kwd] = header.get(kwd, 'N/A')
-
-        dirname, name = os.path.split(path)
-
-        thumbname = name
-        if '.' in thumbname:
-            thumbname = thumbname.split('.')[0]
-
-        self.insert_thumbnail(imgwin, thumbkey, thumbname,
-                              chname, name, path, thumbpath, metadata)
-        self.fv.update_pending(timeout=0.001)
-        
     def make_thumbs(self, chname, filelist):
         # NOTE: this is called by the FBrowser plugin, as a non-gui thread!
         lcname = chname.lower()
@@ -366,6 +377,8 @@ class ThumbsBase(GingaPlugin.GlobalPlugin):
             thumbpath = self.get_thumbpath(path)
 
             with self.thmblock:
+                if thumbkey in self.thumbPending:
+                    continue
                 try:
                     bnch = self.thumbDict[thumbkey]
                     # if these are not equal then the mtime must have
@@ -388,10 +401,21 @@ class ThumbsBase(GingaPlugin.GlobalPlugin):
             try:
                 if image == None:
                     image = self.fv.load_image(path)
-                self.fv.gui_do(self._make_thumb, chname, image, path,
-                               thumbkey, save_thumb=save_thumb,
-                               thumbpath=thumbpath)
-                
+                metadata = self.get_thumb_metadata(image)
+
+                dirname, name = os.path.split(path)
+                thumbname = name
+                if '.' in thumbname:
+                    thumbname = thumbname.split('.')[0]
+
+                with self.thmblock:
+                    self.thumbPending.add(thumbkey)
+                self.thumb_farm.add_job(image, None, self._thumb_ready,
+                                        self._insert_thumb, thumbkey,
+                                        thumbname, chname, name, path,
+                                        thumbpath, metadata,
+                                        save_thumb=save_thumb)
+
             except Exception, e:
                 self.logger.error("Error generating thumbnail for '%s': %s" % (
                     path, str(e)))
@@ -388,6 +388,7 @@ class GingaView(QtMain.QtMain):
         fi = ImageViewCanvasQt.ImageViewCanvas(logger=self.logger,
                                                rgbmap=rgbmap,
                                                settings=settings)
+        fi.set_threadpool(self.threadPool)
         fi.enable_draw(False)
         fi.enable_auto_orient(True)
         fi.add_callback('motion', self.motion_cb)
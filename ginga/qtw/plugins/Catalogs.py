@@ -12,6 +12,7 @@ from ginga.qtw import QtHelp
 from ginga.qtw import ColorBar
 from ginga.misc import Bunch, Future
 from ginga.misc.plugins import CatalogsBase
+from ginga.util import catalog
 
 class Catalogs(CatalogsBase.CatalogsBase):
 
@@ -555,10 +556,16 @@ class CatalogTableModel(QtCore.QAbstractTableModel):
         
         self.emit(QtCore.SIGNAL("layoutAboutToBeChanged()"))
 
-        self.starlist = sorted(self.starlist, key=sortfn)        
+        if isinstance(self.starlist, catalog.StarTable):
+            # sort on the column, without making all the star rows
+            field = self.columns[Ncol][1]
+            self.starlist = self.starlist.sorted_by(
+                field, reverse=(order == QtCore.Qt.DescendingOrder))
+        else:
+            self.starlist = sorted(self.starlist, key=sortfn)        
 
-        if order == QtCore.Qt.DescendingOrder:
-            self.starlist.reverse()
+            if order == QtCore.Qt.DescendingOrder:
+                self.starlist.reverse()
         self.emit(QtCore.SIGNAL("layoutChanged()"))
         
     
@@ -8,8 +8,8 @@
 # Please see the file LICENSE.txt for details.
 #
 import os
+import numpy
 
-from ginga.qtw import ImageViewQt as ImageViewQt
 from ginga.qtw.QtHelp import QtGui, QtCore
 from ginga.misc.plugins import ThumbsBase
 from ginga.qtw import QtHelp
@@ -38,6 +38,9 @@ class MyLabel(QtGui.QLabel):
     
 class Thumbs(ThumbsBase.ThumbsBase):
 
+    # the layout of QImage.Format_ARGB32
+    thumb_rgb_order = 'BGRA'
+
     def __init__(self, fv):
         # superclass defines some variables for us, like logger
         super(Thumbs, self).__init__(fv)
@@ -50,14 +53,6 @@ class Thumbs(ThumbsBase.ThumbsBase):
         width, height = 300, 300
         cm, im = self.fv.cm, self.fv.im
 
-        tg = ImageViewQt.ImageViewQt(logger=self.logger)
-        tg.configure(200, 200)
-        tg.enable_autozoom('on')
-        tg.enable_autocuts('on')
-        tg.enable_auto_orient(True)
-        tg.set_makebg(False)
-        self.thumb_generator = tg
-
         sw = MyScrollArea()
         sw.setWidgetResizable(True)
         #sw.setEnabled(True)
@@ -91,6 +86,18 @@ class Thumbs(ThumbsBase.ThumbsBase):
         b.auto_scroll.setChecked(autoScroll)
         rvbox.addWidget(w, stretch=0)
 
+    def make_thumb_widget(self, rgbarr):
+        height, width, depth = rgbarr.shape
+        rgbarr = numpy.ascontiguousarray(rgbarr)
+        image = QtGui.QImage(rgbarr.data, width, height,
+                             QtGui.QImage.Format_ARGB32)
+        # QImage does not copy the data, so keep a reference to it
+        image.ndarray = rgbarr
+        return image
+
+    def save_thumb_widget(self, imgwin, thumbpath):
+        imgwin.save(thumbpath, format='jpeg', quality=90)
+
     def insert_thumbnail(self, imgwin, thumbkey, thumbname, chname, name, path,
                          thumbpath, metadata):
         pixmap = QtGui.QPixmap.fromImage(imgwin)
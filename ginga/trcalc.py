@@ -10,6 +10,7 @@
 import math
 import numpy
 import time
+import threading
 
 try:
     # optional numexpr package speeds up certain combined numpy array
@@ -37,6 +38,66 @@ def rotate_pt(x, y, theta_deg, xoff=0, yoff=0):
     return (ap + xoff, bp + yoff)
 
 
+def rotate_grid(xs, ys, theta_deg):
+    """
+    Rotate the grid formed by all combinations of the 1D offset vectors
+    `xs` (columns) and `ys` (rows) by `theta_deg`.  Returns two 2D float
+    arrays (ap, bp) of the rotated x and y offsets.
+    """
+    cos_t = numpy.cos(numpy.radians(theta_deg))
+    sin_t = numpy.sin(numpy.radians(theta_deg))
+
+    xi = xs[numpy.newaxis, :]
+    yi = ys[:, numpy.newaxis]
+    if have_numexpr:
+        ap = ne.evaluate("(xi * cos_t) - (yi * sin_t)")
+        bp = ne.evaluate("(xi * sin_t) + (yi * cos_t)")
+    else:
+        ap = (xi * cos_t) - (yi * sin_t)
+        bp = (xi * sin_t) + (yi * cos_t)
+    return (ap, bp)
+
+
+# Cache of index arrays for rotate_nd(), keyed by shape, angle and
+# rotation center.  These are large, so only a few are kept.
+_rot_cache = {}
+_rot_cache_order = []
+_rot_cache_len = 2
+_rot_lock = threading.RLock()
+
+def get_rotation_indexes(wd, ht, theta_deg, rotctr_x, rotctr_y):
+    """
+    Returns the (possibly cached) integer index arrays (yi, xi) that
+    rotate an array of `wd`x`ht` by `theta_deg` around the rotation center
+    (rotctr_x, rotctr_y) when used to index it.
+    """
+    key = (wd, ht, theta_deg, rotctr_x, rotctr_y)
+    with _rot_lock:
+        if key in _rot_cache:
+            return _rot_cache[key]
+
+    xs = numpy.arange(wd) - rotctr_x
+    ys = numpy.arange(ht) - rotctr_y
+    ap, bp = rotate_grid(xs, ys, theta_deg)
+
+    # Optomizations to reuse existing intermediate arrays
+    ap += rotctr_x
+    numpy.rint(ap, out=ap)
+    ap = ap.astype('int')
+    ap.clip(0, wd-1, out=ap)
+    bp += rotctr_y
+    numpy.rint(bp, out=bp)
+    bp = bp.astype('int')
+    bp.clip(0, ht-1, out=bp)
+
+    with _rot_lock:
+        _rot_cache[key] = (bp, ap)
+        _rot_cache_order.append(key)
+        while len(_rot_cache_order) > _rot_cache_len:
+            del _rot_cache[_rot_cache_order.pop(0)]
+    return (bp, ap)
+
+
 def rotate_nd(data_np, theta_deg, rotctr_x=None, rotctr_y=None):
     """
     Rotate numpy array `data_np` by `theta_deg` around rotation center
@@ -51,31 +112,10 @@ def rotate_nd(data_np, theta_deg, rotctr_x=None, rotctr_y=None):
     if rotctr_y == None:
         rotctr_y = ht // 2
 
-    yi, xi = numpy.mgrid[0:ht, 0:wd]
-    xi -= rotctr_x
-    yi -= rotctr_y
-    cos_t = numpy.cos(numpy.radians(theta_deg))
-    sin_t = numpy.sin(numpy.radians(theta_deg))
-
     #t1 = time.time()
-    if have_numexpr:
-        ap = ne.evaluate("(xi * cos_t) - (yi * sin_t) + rotctr_x")
-        bp = ne.evaluate("(xi * sin_t) + (yi * cos_t) + rotctr_y")
-    else:
-        ap = (xi * cos_t) - (yi * sin_t) + rotctr_x
-        bp = (xi * sin_t) + (yi * cos_t) + rotctr_y
+    bp, ap = get_rotation_indexes(wd, ht, theta_deg, rotctr_x, rotctr_y)
     #print "rotation in %.5f sec" % (time.time() - t1)
 
-    #ap = numpy.rint(ap).astype('int').clip(0, wd-1)
-    #bp = numpy.rint(bp).astype('int').clip(0, ht-1)
-    # Optomizations to reuse existing intermediate arrays
-    numpy.rint(ap, out=ap)
-    ap = ap.astype('int')
-    ap.clip(0, wd-1, out=ap)
-    numpy.rint(bp, out=bp)
-    bp = bp.astype('int')
-    bp.clip(0, ht-1, out=bp)
-
     newdata = data_np[bp, ap]
     new_ht, new_wd = newdata.shape[:2]
 
@@ -0,0 +1,543 @@
+#! /usr/bin/env python
+#
+# bufstream.py -- binary streaming of image arrays to a viewer
+#
+# Eric Jeschke (eric@naoj.org)
+#
+# Copyright (c) Eric R. Jeschke.  All rights reserved.
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+A binary transport for pushing numpy arrays to a viewer over a TCP or
+local (Unix domain) socket, as an alternative to sending base64 encoded
+text through XML-RPC (see the RC plugin).
+
+Each array is sent as a small header followed by the raw bytes of the
+array in chunks, each of which may be compressed.  The receiver reads
+uncompressed chunks straight into the memory of the array it returns,
+so the data is not copied on the way in.  Several arrays may be sent
+over one connection, and the receiver acknowledges each of them.
+
+Wire format (all integers are unsigned, network byte order):
+
+  'GBS1' magic, header length (4 bytes), header (JSON)
+  for each chunk: length (4 bytes), chunk data
+  reply: status (4 bytes, 0 for success), length (4 bytes), message
+
+The header holds the keys `imname`, `chname`, `dims`, `dtype` (a numpy
+type string, such as '<f4'), `codec`, `chunksize` (number of array
+bytes in each chunk), `header` (FITS keywords) and `metadata`.
+
+Run this module to benchmark the transports against the XML-RPC path.
+"""
+import sys, os
+import time
+import json
+import struct
+import socket
+import threading
+import SocketServer
+import logging, logging.handlers
+import zlib
+import bz2
+import binascii
+import numpy
+
+have_lz4 = False
+try:
+    import lz4.block as lz4block
+    have_lz4 = True
+except ImportError:
+    try:
+        # older versions of the lz4 package
+        import lz4 as lz4block
+        have_lz4 = True
+    except ImportError:
+        pass
+
+have_zstd = False
+try:
+    import zstandard
+    have_zstd = True
+except ImportError:
+    pass
+
+MAGIC = 'GBS1'
+default_port = 9001
+default_chunksize = 4 * 1024 * 1024
+# largest header or reply accepted
+max_header_size = 16 * 1024 * 1024
+
+STD_FORMAT = '%(asctime)s | %(levelname)1.1s | %(filename)s:%(lineno)d (%(funcName)s) | %(message)s'
+
+
+class BufStreamError(Exception):
+    pass
+
+
+def _zstd_compress(data):
+    return zstandard.ZstdCompressor(level=1).compress(data)
+
+def _zstd_decompress(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+# compression name -> (compress function, decompress function)
+codecs = { 'none': (None, None),
+           'zlib': (lambda data: zlib.compress(data, 1), zlib.decompress),
+           }
+if have_lz4:
+    codecs['lz4'] = (lz4block.compress, lz4block.decompress)
+if have_zstd:
+    codecs['zstd'] = (_zstd_compress, _zstd_decompress)
+
+def get_codecs():
+    """Returns the names of the compression methods available."""
+    return sorted(codecs.keys())
+
+
+def _recv_into(sock, view):
+    # fill memoryview `view` from the socket
+    nbytes = len(view)
+    t_bytes = 0
+    while t_bytes < nbytes:
+        n = sock.recv_into(view[t_bytes:], nbytes - t_bytes)
+        if n == 0:
+            raise BufStreamError("Connection closed after %d of %d bytes" % (
+                t_bytes, nbytes))
+        t_bytes += n
+
+def _recv(sock, nbytes):
+    buf = bytearray(nbytes)
+    _recv_into(sock, memoryview(buf))
+    return buf
+
+def _recv_header(sock, eof_ok=False):
+    # returns the header dict, or None at end of stream if `eof_ok`
+    first = sock.recv(1)
+    if len(first) == 0:
+        if eof_ok:
+            return None
+        raise BufStreamError("Connection closed")
+    buf = first + str(_recv(sock, 7))
+    magic, length = struct.unpack('!4sI', buf)
+    if magic != MAGIC:
+        raise BufStreamError("Bad magic in stream: %s" % (repr(magic)))
+    if length > max_header_size:
+        raise BufStreamError("Header too large (%d bytes)" % (length))
+    return json.loads(str(_recv(sock, length)))
+
+def _check_header(hdr):
+    try:
+        dtype = numpy.dtype(str(hdr['dtype']))
+        dims = tuple(map(int, hdr['dims']))
+        codec = str(hdr.get('codec', 'none'))
+        chunksize = int(hdr.get('chunksize', default_chunksize))
+    except Exception, e:
+        raise BufStreamError("Bad header: %s" % (str(e)))
+    if dtype.hasobject:
+        raise BufStreamError("Can't receive arrays of type %s" % (
+            str(dtype)))
+    if not codec in codecs:
+        raise BufStreamError("Compression '%s' is not available" % (
+            codec))
+    if chunksize <= 0:
+        raise BufStreamError("Bad chunk size %d" % (chunksize))
+    return (dims, dtype, codec, chunksize)
+
+
+def recv_array(sock, eof_ok=False):
+    """Receive an array from socket `sock`.  Returns (data, hdr), where
+    `data` is the array and `hdr` is the header sent with it, or None if
+    `eof_ok` is True and the stream has ended.  The array is in native
+    byte order.
+    """
+    hdr = _recv_header(sock, eof_ok=eof_ok)
+    if hdr == None:
+        return None
+    dims, dtype, codec, chunksize = _check_header(hdr)
+
+    nbytes = int(numpy.prod(dims)) * dtype.itemsize
+    flat = numpy.empty(nbytes, dtype=numpy.uint8)
+    view = memoryview(flat)
+    decompress = codecs[codec][1]
+    # buffer for compressed chunks, reused between chunks
+    cbuf = bytearray(0)
+
+    pos = 0
+    while pos < nbytes:
+        n = min(chunksize, nbytes - pos)
+        length, = struct.unpack('!I', str(_recv(sock, 4)))
+        if decompress == None:
+            if length != n:
+                raise BufStreamError("Chunk length %d, expected %d" % (
+                    length, n))
+            # read the data straight into the array
+            _recv_into(sock, view[pos:pos+n])
+        else:
+            if length > len(cbuf):
+                cbuf = bytearray(length)
+            _recv_into(sock, memoryview(cbuf)[:length])
+            chunk = decompress(buffer(cbuf, 0, length))
+            if len(chunk) != n:
+                raise BufStreamError("Chunk decompressed to %d bytes, "
+                                     "expected %d" % (len(chunk), n))
+            flat[pos:pos+n] = numpy.frombuffer(chunk, dtype=numpy.uint8)
+        pos += n
+
+    data = flat.view(dtype).reshape(dims)
+    if not dtype.isnative:
+        data = data.byteswap(True).view(dtype.newbyteorder('='))
+    return (data, hdr)
+
+
+def send_array(sock, data, imname=None, chname=None, header=None,
+               metadata=None, codec='none', chunksize=default_chunksize):
+    """Send numpy array `data` over socket `sock`, compressing it with
+    `codec` (see get_codecs()) in chunks of `chunksize` bytes.  `header`
+    and `metadata` are dicts which must be encodable in JSON.
+    """
+    if not codec in codecs:
+        raise BufStreamError("Compression '%s' is not available" % (
+            codec))
+    data = numpy.ascontiguousarray(data)
+    hdr = dict(imname=imname, chname=chname, dims=list(data.shape),
+               dtype=data.dtype.str, codec=codec, chunksize=chunksize,
+               header=header or {}, metadata=metadata or {})
+    buf = json.dumps(hdr)
+    sock.sendall(struct.pack('!4sI', MAGIC, len(buf)) + buf)
+
+    compress = codecs[codec][0]
+    flat = data.reshape(-1).view(numpy.uint8)
+    nbytes = len(flat)
+    pos = 0
+    while pos < nbytes:
+        n = min(chunksize, nbytes - pos)
+        # NOTE: buffer() makes no copy of the data
+        chunk = buffer(flat, pos, n)
+        if compress != None:
+            chunk = compress(chunk)
+        sock.sendall(struct.pack('!I', len(chunk)))
+        sock.sendall(chunk)
+        pos += n
+
+
+def _recv_reply(sock):
+    status, length = struct.unpack('!iI', str(_recv(sock, 8)))
+    if length > max_header_size:
+        raise BufStreamError("Reply too large (%d bytes)" % (length))
+    msg = str(_recv(sock, length))
+    return (status, msg)
+
+def _send_reply(sock, status, msg):
+    sock.sendall(struct.pack('!iI', status, len(msg)) + msg)
+
+
+class BufStreamClient(object):
+    """Sends arrays to a `BufStreamServer` at `host`:`port`, or at the
+    Unix domain socket `path` if it is given.
+    """
+
+    def __init__(self, host='localhost', port=default_port, path=None,
+                 codec='none', chunksize=default_chunksize):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.codec = codec
+        self.chunksize = chunksize
+        self.sock = None
+
+    def open(self):
+        if self.path != None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.path)
+        else:
+            sock = socket.create_connection((self.host, self.port))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+
+    def close(self):
+        if self.sock != None:
+            self.sock.close()
+            self.sock = None
+
+    def load_array(self, imname, chname, data, header=None, metadata=None,
+                   codec=None):
+        """Display array `data` as image `imname` in channel `chname`.
+        Raises BufStreamError if the viewer reports an error.
+        """
+        if self.sock == None:
+            self.open()
+        if codec == None:
+            codec = self.codec
+        try:
+            send_array(self.sock, data, imname=imname, chname=chname,
+                       header=header, metadata=metadata, codec=codec,
+                       chunksize=self.chunksize)
+            status, msg = _recv_reply(self.sock)
+        except (socket.error, BufStreamError), e:
+            # connection is in an unknown state
+            self.close()
+            raise BufStreamError("Error sending '%s': %s" % (
+                imname, str(e)))
+        if status != 0:
+            raise BufStreamError(msg)
+        return 0
+
+
+class _BufStreamHandler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        server = self.server
+        sock = self.request
+        while True:
+            try:
+                res = recv_array(sock, eof_ok=True)
+            except Exception, e:
+                server.logger.error("Error receiving array: %s" % (str(e)))
+                return
+            if res == None:
+                return
+            data, hdr = res
+
+            try:
+                server.callback(data, hdr)
+                status, msg = 0, ''
+            except Exception, e:
+                status, msg = 1, str(e)
+                server.logger.error("Error loading array '%s': %s" % (
+                    hdr.get('imname', None), msg))
+            try:
+                _send_reply(sock, status, msg)
+            except socket.error, e:
+                server.logger.error("Error sending reply: %s" % (str(e)))
+                return
+
+
+class _TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _UnixServer(SocketServer.ThreadingMixIn,
+                  SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class BufStreamServer(object):
+    """Receives arrays sent by `BufStreamClient` on `host`:`port` (port 0
+    picks a free port), or on the Unix domain socket `path` if it is
+    given.  `callback` is called as callback(data, hdr) for each array,
+    from the thread serving the connection; an exception raised by it is
+    reported back to the client.
+    """
+
+    def __init__(self, logger, callback, host='', port=default_port,
+                 path=None):
+        self.logger = logger
+        self.callback = callback
+        self.host = host
+        self.port = port
+        self.path = path
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        if self.path != None:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            server = _UnixServer(self.path, _BufStreamHandler)
+        else:
+            server = _TCPServer((self.host, self.port), _BufStreamHandler)
+            # get the port, in case one was picked for us
+            self.port = server.server_address[1]
+        server.logger = self.logger
+        server.callback = self.callback
+        self.server = server
+
+        self.thread = threading.Thread(target=server.serve_forever,
+                                       kwargs=dict(poll_interval=0.1))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.server != None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            if self.path != None:
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+        self.thread = None
+
+
+def benchmark(logger, wd, ht, dtype='float32', count=5, codec_names=None,
+              path=None):
+    """Measure the rate at which `count` arrays of `wd`x`ht` can be
+    pushed through the XML-RPC path of the RC plugin and through each of
+    the binary transports, with everything but the display itself
+    included.  Returns a list of (name, MB/s).
+    """
+    import SimpleXMLRPCServer
+    import xmlrpclib
+
+    data = numpy.random.RandomState(0).normal(1000.0, 50.0, (ht, wd))
+    # quantize a little, as real data (and its noise) would be
+    data = numpy.round(data).astype(dtype)
+    size_mb = data.nbytes / (1024.0 * 1024.0)
+    dims, dtname = data.shape, str(data.dtype)
+    if codec_names == None:
+        codec_names = get_codecs()
+    res = []
+
+    # same decoding as GingaWrapper.load_buffer
+    class _Receiver(object):
+        def load_buffer(self, imname, chname, buf, dims, dtype,
+                        header, metadata, compressed):
+            buf = binascii.a2b_base64(buf)
+            if compressed:
+                buf = bz2.decompress(buf)
+            arr = numpy.fromstring(buf, dtype=getattr(numpy, dtype))
+            arr = arr.reshape(dims)
+            return 0
+
+    server = SimpleXMLRPCServer.SimpleXMLRPCServer(('localhost', 0),
+                                                   logRequests=False)
+    server.register_instance(_Receiver())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        proxy = xmlrpclib.ServerProxy('http://localhost:%d' % (
+            server.server_address[1]))
+        for compressed in (False, True):
+            time_start = time.time()
+            for i in xrange(count):
+                buf = data.tostring()
+                if compressed:
+                    buf = bz2.compress(buf)
+                buf = binascii.b2a_base64(buf)
+                proxy.load_buffer('bench%d' % i, 'Bench', buf, dims,
+                                  dtname, {}, {}, compressed)
+            elapsed = time.time() - time_start
+            name = 'xmlrpc/%s' % ('bz2' if compressed else 'none')
+            res.append((name, count * size_mb / elapsed))
+            logger.info("%-14s %8.1f MB/s" % (name, res[-1][1]))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    recvd = []
+    def callback(arr, hdr):
+        recvd.append(arr.shape)
+
+    transports = [('tcp', None)]
+    if path != None:
+        transports.append(('unix', path))
+    for kind, spath in transports:
+        server = BufStreamServer(logger, callback, host='localhost',
+                                 port=0, path=spath)
+        server.start()
+        try:
+            for codec in codec_names:
+                client = BufStreamClient(host='localhost', port=server.port,
+                                         path=spath, codec=codec)
+                time_start = time.time()
+                for i in xrange(count):
+                    client.load_array('bench%d' % i, 'Bench', data)
+                elapsed = time.time() - time_start
+                client.close()
+                name = '%s/%s' % (kind, codec)
+                res.append((name, count * size_mb / elapsed))
+                logger.info("%-14s %8.1f MB/s" % (name, res[-1][1]))
+        finally:
+            server.stop()
+
+    return res
+
+
+def main(options, args):
+
+    logger = logging.getLogger("bufstream")
+    logger.setLevel(options.loglevel)
+    fmt = logging.Formatter(STD_FORMAT)
+    if options.logfile:
+        fileHdlr  = logging.handlers.RotatingFileHandler(options.logfile)
+        fileHdlr.setLevel(options.loglevel)
+        fileHdlr.setFormatter(fmt)
+        logger.addHandler(fileHdlr)
+
+    if options.logstderr:
+        stderrHdlr = logging.StreamHandler()
+        stderrHdlr.setLevel(options.loglevel)
+        stderrHdlr.setFormatter(fmt)
+        logger.addHandler(stderrHdlr)
+
+    codec_names = None
+    if options.codecs:
+        codec_names = options.codecs.split(',')
+    wd, ht = map(int, options.size.split('x'))
+    res = benchmark(logger, wd, ht, dtype=options.dtype,
+                    count=options.count, codec_names=codec_names,
+                    path=options.path)
+
+    size_mb = wd * ht * numpy.dtype(options.dtype).itemsize / (1024.0 * 1024.0)
+    print "%dx%d %s (%.1f MB) x %d" % (wd, ht, options.dtype, size_mb,
+                                       options.count)
+    for name, rate in res:
+        print "%-14s %8.1f MB/s" % (name, rate)
+
+
+if __name__ == "__main__":
+
+    # Parse command line options with nifty optparse module
+    from optparse import OptionParser
+
+    usage = "usage: %prog [options]"
+    optprs = OptionParser(usage=usage, version=('%%prog'))
+
+    optprs.add_option("--codecs", dest="codecs", metavar="LIST",
+                      help="Benchmark compression methods in LIST")
+    optprs.add_option("--count", dest="count", type='int', default=5,
+                      help="Send COUNT arrays with each transport")
+    optprs.add_option("--debug", dest="debug", default=False, action="store_true",
+                      help="Enter the pdb debugger on main()")
+    optprs.add_option("--dtype", dest="dtype", default='float32',
+                      help="Send arrays of type DTYPE")
+    optprs.add_option("--log", dest="logfile", metavar="FILE",
+                      help="Write logging output to FILE")
+    optprs.add_option("--loglevel", dest="loglevel", metavar="LEVEL",
+                      type='int', default=logging.INFO,
+                      help="Set logging level to LEVEL")
+    optprs.add_option("--path", dest="path", metavar="PATH",
+                      help="Also benchmark a Unix domain socket at PATH")
+    optprs.add_option("--size", dest="size", default='2048x2048',
+                      metavar="WDxHT", help="Send arrays of size WDxHT")
+    optprs.add_option("--stderr", dest="logstderr", default=False,
+                      action="store_true",
+                      help="Copy logging also to stderr")
+    optprs.add_option("--profile", dest="profile", action="store_true",
+                      default=False,
+                      help="Run the profiler on main()")
+
+    (options, args) = optprs.parse_args(sys.argv[1:])
+
+    # Are we debugging this?
+    if options.debug:
+        import pdb
+
+        pdb.run('main(options, args)')
+
+    # Are we profiling this?
+    elif options.profile:
+        import profile
+
+        print "%s profile:" % sys.argv[0]
+        profile.run('main(options, args)')
+
+
+    else:
+        main(options, args)
+
+# END
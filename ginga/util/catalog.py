@@ -8,10 +8,16 @@
 # This is open-source software licensed under a BSD license.
 # Please see the file LICENSE.txt for details.
 #
+import os
 import re
 import urllib
 import urllib2
 import time
+import math
+import threading
+import Queue
+
+import numpy
 
 from ginga.misc import Bunch
 from ginga.util import wcs
@@ -20,6 +26,20 @@ from ginga.util import wcs
 star_attrs = ('name', 'ra', 'dec', 'ra_deg', 'dec_deg', 'mag', 'preference',
               'priority', 'flag', 'b_r', 'dst', 'description')
 
+# standard columns of a star listing
+star_columns = [('Name', 'name'),
+                ('RA', 'ra'),
+                ('DEC', 'dec'),
+                ('Mag', 'mag'),
+                ('Preference', 'preference'),
+                ('Priority', 'priority'),
+                ('Description', 'description'),
+                ]
+
+
+class CatalogError(Exception):
+    pass
+
 
 # Do we have astropy.vo installed?
 have_astropy = False
@@ -40,6 +60,15 @@ try:
 except ImportError:
     pass
 
+# scipy's k-d tree speeds up nearest star lookups
+have_kdtree = False
+try:
+    from scipy.spatial import cKDTree
+    have_kdtree = True
+
+except ImportError:
+    pass
+
 
 class Star(object):
     def __init__(self, **kwdargs):
@@ -62,6 +91,472 @@ class Star(object):
         return self.starInfo.has_key(key)
         
 
+class StarTable(object):
+    """A list of stars held as columns of values (arrays with one entry
+    per star), which is much faster to build and smaller than a list of
+    `Star` objects.  `defaults` gives values for fields that are the same
+    for every star.
+
+    Indexing or iterating over the table returns `Star` objects.  These
+    are only made when asked for, and are kept so that the same object is
+    returned for a star each time.  The 'ra' and 'dec' strings are made
+    from 'ra_deg' and 'dec_deg' if they are not columns of the table.
+    """
+
+    def __init__(self, columns, defaults=None):
+        self.columns = columns
+        if defaults == None:
+            defaults = {}
+        self.defaults = defaults
+        self.numrows = len(columns['ra_deg'])
+        # rows of the columns that are in this table, or None for all
+        self.rownums = None
+        # positions in this table of the rows (-1 if not present)
+        self.positions = None
+        # stars made so far, shared with the tables taken from this one
+        self.stars = {}
+        self.star_rownums = {}
+
+    def __len__(self):
+        if self.rownums is None:
+            return self.numrows
+        return len(self.rownums)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in xrange(*key.indices(len(self)))]
+        if self.rownums is None:
+            if key < 0:
+                key += self.numrows
+            if (key < 0) or (key >= self.numrows):
+                raise IndexError("star index out of range")
+            return self._get_star(key)
+        return self._get_star(int(self.rownums[key]))
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __contains__(self, star):
+        return self.get_number(star) != None
+
+    def _get_star(self, rownum):
+        star = self.stars.get(rownum, None)
+        if star != None:
+            return star
+
+        d = dict(self.defaults)
+        for name, column in self.columns.items():
+            value = column[rownum]
+            if isinstance(value, numpy.generic):
+                value = value.item()
+            d[name] = value
+        if not ('ra' in d):
+            d['ra'] = wcs.raDegToString(d['ra_deg'])
+        if not ('dec' in d):
+            d['dec'] = wcs.decDegToString(d['dec_deg'])
+
+        star = Star(**d)
+        self.stars[rownum] = star
+        self.star_rownums[id(star)] = rownum
+        return star
+
+    def get_column(self, name):
+        """Returns the values of field `name` as an array."""
+        if name in self.columns:
+            column = self.columns[name]
+        else:
+            column = numpy.array([self.defaults[name]] * self.numrows)
+        if self.rownums is None:
+            return column
+        return column[self.rownums]
+
+    def get_number(self, star):
+        """Returns the position of `star` in the table, or None."""
+        rownum = self.star_rownums.get(id(star), None)
+        if (rownum == None) or (self.rownums is None):
+            return rownum
+        if self.positions is None:
+            positions = numpy.empty(self.numrows, dtype=numpy.int)
+            positions.fill(-1)
+            positions[self.rownums] = numpy.arange(len(self.rownums))
+            self.positions = positions
+        pos = self.positions[rownum]
+        if pos < 0:
+            return None
+        return int(pos)
+
+    def index(self, star):
+        i = self.get_number(star)
+        if i == None:
+            raise ValueError("star is not in table")
+        return i
+
+    def take(self, idx):
+        """Returns a table of the stars at positions `idx` of this one."""
+        table = StarTable(self.columns, defaults=self.defaults)
+        table.stars = self.stars
+        table.star_rownums = self.star_rownums
+        idx = numpy.asarray(idx, dtype=numpy.int)
+        if self.rownums is None:
+            table.rownums = idx
+        else:
+            table.rownums = self.rownums[idx]
+        return table
+
+    def sorted_by(self, name, reverse=False):
+        """Returns a table of these stars sorted on field `name`."""
+        if (name in ('ra', 'dec')) and not (name in self.columns):
+            name = name + '_deg'
+        order = numpy.argsort(self.get_column(name), kind='mergesort')
+        if reverse:
+            order = order[::-1]
+        return self.take(order)
+
+
+def make_star_table(columns, ext, magfield):
+    """Build a StarTable from the columns of a catalog query result.
+    `ext` names the id, ra and dec columns and `magfield` the magnitude
+    column, if any.
+    """
+    columns = dict(columns)
+
+    def get_float(name, fill):
+        column = numpy.ma.asarray(columns[name]).astype(numpy.float)
+        return numpy.ma.filled(column, fill)
+
+    ra_deg = get_float(ext['ra'], numpy.nan)
+    dec_deg = get_float(ext['dec'], numpy.nan)
+    try:
+        mag = get_float(magfield, 0.0)
+    except Exception:
+        mag = numpy.zeros(len(ra_deg))
+
+    # Make sure we have at least these Ginga standard fields defined
+    columns.update({ 'name':    columns[ext['id']],
+                     'ra_deg':  ra_deg,
+                     'dec_deg': dec_deg,
+                     'mag':     mag })
+    # RA and DEC strings are made from the degrees
+    columns.pop('ra', None)
+    columns.pop('dec', None)
+    defaults = { 'preference':  0.0,
+                 'priority':    0,
+                 'description': 'fake magnitude' }
+    return StarTable(columns, defaults=defaults)
+
+
+def make_table_from_stars(starlist):
+    """Returns a StarTable of the standard fields of a list of stars."""
+    if isinstance(starlist, StarTable):
+        return starlist
+    columns = {}
+    for name in ('name', 'ra_deg', 'dec_deg', 'mag', 'preference',
+                 'priority', 'description'):
+        columns[name] = numpy.array([star[name] for star in starlist])
+    if len(starlist) == 0:
+        columns['ra_deg'] = numpy.zeros(0)
+    return StarTable(columns)
+
+
+def merge_star_tables(tables, radius_deg, names=None):
+    """Merge star tables from several catalogs into one table.
+
+    A star within `radius_deg` of a star from an earlier table is taken
+    to be the same star and is dropped.  `names` gives a name for each
+    table (e.g. the catalog server), which is stored in the 'catalog'
+    field of its stars.  Only the fields that all the tables have are
+    kept.
+    """
+    tables = map(make_table_from_stars, tables)
+    chord = radius_to_chord(radius_deg)
+
+    # find the stars to keep from each table
+    kept = []
+    points = numpy.zeros((0, 3))
+    for table in tables:
+        ra_deg = numpy.asarray(table.get_column('ra_deg'), dtype=numpy.float)
+        dec_deg = numpy.asarray(table.get_column('dec_deg'),
+                                dtype=numpy.float)
+        xyz = radec_to_xyz(ra_deg, dec_deg)
+        keep = numpy.isfinite(ra_deg) & numpy.isfinite(dec_deg)
+        if len(points) > 0:
+            tree = PointTree(points, numpy.arange(len(points)))
+            keep &= ~tree.query_within(xyz, chord)
+        idx = numpy.nonzero(keep)[0]
+        kept.append(idx)
+        points = numpy.vstack((points, xyz[idx]))
+
+    # fields common to all the tables
+    fields = None
+    for table in tables:
+        names_t = set(table.columns.keys()) | set(table.defaults.keys())
+        if fields == None:
+            fields = names_t
+        else:
+            fields &= names_t
+
+    columns, defaults = {}, {}
+    for field in (fields or []):
+        # a value that is the same for every star stays a default
+        values = [table.defaults.get(field, None) for table in tables]
+        if (not (None in values)) and (values.count(values[0]) == len(values)):
+            defaults[field] = values[0]
+            continue
+        pieces = [table.get_column(field)[kept_idx]
+                  for table, kept_idx in zip(tables, kept)]
+        try:
+            if any(map(numpy.ma.isMaskedArray, pieces)):
+                columns[field] = numpy.ma.concatenate(pieces)
+            else:
+                columns[field] = numpy.concatenate(pieces)
+        except (TypeError, ValueError):
+            # incompatible values--drop the field
+            pass
+
+    if names != None:
+        columns['catalog'] = numpy.repeat(numpy.array(names),
+                                          map(len, kept))
+    if not ('ra_deg' in columns):
+        columns['ra_deg'] = numpy.zeros(0)
+        columns['dec_deg'] = numpy.zeros(0)
+    return StarTable(columns, defaults=defaults)
+
+
+def radec_to_xyz(ra_deg, dec_deg):
+    """Returns unit vectors (an N x 3 array) for positions on the sky."""
+    ra = numpy.radians(ra_deg)
+    dec = numpy.radians(dec_deg)
+    cos_dec = numpy.cos(dec)
+    return numpy.column_stack((cos_dec * numpy.cos(ra),
+                               cos_dec * numpy.sin(ra),
+                               numpy.sin(dec)))
+
+def radius_to_chord(radius_deg):
+    """Returns the length of the chord subtending an angle on the unit
+    sphere."""
+    return 2.0 * math.sin(math.radians(min(radius_deg, 180.0)) / 2.0)
+
+
+class PointTree(object):
+    """Spatial lookup over a set of points (an N x D array).  `idx` gives
+    the number reported for each point.  A k-d tree is used if scipy is
+    available, otherwise searches are narrowed down by the points sorted
+    on their first coordinate.
+    """
+
+    def __init__(self, points, idx):
+        self.points = points
+        self.idx = idx
+        self.order = numpy.argsort(points[:, 0], kind='mergesort')
+        self.sorted_x = points[self.order, 0]
+        self.tree = None
+        if have_kdtree and (len(points) > 0):
+            self.tree = cKDTree(points)
+
+    def _xrange(self, lo, hi):
+        # indices of the points with lo <= x <= hi
+        i1 = numpy.searchsorted(self.sorted_x, lo, side='left')
+        i2 = numpy.searchsorted(self.sorted_x, hi, side='right')
+        return self.order[i1:i2]
+
+    def query_box(self, lo, hi):
+        """Returns the numbers of the points inside the box with corners
+        `lo` and `hi`, in no particular order.
+        """
+        cand = self._xrange(lo[0], hi[0])
+        pts = self.points[cand]
+        mask = numpy.logical_and.reduce((pts >= lo) & (pts <= hi), axis=1)
+        return self.idx[cand[mask]]
+
+    def query_radius(self, pt, radius):
+        """Returns the numbers of the points within `radius` of `pt`,
+        nearest first.
+        """
+        pt = numpy.asarray(pt, dtype=numpy.float)
+        if self.tree != None:
+            cand = numpy.array(self.tree.query_ball_point(pt, radius),
+                               dtype=numpy.int)
+        else:
+            cand = self._xrange(pt[0] - radius, pt[0] + radius)
+        dist = numpy.sqrt(((self.points[cand] - pt)**2).sum(axis=1))
+        cand, dist = cand[dist <= radius], dist[dist <= radius]
+        return self.idx[cand[numpy.argsort(dist, kind='mergesort')]]
+
+    def query_nearest(self, pt, radius=None):
+        """Returns the number of the point nearest to `pt`, or None if
+        there is no point (within `radius`, if given).
+        """
+        if len(self.points) == 0:
+            return None
+        if self.tree != None:
+            if radius == None:
+                radius = numpy.inf
+            dist, i = self.tree.query(pt, distance_upper_bound=radius)
+            if i >= len(self.points):
+                return None
+            return self.idx[i]
+        if radius != None:
+            res = self.query_radius(pt, radius)
+            if len(res) == 0:
+                return None
+            return res[0]
+        dist = ((self.points - numpy.asarray(pt))**2).sum(axis=1)
+        return self.idx[numpy.argmin(dist)]
+
+    def query_within(self, pts, radius):
+        """Returns a boolean array telling which of the points `pts` (an
+        M x D array) have a point of the tree within `radius`.
+        """
+        if len(self.points) == 0:
+            return numpy.zeros(len(pts), dtype=numpy.bool)
+        if self.tree != None:
+            dist, i = self.tree.query(pts, distance_upper_bound=radius)
+            return numpy.isfinite(dist)
+        return numpy.array([self.query_nearest(pt, radius=radius) != None
+                            for pt in pts], dtype=numpy.bool)
+
+
+class StarIndex(object):
+    """A spatial index over a list of stars, for quick lookup of the
+    stars in a region or near a point.
+
+    Stars are indexed by RA/DEC (as points on the unit sphere) and, after
+    `set_image` has been called, by their pixel positions on that image.
+    """
+
+    def __init__(self, starlist, image=None):
+        self.starlist = starlist
+
+        if isinstance(starlist, StarTable):
+            # positions can be read straight from the columns
+            self.numbers = None
+            ra_deg = numpy.array(starlist.get_column('ra_deg'),
+                                 dtype=numpy.float)
+            dec_deg = numpy.array(starlist.get_column('dec_deg'),
+                                  dtype=numpy.float)
+        else:
+            self.numbers = dict([(id(star), i)
+                                 for i, star in enumerate(starlist)])
+            num = len(starlist)
+            ra_deg = numpy.empty(num, dtype=numpy.float)
+            dec_deg = numpy.empty(num, dtype=numpy.float)
+            for i, star in enumerate(starlist):
+                try:
+                    ra_deg[i] = float(star['ra_deg'])
+                    dec_deg[i] = float(star['dec_deg'])
+                except (KeyError, TypeError, ValueError):
+                    ra_deg[i] = dec_deg[i] = numpy.nan
+        self.ra_deg = ra_deg
+        self.dec_deg = dec_deg
+
+        valid = numpy.isfinite(ra_deg) & numpy.isfinite(dec_deg)
+        idx = numpy.nonzero(valid)[0]
+        self.sky_tree = PointTree(radec_to_xyz(ra_deg[idx], dec_deg[idx]),
+                                  idx)
+
+        self.image = None
+        self.xs = None
+        self.ys = None
+        self.pix_tree = None
+        if image != None:
+            self.set_image(image)
+
+    def __len__(self):
+        return len(self.starlist)
+
+    def set_image(self, image):
+        """Calculate the pixel positions of the stars on `image`."""
+        num = len(self.starlist)
+        xs = numpy.empty(num, dtype=numpy.float)
+        ys = numpy.empty(num, dtype=numpy.float)
+        xs.fill(numpy.nan)
+        ys.fill(numpy.nan)
+        idx = numpy.nonzero(numpy.isfinite(self.ra_deg) &
+                            numpy.isfinite(self.dec_deg))[0]
+        try:
+            # project all of the stars in one call
+            pix = image.radectopix_many(numpy.column_stack(
+                (self.ra_deg[idx], self.dec_deg[idx])))
+            xs[idx], ys[idx] = pix[:, 0], pix[:, 1]
+
+        except Exception:
+            # the WCS could not do them together--try one at a time
+            for i in idx:
+                try:
+                    xs[i], ys[i] = image.radectopix(self.ra_deg[i],
+                                                    self.dec_deg[i])
+                except Exception:
+                    # no position for this star
+                    pass
+        self.xs = xs
+        self.ys = ys
+
+        valid = numpy.isfinite(xs) & numpy.isfinite(ys)
+        idx = numpy.nonzero(valid)[0]
+        self.pix_tree = PointTree(numpy.column_stack((xs[idx], ys[idx])),
+                                  idx)
+        self.image = image
+
+    def get_number(self, star):
+        """Returns the position of `star` in the star list, or None."""
+        if self.numbers == None:
+            return self.starlist.get_number(star)
+        return self.numbers.get(id(star), None)
+
+    def get_xy(self, star):
+        """Returns the pixel position of `star`, or None if unknown."""
+        i = self.get_number(star)
+        if (i == None) or (self.xs is None) or \
+               (not numpy.isfinite(self.xs[i])):
+            return None
+        return (self.xs[i], self.ys[i])
+
+    def _stars(self, idx):
+        return [self.starlist[i] for i in idx]
+
+    def in_box(self, x1, y1, x2, y2):
+        """Returns the numbers of the stars inside a pixel bounding box."""
+        return self.pix_tree.query_box((min(x1, x2), min(y1, y2)),
+                                       (max(x1, x2), max(y1, y2)))
+
+    def near(self, x, y, radius):
+        """Returns the stars within `radius` pixels of (x, y), nearest
+        first.
+        """
+        return self._stars(self.pix_tree.query_radius((x, y), radius))
+
+    def nearest(self, x, y, radius=None):
+        """Returns the star nearest to pixel (x, y), or None if there is
+        no star (within `radius`, if given).
+        """
+        i = self.pix_tree.query_nearest((x, y), radius=radius)
+        if i == None:
+            return None
+        return self.starlist[i]
+
+    def near_radec(self, ra_deg, dec_deg, radius_deg):
+        """Returns the stars within `radius_deg` of (ra_deg, dec_deg),
+        nearest first.
+        """
+        pt = radec_to_xyz(ra_deg, dec_deg)[0]
+        return self._stars(self.sky_tree.query_radius(
+            pt, radius_to_chord(radius_deg)))
+
+    def nearest_radec(self, ra_deg, dec_deg, radius_deg=None):
+        """Returns the star nearest to (ra_deg, dec_deg), or None if there
+        is no star (within `radius_deg`, if given).
+        """
+        pt = radec_to_xyz(ra_deg, dec_deg)[0]
+        radius = None
+        if radius_deg != None:
+            radius = radius_to_chord(radius_deg)
+        i = self.sky_tree.query_nearest(pt, radius=radius)
+        if i == None:
+            return None
+        return self.starlist[i]
+
+
 class AstroPyCatalogServer(object):
 
     def __init__(self, logger, full_name, key, url, description):
@@ -71,6 +566,8 @@ class AstroPyCatalogServer(object):
         self.description = description
         self.kind = 'astropy.vo-catalog'
         self.url = url
+        # optional cache of query results
+        self.cache = None
 
         # For compatibility with URL catalog servers
         self.params = {}
@@ -83,25 +580,6 @@ class AstroPyCatalogServer(object):
     def getParams(self):
         return self.params
 
-    def toStar(self, data, ext, magfield):
-        try:
-            mag = float(data[magfield])
-        except:
-            mag = 0.0
-            
-        # Make sure we have at least these Ginga standard fields defined
-        d = { 'name':         data[ext['id']],
-              'ra_deg':       float(data[ext['ra']]),
-              'dec_deg':      float(data[ext['dec']]),
-              'mag':          mag,
-              'preference':   0.0,
-              'priority':     0,
-              'description':  'fake magnitude' }
-        data.update(d)
-        data['ra'] = wcs.raDegToString(data['ra_deg'])
-        data['dec'] = wcs.decDegToString(data['dec_deg'])
-        return Star(**data)
-
     def search(self, **params):
         """For compatibility with generic star catalog search.
         """
@@ -121,6 +599,18 @@ class AstroPyCatalogServer(object):
         radius_deg = float(params['r']) / 60.0
         #radius_deg = float(params['r'])
 
+        # use the results of an identical query, if cached
+        key = None
+        if self.cache != None:
+            key = self.cache.make_key(self.short_name,
+                                      dict(ra=ra_deg, dec=dec_deg,
+                                           r=radius_deg))
+            res = self.cache.get_object(key)
+            if res != None:
+                self.logger.info("Found query results in cache")
+                return res
+            self.cache.check_online()
+
         c = coordinates.ICRSCoordinates(ra_deg, dec_deg,
                                         unit=(units.degree, units.degree))
         self.logger.info("Querying catalog: %s" % (self.full_name))
@@ -156,11 +646,9 @@ class AstroPyCatalogServer(object):
             magfield = None
 
         # prepare the result list
-        starlist = []
         arr = results.array
-        for i in xrange(numsources):
-            source = dict(zip(fields, arr[i]))
-            starlist.append(self.toStar(source, ext, magfield))
+        columns = [(name, arr[name]) for name in fields]
+        starlist = make_star_table(columns, ext, magfield)
 
         # metadata about the list
         columns = [('Name', 'name'),
@@ -184,6 +672,9 @@ class AstroPyCatalogServer(object):
         colorCode = 'Mag'
         
         info = Bunch.Bunch(columns=columns, color=colorCode)
+        if key != None:
+            self.cache.put_object(key, (starlist, info),
+                                  server=self.short_name)
         return starlist, info
 
 
@@ -196,6 +687,8 @@ class PyVOCatalogServer(object):
         self.description = description
         self.kind = 'pyvo-catalog'
         self.url = url
+        # optional cache of query results
+        self.cache = None
 
         # For compatibility with URL catalog servers
         self.params = {}
@@ -208,25 +701,6 @@ class PyVOCatalogServer(object):
     def getParams(self):
         return self.params
 
-    def toStar(self, data, ext, magfield):
-        try:
-            mag = float(data[magfield])
-        except:
-            mag = 0.0
-            
-        # Make sure we have at least these Ginga standard fields defined
-        d = { 'name':         data[ext['id']],
-              'ra_deg':       float(data[ext['ra']]),
-              'dec_deg':      float(data[ext['dec']]),
-              'mag':          mag,
-              'preference':   0.0,
-              'priority':     0,
-              'description':  'fake magnitude' }
-        data.update(d)
-        data['ra'] = wcs.raDegToString(data['ra_deg'])
-        data['dec'] = wcs.decDegToString(data['dec_deg'])
-        return Star(**data)
-
     def search(self, **params):
         """For compatibility with generic star catalog search.
         """
@@ -245,6 +719,18 @@ class PyVOCatalogServer(object):
         # Convert to degrees for search radius
         radius_deg = float(params['r']) / 60.0
         #radius_deg = float(params['r'])
+
+        # use the results of an identical query, if cached
+        key = None
+        if self.cache != None:
+            key = self.cache.make_key(self.short_name,
+                                      dict(ra=ra_deg, dec=dec_deg,
+                                           r=radius_deg))
+            res = self.cache.get_object(key)
+            if res != None:
+                self.logger.info("Found query results in cache")
+                return res
+            self.cache.check_online()
         
         # initialize our query object with the service's base URL
         query = pyvo.scs.SCSQuery(self.url)
@@ -284,10 +770,9 @@ class PyVOCatalogServer(object):
             
         self.logger.info("Found %d sources" % len(results))
 
-        starlist = []
-        for source in results:
-            data = dict(source.items())
-            starlist.append(self.toStar(data, ext, magfield))
+        names = [field.name for field in fields]
+        columns = [(name, results.getcolumn(name)) for name in names]
+        starlist = make_star_table(columns, ext, magfield)
 
         # metadata about the list
         columns = [('Name', 'name'),
@@ -299,7 +784,7 @@ class PyVOCatalogServer(object):
                    ('Description', 'description'),
                    ]
         # Append extra columns returned by search to table header 
-        cols = list(source.keys())
+        cols = list(names)
         cols.remove(ext['ra'])
         cols.remove(ext['dec'])
         cols.remove(ext['id'])
@@ -309,6 +794,9 @@ class PyVOCatalogServer(object):
         colorCode = 'Mag'
         
         info = Bunch.Bunch(columns=columns, color=colorCode)
+        if key != None:
+            self.cache.put_object(key, (starlist, info),
+                                  server=self.short_name)
         return starlist, info
 
 
@@ -321,6 +809,8 @@ class PyVOImageServer(object):
         self.description = description
         self.kind = 'pyvo-image'
         self.url = url
+        # optional cache of query results
+        self.cache = None
 
         # For compatibility with other Ginga catalog servers
         self.params = {}
@@ -356,6 +846,20 @@ class PyVOImageServer(object):
         ht_deg = float(params['height']) / 60.0
         ## wd_deg = float(params['width'])
         ## ht_deg = float(params['height'])
+
+        # use the image from an identical query, if cached
+        key = None
+        if self.cache != None:
+            key = self.cache.make_key(self.short_name,
+                                      dict(ra=ra_deg, dec=dec_deg,
+                                           width=wd_deg, height=ht_deg))
+            fitspath = dstpath
+            if fitspath == None:
+                fitspath = os.path.join("/tmp", "pyvo-%s.fits" % (key))
+            if self.cache.get_file(key, fitspath) != None:
+                self.logger.info("Found image in cache")
+                return fitspath
+            self.cache.check_online()
         
         # initialize our query object with the service's base URL
         query = pyvo.sia.SIAQuery(self.url)
@@ -381,6 +885,9 @@ class PyVOImageServer(object):
         fitspath = results[0].make_dataset_filename(dir="/tmp")
         results[0].cachedataset(fitspath)
 
+        if key != None:
+            self.cache.put_file(key, fitspath, server=self.short_name)
+
         # explicit return
         return fitspath
 
@@ -395,6 +902,8 @@ class URLServer(object):
         self.base_url = url
         self.reqtype = 'get'
         self.description = description
+        # optional cache of query results
+        self.cache = None
 
         self.params = self._parse_params(url)
 
@@ -424,6 +933,34 @@ class URLServer(object):
 
 
     def fetch(self, url, filepath=None):
+        # use the results of an identical query, if cached
+        key = None
+        if self.cache != None:
+            key = self.cache.make_key(self.short_name, url)
+            if filepath:
+                if self.cache.get_file(key, filepath) != None:
+                    self.logger.info("Found url=%s in cache" % (url))
+                    return None
+            else:
+                data = self.cache.get_data(key)
+                if data != None:
+                    self.logger.info("Found url=%s in cache" % (url))
+                    return data
+            self.cache.check_online()
+
+        data = self._fetch(url)
+        if key != None:
+            self.cache.put_data(key, data, server=self.short_name, url=url)
+
+        if filepath:
+            with open(filepath, 'wb') as out_f:
+                out_f.write(data)
+            return None
+
+        else:
+            return data
+
+    def _fetch(self, url):
         data = ""
 
         req = urllib2.Request(url)
@@ -456,13 +993,7 @@ class URLServer(object):
                 url, str(e)))
             raise e
 
-        if filepath:
-            with open(filepath, 'wb') as out_f:
-                out_f.write(data)
-            return None
-
-        else:
-            return data
+        return data
 
 
     def search(self, filepath, **params):
@@ -524,56 +1055,47 @@ class CatalogServer(URLServer):
                 break
         self.logger.debug("offset=%d" % (offset))
 
-        results = []
-        table = [lines[offset-2]]
-        
+        i_name, i_ra = self.index['name'], self.index['ra']
+        i_dec, i_mag = self.index['dec'], self.index['mag']
+        numcols = max(i_name, i_ra, i_dec, i_mag) + 1
+        rows = []
+        numbad = 0
+
         for line in lines[offset:]:
-            line = line.strip()
-            #print ">>>", line
-            if (len(line) == 0) or line.startswith('#'):
-                continue
             elts = line.split()
-            if (len(elts) < 3):
+            #print ">>>", elts
+            if (len(elts) < 3) or elts[0].startswith('#'):
                 continue
-            table.append(line)
-
-            try:
-                name = elts[self.index['name']]
-                ra = elts[self.index['ra']]
-                dec = elts[self.index['dec']]
-                mag = float(elts[self.index['mag']])
-                #print name
-
-                if (self.format == 'deg') or not (':' in ra):
-                    # Assume RA and DEC are in degrees
-                    ra_deg = float(ra)
-                    dec_deg = float(dec)
-                else:
-                    # Assume RA and DEC are in standard string notation
-                    ra_deg = wcs.hmsStrToDeg(ra)
-                    dec_deg = wcs.dmsStrToDeg(dec)
-
-                # convert ra/dec via EQUINOX change if catalog EQUINOX is
-                # not the same as our default one (2000)
-                if cmp(self.equinox, 2000.0) != 0:
-                    ra_deg, dec_deg = wcs.eqToEq2000(ra_deg, dec_deg,
-                                                     self.equinox)
-                
-                ra_txt = wcs.raDegToString(ra_deg, format='%02d:%02d:%06.3f')
-                dec_txt = wcs.decDegToString(dec_deg,
-                                               format='%s%02d:%02d:%05.2f')
-                self.logger.debug("STAR %s AT ra=%s dec=%s mag=%f" % (
-                    name, ra_txt, dec_txt, mag))
-
-                results.append(Star(name=name, ra_deg=ra_deg, dec_deg=dec_deg,
-                                    ra=ra_txt, dec=dec_txt, mag=mag,
-                                    preference=0.0, priority=0,
-                                    description=''))
-
-            except Exception, e:
-                print str(e)
-                self.logger.error("Error parsing catalog query results: %s" % (
-                    str(e)))
+            if len(elts) < numcols:
+                numbad += 1
+                continue
+            rows.append(elts)
+
+        names = [row_elts[i_name] for row_elts in rows]
+        ras = [row_elts[i_ra] for row_elts in rows]
+        decs = [row_elts[i_dec] for row_elts in rows]
+        mags = [row_elts[i_mag] for row_elts in rows]
+        rows = None
+
+        # parse the columns
+        ra_deg, dec_deg = self.parse_radec(ras, decs)
+        mag = _to_float_array(mags)
+
+        good = numpy.isfinite(ra_deg) & numpy.isfinite(dec_deg) & \
+               numpy.isfinite(mag)
+        numbad += len(good) - numpy.count_nonzero(good)
+        if numbad > 0:
+            self.logger.error("Error parsing catalog query results: "
+                              "%d bad rows skipped" % (numbad))
+
+        columns = { 'name':    numpy.array(names)[good],
+                    'ra_deg':  ra_deg[good],
+                    'dec_deg': dec_deg[good],
+                    'mag':     mag[good] }
+        defaults = { 'preference':  0.0,
+                     'priority':    0,
+                     'description': '' }
+        results = StarTable(columns, defaults=defaults)
 
         # metadata about the list
         columns = [('Name', 'name'),
@@ -587,6 +1109,51 @@ class CatalogServer(URLServer):
         info = Bunch.Bunch(columns=columns, color='Mag')
 
         return (results, info)
+
+    def parse_radec(self, ras, decs):
+        """Convert sequences of RA and DEC strings from the catalog into
+        arrays of degrees at equinox 2000.  Unparseable values give NaN.
+        """
+        ra_deg = numpy.empty(len(ras), dtype=numpy.float)
+        dec_deg = numpy.empty(len(decs), dtype=numpy.float)
+        if self.format == 'deg':
+            is_sexa = numpy.zeros(len(ras), dtype=numpy.bool)
+        else:
+            is_sexa = numpy.array([':' in ra for ra in ras],
+                                  dtype=numpy.bool)
+
+        # RA and DEC in standard string notation
+        idx = numpy.nonzero(is_sexa)[0]
+        if len(idx) > 0:
+            ra_deg[idx] = wcs.hmsStrToDegArray([ras[i] for i in idx])
+            dec_deg[idx] = wcs.dmsStrToDegArray([decs[i] for i in idx])
+
+        # RA and DEC in degrees
+        idx = numpy.nonzero(~is_sexa)[0]
+        if len(idx) > 0:
+            ra_deg[idx] = _to_float_array([ras[i] for i in idx])
+            dec_deg[idx] = _to_float_array([decs[i] for i in idx])
+
+        # convert ra/dec via EQUINOX change if catalog EQUINOX is
+        # not the same as our default one (2000)
+        if cmp(self.equinox, 2000.0) != 0:
+            ra_deg, dec_deg = wcs.eqToEq2000Array(ra_deg, dec_deg,
+                                                  self.equinox)
+        return (ra_deg, dec_deg)
+
+
+def _to_float_array(strs):
+    # convert a sequence of strings to floats, NaN where not a number
+    try:
+        return numpy.array(strs, dtype=numpy.float)
+    except ValueError:
+        arr = numpy.empty(len(strs), dtype=numpy.float)
+        for i in xrange(len(strs)):
+            try:
+                arr[i] = float(strs[i])
+            except ValueError:
+                arr[i] = numpy.nan
+        return arr
         
 
 class ServerBank(object):
@@ -595,11 +1162,27 @@ class ServerBank(object):
         self.logger = logger
         self.imbank = {}
         self.ctbank = {}
+        self.cache = None
+
+    def set_cache(self, cache):
+        """Use `cache` (a querycache.QueryCache) for the queries to all
+        the servers in the bank.
+        """
+        self.cache = cache
+        for srvobj in self.imbank.values() + self.ctbank.values():
+            srvobj.cache = cache
+
+    def get_cache(self):
+        return self.cache
 
     def addImageServer(self, srvobj):
+        if self.cache != None:
+            srvobj.cache = self.cache
         self.imbank[srvobj.short_name] = srvobj
 
     def addCatalogServer(self, srvobj):
+        if self.cache != None:
+            srvobj.cache = self.cache
         self.ctbank[srvobj.short_name] = srvobj
 
     def getImageServer(self, key):
@@ -626,6 +1209,133 @@ class ServerBank(object):
         obj = self.ctbank[key]
 
         return obj.search(**params)
+
+    def _get_timeout(self, timeout, key):
+        if isinstance(timeout, dict):
+            return timeout.get(key, None)
+        return timeout
+
+    def fanout(self, tasks, timeout=None):
+        """Run several queries concurrently.  `tasks` is a list of
+        (key, fn) pairs, where `fn` takes no arguments.  Yields (key,
+        result) pairs as the queries finish; the result is an exception
+        if the query failed.  `timeout` is a time limit in seconds for
+        all the queries, or a dict of limits by key; a query that does
+        not finish in time yields a CatalogError and is abandoned.
+        """
+        queue = Queue.Queue()
+
+        def run(key, fn):
+            try:
+                res = fn()
+            except Exception, e:
+                res = e
+            queue.put((key, res))
+
+        time_start = time.time()
+        deadlines = {}
+        for key, fn in tasks:
+            limit = self._get_timeout(timeout, key)
+            if limit != None:
+                deadlines[key] = time_start + limit
+            thread = threading.Thread(target=run, args=(key, fn))
+            thread.daemon = True
+            thread.start()
+
+        pending = set([key for key, fn in tasks])
+        while len(pending) > 0:
+            # wait for the next result, or the next deadline
+            wait = None
+            times = [deadlines[key] for key in pending if key in deadlines]
+            if len(times) > 0:
+                wait = max(0.0, min(times) - time.time())
+            try:
+                if wait == None:
+                    key, res = queue.get()
+                else:
+                    key, res = queue.get(timeout=wait)
+
+            except Queue.Empty:
+                time_now = time.time()
+                for key in list(pending):
+                    if (key in deadlines) and (deadlines[key] <= time_now):
+                        pending.remove(key)
+                        yield (key, CatalogError(
+                            "Query to '%s' timed out after %.1f sec" % (
+                                key, time_now - time_start)))
+                continue
+
+            if key in pending:
+                pending.remove(key)
+                yield (key, res)
+
+    def getCatalogs(self, keys, timeout=None, merge_radius_arcsec=1.0,
+                    cb_fn=None, **params):
+        """Query several catalog servers concurrently, with the same
+        parameters, and merge the results.  Stars from different
+        catalogs within `merge_radius_arcsec` of each other are taken to
+        be the same star, and the first of them in the order of `keys`
+        is kept.
+
+        If `cb_fn` is given, it is called as cb_fn(key, starlist, info)
+        as the results of each server arrive, with the merged results so
+        far.  Returns (starlist, info, errors), where `errors` is a dict
+        of the exceptions of the failed (or timed out) queries by key.
+        """
+        tasks = []
+        for key in keys:
+            obj = self.ctbank[key]
+            tasks.append((key, lambda obj=obj: obj.search(**params)))
+
+        radius_deg = merge_radius_arcsec / 3600.0
+        results, infos, errors = {}, {}, {}
+        starlist, info = None, None
+        for key, res in self.fanout(tasks, timeout=timeout):
+            if isinstance(res, Exception):
+                self.logger.error("Query to catalog server '%s' failed: %s" % (
+                    key, str(res)))
+                errors[key] = res
+                continue
+
+            results[key], infos[key] = res
+            self.logger.info("Got %d stars from catalog server '%s'" % (
+                len(results[key]), key))
+            order = [key2 for key2 in keys if key2 in results]
+            starlist = merge_star_tables([results[key2] for key2 in order],
+                                         radius_deg, names=order)
+
+            # columns: the standard ones, the catalog and any others
+            # common to all the catalogs
+            columns = list(star_columns) + [('Catalog', 'catalog')]
+            known = set(map(lambda col: col[1], columns))
+            for col in infos[order[0]].columns:
+                if (not (col[1] in known)) and \
+                       (col[1] in starlist.columns):
+                    columns.append(col)
+            info = Bunch.Bunch(columns=columns, color='Mag')
+
+            if cb_fn != None:
+                cb_fn(key, starlist, info)
+
+        if starlist == None:
+            raise CatalogError("All catalog queries failed: %s" % (
+                '; '.join(["%s: %s" % (key, str(errors[key]))
+                           for key in keys if key in errors])))
+        return (starlist, info, errors)
+
+    def getImages(self, keys, filepaths, timeout=None, **params):
+        """Query several image servers concurrently, with the same
+        parameters.  `filepaths` is a dict of the path to store each
+        server's image in.  Returns a dict of the path of each image (or
+        the exception, if the query failed) by key.
+        """
+        tasks = []
+        for key in keys:
+            obj = self.imbank[key]
+            tasks.append((key, lambda obj=obj, path=filepaths.get(key, None):
+                          obj.search(path, **params)))
+
+        return dict(self.fanout(tasks, timeout=timeout))
     
 
 # END
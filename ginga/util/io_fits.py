@@ -84,6 +84,8 @@ class PyFitsFileHandler(BaseFitsFileHandler):
             raise FITSError("Need astropy or pyfits module installed to use this file handler")
         self.logger = logger
         self.kind = 'pyfits'
+        # open HDU list, held when the data is memory mapped
+        self.fits_f = None
 
     def fromHDU(self, hdu, ahdr):
         header = hdu.header
@@ -113,10 +115,19 @@ class PyFitsFileHandler(BaseFitsFileHandler):
         self.fromHDU(hdu, ahdr)
         return (data, naxispath)
 
-    def load_file(self, filespec, ahdr, numhdu=None, naxispath=None):
+    def load_file(self, filespec, ahdr, numhdu=None, naxispath=None,
+                  memmap=False):
+        """Load a data HDU from a FITS file.
+
+        If `memmap` is True the file is memory mapped and kept open for
+        as long as this handler lives (or until the next load/close), so
+        that only the pages of the data actually accessed are read in.
+        """
         filepath = get_path(filespec)
         self.logger.info("Loading file '%s' ..." % (filepath))
-        fits_f = pyfits.open(filepath, 'readonly')
+        # release any file held from a previous load
+        self.close()
+        fits_f = pyfits.open(filepath, 'readonly', memmap=memmap)
 
         # this seems to be necessary now for some fits files...
         try:
@@ -129,7 +140,7 @@ class PyFitsFileHandler(BaseFitsFileHandler):
             found_valid_hdu = False
             for i in range(len(fits_f)):
                 hdu = fits_f[i]
-                if hdu.data == None:
+                if hdu.data is None:
                     # compressed FITS file or non-pixel data hdu?
                     continue
                 if not isinstance(hdu.data, numpy.ndarray):
@@ -148,9 +159,18 @@ class PyFitsFileHandler(BaseFitsFileHandler):
 
         data, naxispath = self.load_hdu(hdu, ahdr, fobj=fits_f,
                                         naxispath=naxispath)
-        fits_f.close()
+        if memmap:
+            # data is a view on the mapped file--keep it open
+            self.fits_f = fits_f
+        else:
+            fits_f.close()
         return (data, naxispath)
 
+    def close(self):
+        if self.fits_f != None:
+            self.fits_f.close()
+            self.fits_f = None
+
     def create_fits(self, data, header):
         fits_f = pyfits.HDUList()
         hdu = pyfits.PrimaryHDU()
@@ -204,7 +224,10 @@ class FitsioFileHandler(BaseFitsFileHandler):
         self.fromHDU(hdu, ahdr)
         return (data, naxispath)
         
-    def load_file(self, filespec, ahdr, numhdu=None, naxispath=None):
+    def load_file(self, filespec, ahdr, numhdu=None, naxispath=None,
+                  memmap=False):
+        # NOTE: fitsio does not support memory mapping; `memmap` is
+        # accepted for compatibility with the pyfits handler
         filepath = get_path(filespec)
         self.logger.info("Loading file '%s' ..." % (filepath))
         fits_f = fitsio.FITS(filepath)
@@ -233,6 +256,9 @@ class FitsioFileHandler(BaseFitsFileHandler):
         fits_f.close()
         return (data, naxispath)
 
+    def close(self):
+        pass
+
     def create_fits(self, data, header):
         fits_f = pyfits.HDUList()
         hdu = pyfits.PrimaryHDU()
@@ -20,12 +20,60 @@ try:
 except ImportError:
     have_scipy = False
     
-from ginga.misc import Bunch
+from ginga.misc import Bunch, log
 
 class IQCalcError(Exception):
     """Base exception for raising errors in this module."""
     pass
 
+# Record type of the results returned by IQCalc.fwhm_batch()
+fwhm_batch_dtype = numpy.dtype([('x', numpy.float64), ('y', numpy.float64),
+                                ('objx', numpy.float64),
+                                ('objy', numpy.float64),
+                                ('fwhm_x', numpy.float64),
+                                ('fwhm_y', numpy.float64),
+                                ('fwhm', numpy.float64),
+                                ('sdx', numpy.float64),
+                                ('sdy', numpy.float64),
+                                ('maxx', numpy.float64),
+                                ('maxy', numpy.float64),
+                                ('brightness', numpy.float64),
+                                ('elipse', numpy.float64),
+                                ('ok', numpy.bool_)])
+
+
+def _find_peaks_tile(args):
+    """Find the peaks in one tile; see IQCalc.iter_bright_peaks().  This
+    may run in a worker process, so it does no logging.
+    """
+    tile, threshold, radius, xoff, yoff, core = args
+    iqcalc = IQCalc(logger=log.NullLogger())
+    cx1, cy1, cx2, cy2 = core
+    peaks = []
+    for xc, yc in iqcalc.find_bright_peaks(tile, threshold=threshold,
+                                           radius=radius):
+        xc, yc = xc + xoff, yc + yoff
+        # only keep the peaks centered in this tile's own (unextended)
+        # area, so that peaks seen in the overlap of neighboring tiles
+        # are reported just once
+        if (cx1 <= xc < cx2) and (cy1 <= yc < cy2):
+            peaks.append((xc, yc))
+    return peaks
+
+def _fit_cuts_batch(batch):
+    """Fit a batch of cross cuts; see IQCalc.evaluate_peaks().  This runs
+    in a worker process, so it does no logging.
+    """
+    iqcalc = IQCalc(logger=log.NullLogger())
+    results = []
+    for x0, y0, xarr, yarr, medv in batch:
+        try:
+            res = iqcalc.fit_cuts(x0, y0, xarr, yarr, medv)
+        except Exception, e:
+            res = str(e)
+        results.append(res)
+    return results
+
 
 class IQCalc(object):
 
@@ -41,6 +89,14 @@ class IQCalc(object):
         self.skylevel_magnification = 1.05
         self.skylevel_offset = 40.0
 
+        # number of peaks fit together by the batch fwhm method
+        self.batch_size = 1024
+        # maximum number of peaks sent to a worker process at a time
+        self.parallel_batch_size = 256
+
+        # number of pixels used to estimate statistics of large fields
+        self.sample_size = 1000000
+
     # FWHM CALCULATION
 
     def gaussian(self, x, p):
@@ -107,6 +163,12 @@ class IQCalc(object):
         # Get two cuts of the data, one in X and one in Y
         x0, y0, xarr, yarr = self.cut_cross(x, y, radius, data)
 
+        return self.fit_cuts(x0, y0, xarr, yarr, medv)
+
+    def fit_cuts(self, x0, y0, xarr, yarr, medv):
+        """Fit the cross cuts returned by cut_cross(), which start at
+        (x0, y0).  Returns the same values as get_fwhm().
+        """
         # Calculate FWHM in each direction
         fwhm_x, cx, sdx, maxx = self.calc_fwhm(xarr, medv=medv)
         fwhm_y, cy, sdy, maxy = self.calc_fwhm(yarr, medv=medv)
@@ -126,13 +188,171 @@ class IQCalc(object):
         return fwhm
 
     def centroid(self, data, xc, yc, radius):
-        x0, y0, arr = self.cut_region(self, xc, yc, radius, data)
+        x0, y0, arr = self.cut_region(xc, yc, radius, data)
         cy, cx = ndimage.center_of_mass(arr)
         return (cx, cy)
 
+    # BATCH FWHM CALCULATION
+
+    def cut_cross_batch(self, xs, ys, radius, data):
+        """Vectorized version of cut_cross() for arrays of positions
+        (xs, ys).  Returns the starting pixels (x0s, y0s), the cuts stacked
+        into (N, 2*radius+1) arrays (xarr, yarr) and boolean arrays of the
+        same shape marking which elements of the cuts lie in the data.
+        """
+        n = radius
+        ht, wd = data.shape
+        xs = numpy.asarray(xs).astype(numpy.intp)
+        ys = numpy.asarray(ys).astype(numpy.intp)
+        offsets = numpy.arange(2*n+1)
+
+        x0s = numpy.maximum(xs - n, 0)
+        y0s = numpy.maximum(ys - n, 0)
+        xi = x0s[:, numpy.newaxis] + offsets
+        yi = y0s[:, numpy.newaxis] + offsets
+        xvalid = xi <= numpy.minimum(xs + n, wd - 1)[:, numpy.newaxis]
+        yvalid = yi <= numpy.minimum(ys + n, ht - 1)[:, numpy.newaxis]
+
+        xarr = data[ys[:, numpy.newaxis], xi.clip(0, wd - 1)]
+        yarr = data[yi.clip(0, ht - 1), xs[:, numpy.newaxis]]
+        return (x0s, y0s, xarr, yarr, xvalid, yvalid)
+
+    def calc_fwhm_batch(self, arr, valid, medv, max_iter=20):
+        """Vectorized version of calc_fwhm() for a stack of 1D cuts `arr`
+        (of shape (N, M)); elements that are not `valid` are ignored.
+        The gaussians are fit by Levenberg-Marquardt iterations done on
+        all of the cuts together, starting from their moments.
+
+        Returns arrays of (fwhm, mu, sdev, maxv, ok).
+        """
+        num, m = arr.shape
+        X = numpy.arange(m, dtype=numpy.float64)
+        w = valid.astype(numpy.float64)
+
+        # same preparation of the data as calc_fwhm()
+        Y = arr.astype(numpy.float64) - medv
+        Y *= w
+        maxv = Y.max(axis=1)
+        Y = Y.clip(0, maxv[:, numpy.newaxis])
+
+        # initial guess from the moments of each cut
+        total = Y.sum(axis=1)
+        good = total > 0.0
+        total = numpy.where(good, total, 1.0)
+        mu = (Y * X).sum(axis=1) / total
+        dX = X - mu[:, numpy.newaxis]
+        sdev = numpy.sqrt((Y * dX * dX).sum(axis=1) / total)
+        sdev = numpy.where(sdev > 0.0, sdev, 1.0)
+        P = numpy.column_stack((mu, sdev, total))
+
+        norm = 1.0 / numpy.sqrt(2.0 * numpy.pi)
+
+        def model(P):
+            mu, sdev, amp = P[:, 0:1], P[:, 1:2], P[:, 2:3]
+            dX = X - mu
+            g = numpy.exp(-dX * dX / (2.0 * sdev * sdev))
+            c = norm / sdev
+            return (dX, g, c, amp * c * g)
+
+        def cost(f):
+            r = (f - Y) * w
+            return (r * r).sum(axis=1)
+
+        dX, g, c, f = model(P)
+        err = cost(f)
+        lam = numpy.ones(num) * 1.0e-3
+        for i in xrange(max_iter):
+            mu, sdev, amp = P[:, 0:1], P[:, 1:2], P[:, 2:3]
+            # Jacobian of the model with respect to (mu, sdev, amp)
+            J = numpy.empty((num, m, 3))
+            J[:, :, 0] = f * dX / (sdev * sdev)
+            J[:, :, 1] = f * (dX * dX / (sdev * sdev * sdev) - 1.0 / sdev)
+            J[:, :, 2] = c * g
+            Jw = J * w[:, :, numpy.newaxis]
+            JTJ = numpy.einsum('nki,nkj->nij', Jw, J)
+            JTr = numpy.einsum('nki,nk->ni', Jw, f - Y)
+
+            # damped normal equations
+            A = JTJ.copy()
+            diag = numpy.arange(3)
+            A[:, diag, diag] *= (1.0 + lam[:, numpy.newaxis])
+            # keep singular systems (e.g. empty cuts) solvable
+            A[:, diag, diag] += 1.0e-12
+            try:
+                step = numpy.linalg.solve(A, -JTr[:, :, numpy.newaxis])[:, :, 0]
+            except numpy.linalg.LinAlgError:
+                break
+
+            P_new = P + step
+            P_new[:, 1] = numpy.where(P_new[:, 1] != 0.0, P_new[:, 1], 1.0e-6)
+            dX_n, g_n, c_n, f_n = model(P_new)
+            err_n = cost(f_n)
+
+            better = numpy.isfinite(err_n) & (err_n < err)
+            lam = numpy.where(better, lam * 0.1, lam * 10.0)
+            b = better[:, numpy.newaxis]
+            P = numpy.where(b, P_new, P)
+            dX = numpy.where(b, dX_n, dX)
+            g = numpy.where(b, g_n, g)
+            c = numpy.where(b, c_n, c)
+            f = numpy.where(b, f_n, f)
+            err = numpy.where(better, err_n, err)
+
+        mu, sdev, amp = P[:, 0], numpy.fabs(P[:, 1]), P[:, 2]
+        fwhm = 2.0 * numpy.sqrt(2.0 * numpy.log(2.0)) * sdev
+        ok = good & numpy.isfinite(P).all(axis=1)
+        return (fwhm, mu, sdev, amp, ok)
+
+    def fwhm_batch(self, xs, ys, data, radius=15, medv=None, max_iter=20):
+        """Batch version of get_fwhm(): measure the objects at positions
+        (xs, ys) in `data` all together.  Returns a record array of
+        `fwhm_batch_dtype`, with one element per position; the `ok` field
+        is False for objects that could not be measured.
+        """
+        if medv == None:
+            medv = numpy.median(data)
+
+        x0s, y0s, xarr, yarr, xvalid, yvalid = self.cut_cross_batch(
+            xs, ys, radius, data)
+        fwhm_x, cx, sdx, maxx, okx = self.calc_fwhm_batch(
+            xarr, xvalid, medv, max_iter=max_iter)
+        fwhm_y, cy, sdy, maxy, oky = self.calc_fwhm_batch(
+            yarr, yvalid, medv, max_iter=max_iter)
+
+        res = numpy.zeros(len(x0s), dtype=fwhm_batch_dtype)
+        res['x'], res['y'] = xs, ys
+        res['objx'], res['objy'] = x0s + cx, y0s + cy
+        res['fwhm_x'], res['fwhm_y'] = fwhm_x, fwhm_y
+        res['sdx'], res['sdy'] = sdx, sdy
+        res['maxx'], res['maxy'] = maxx, maxy
+
+        # same derived measures as evaluate_peaks()
+        norm = 1.0 / numpy.sqrt(2.0 * numpy.pi)
+        def peak(ctr, sdev, maxv):
+            d = numpy.round(ctr) - ctr
+            return norm / sdev * numpy.exp(-d * d / (2 * sdev * sdev)) * maxv
+        res['brightness'] = (peak(res['objx'], sdx, maxx) +
+                             peak(res['objy'], sdy, maxy)) / 2.0
+        res['fwhm'] = numpy.sqrt(fwhm_x * fwhm_x + fwhm_y * fwhm_y) / numpy.sqrt(2.0)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            res['elipse'] = (numpy.minimum(fwhm_x, fwhm_y) /
+                             numpy.maximum(fwhm_x, fwhm_y))
+        res['ok'] = okx & oky & (sdx > 0.0) & (sdy > 0.0)
+        return res
+
 
     # FINDING BRIGHT PEAKS
 
+    def get_sample(self, data):
+        """Returns an evenly spaced subset of at most `sample_size`
+        pixels of `data`, for estimating the statistics of large fields.
+        """
+        ht, wd = data.shape[:2]
+        step = int(math.ceil(math.sqrt(float(wd * ht) / self.sample_size)))
+        if step <= 1:
+            return data
+        return data[::step, ::step]
+
     def get_threshold(self, data, sigma=5.0):
         median = numpy.median(data)
         # NOTE: for this method a good default sigma is 5.0
@@ -179,6 +399,49 @@ class IQCalc(object):
 
         return peaks
 
+    def iter_bright_peaks(self, data, threshold=None, sigma=5, radius=5,
+                          tile_size=1024, pool=None):
+        """Generator version of find_bright_peaks() for large fields.
+
+        (data) is scanned in tiles of (tile_size) pixels on a side, each
+        extended to overlap its neighbors so that peaks on the tile
+        borders are found, but reported only once.  Only one tile at a
+        time is read (e.g. from a memory mapped file) and converted to
+        float.  A list of the peaks (x, y) found is yielded for each tile.
+        If threshold is blank, it is estimated from a sample of the data.
+
+        If (pool) is given, a multiprocessing.Pool owned by the caller,
+        tiles are processed by its worker processes; the results are
+        still yielded in order.
+        """
+        if threshold == None:
+            threshold = self.get_threshold(self.get_sample(data),
+                                           sigma=sigma)
+            self.logger.debug("threshold defaults to %f (sigma=%f)" % (
+                threshold, sigma))
+
+        ht, wd = data.shape
+        margin = 2 * radius
+
+        def tiles():
+            for y1 in xrange(0, ht, tile_size):
+                y2 = min(y1 + tile_size, ht)
+                for x1 in xrange(0, wd, tile_size):
+                    x2 = min(x1 + tile_size, wd)
+                    ex1, ey1 = max(x1 - margin, 0), max(y1 - margin, 0)
+                    ex2, ey2 = min(x2 + margin, wd), min(y2 + margin, ht)
+                    tile = data[ey1:ey2, ex1:ex2].astype(numpy.float32)
+                    yield (tile, threshold, radius, ex1, ey1,
+                           (x1, y1, x2, y2))
+
+        if pool == None:
+            for args in tiles():
+                yield _find_peaks_tile(args)
+            return
+
+        for peaks in pool.imap(_find_peaks_tile, tiles()):
+            yield peaks
+
 
     def cut_region(self, x, y, radius, data):
         """Return a cut region (radius) pixels away from (x, y) in (data).
@@ -216,14 +479,34 @@ class IQCalc(object):
         return float(res)
 
 
-    def fwhm_data(self, x, y, data, radius=15):
-        return self.get_fwhm(x, y, radius, data)
+    def fwhm_data(self, x, y, data, radius=15, medv=None):
+        return self.get_fwhm(x, y, radius, data, medv=medv)
 
 
     # EVALUATION ON A FIELD
     
     def evaluate_peaks(self, peaks, data, bright_radius=2, fwhm_radius=15,
-                       fwhm_method=1, cb_fn=None, ev_intr=None):
+                       fwhm_method=1, cb_fn=None, ev_intr=None,
+                       pool=None, median=None):
+        """Evaluate each of the candidate `peaks` (a list of (x, y)
+        tuples) in `data` and return a list of bunches describing the
+        objects that could be fit.
+
+        `cb_fn`, if given, is called with each object as it is evaluated,
+        and setting the event `ev_intr` interrupts the evaluation.
+
+        `fwhm_method` 1 fits each peak in turn with scipy; method 2 fits
+        them in vectorized batches (see fwhm_batch()), which is much
+        faster.  With method 1, if `pool` (a multiprocessing.Pool owned
+        by the caller) is given, the fitting is farmed out in batches to
+        its worker processes.
+
+        `median` is the background level of `data`; it is calculated if
+        it is not given.
+        """
+        if fwhm_method not in (1, 2):
+            raise IQCalcError("Method (%d) not supported for fwhm calculation!" %(
+                fwhm_method))
 
         height, width = data.shape
         hh = float(height) / 2.0
@@ -234,40 +517,23 @@ class IQCalc(object):
         w4 = float(width) * 4.0
 
         # Find the median (sky/background) level
-        median = float(numpy.median(data))
+        if median == None:
+            median = numpy.median(data)
+        median = float(median)
         #skylevel = median
         # Old SOSS qualsize() applied this calculation to skylevel
         skylevel = median * self.skylevel_magnification + self.skylevel_offset
 
-        # Form a list of objects and their characteristics
-        objlist = []
-        for x, y in peaks:
-            if ev_intr and ev_intr.isSet():
-                raise IQCalcError("Evaluation interrupted!")
-            
-            # Find the fwhm in x and y
-            try:
-                if fwhm_method == 1:
-                    (fwhm_x, fwhm_y, ctr_x, ctr_y,
-                     sdx, sdy, maxx, maxy) = self.fwhm_data(x, y, data,
-                                                            radius=fwhm_radius)
-
-                    ## # Average the X and Y gaussian fitting near the peak
-                    bx = self.gaussian(round(ctr_x), (ctr_x, sdx, maxx))
-                    by = self.gaussian(round(ctr_y), (ctr_y, sdy, maxy))
-                    ## ## bx = self.gaussian(ctr_x, (ctr_x, sdx, maxx))
-                    ## ## by = self.gaussian(ctr_y, (ctr_y, sdy, maxy))
-                    bright = float((bx + by)/2.0)
-
-                else:
-                    raise IQCalcError("Method (%d) not supported for fwhm calculation!" %(
-                        fwhm_method))
+        def make_obj(x, y, res):
+            (fwhm_x, fwhm_y, ctr_x, ctr_y,
+             sdx, sdy, maxx, maxy) = res
 
-            except Exception, e:
-                # Error doing FWHM, skip this object
-                self.logger.debug("Error doing FWHM on object at %.2f,%.2f: %s" % (
-                    x, y, str(e)))
-                continue
+            ## # Average the X and Y gaussian fitting near the peak
+            bx = self.gaussian(round(ctr_x), (ctr_x, sdx, maxx))
+            by = self.gaussian(round(ctr_y), (ctr_y, sdy, maxy))
+            ## ## bx = self.gaussian(ctr_x, (ctr_x, sdx, maxx))
+            ## ## by = self.gaussian(ctr_y, (ctr_y, sdy, maxy))
+            bright = float((bx + by)/2.0)
 
             self.logger.debug("orig=%f,%f  ctr=%f,%f  fwhm=%f,%f bright=%f" % (
                 x, y, ctr_x, ctr_y, fwhm_x, fwhm_y, bright))
@@ -296,6 +562,36 @@ class IQCalc(object):
                               brightness=bright, elipse=elipse,
                               x=int(x), y=int(y),
                               skylevel=skylevel, background=median)
+            return obj
+
+        if fwhm_method == 2:
+            return self._evaluate_peaks_batch(peaks, data, median,
+                                              fwhm_radius, make_obj,
+                                              cb_fn, ev_intr)
+
+        if pool != None:
+            return self._evaluate_peaks_parallel(peaks, data, median,
+                                                 fwhm_radius, make_obj,
+                                                 cb_fn, ev_intr, pool)
+
+        # Form a list of objects and their characteristics
+        objlist = []
+        for x, y in peaks:
+            if ev_intr and ev_intr.isSet():
+                raise IQCalcError("Evaluation interrupted!")
+            
+            # Find the fwhm in x and y
+            try:
+                res = self.fwhm_data(x, y, data, radius=fwhm_radius,
+                                     medv=median)
+                obj = make_obj(x, y, res)
+
+            except Exception, e:
+                # Error doing FWHM, skip this object
+                self.logger.debug("Error doing FWHM on object at %.2f,%.2f: %s" % (
+                    x, y, str(e)))
+                continue
+
             objlist.append(obj)
 
             if cb_fn != None:
@@ -303,6 +599,78 @@ class IQCalc(object):
 
         return objlist
 
+    def _evaluate_peaks_batch(self, peaks, data, median, fwhm_radius,
+                              make_obj, cb_fn, ev_intr):
+        objlist = []
+        for i in xrange(0, len(peaks), self.batch_size):
+            if ev_intr and ev_intr.isSet():
+                raise IQCalcError("Evaluation interrupted!")
+
+            batch = numpy.array(peaks[i:i+self.batch_size],
+                                dtype=numpy.float64)
+            res = self.fwhm_batch(batch[:, 0], batch[:, 1], data,
+                                  radius=fwhm_radius, medv=median)
+            for rec in res:
+                x, y = rec['x'], rec['y']
+                if not rec['ok']:
+                    self.logger.debug("Error doing FWHM on object at %.2f,%.2f" % (
+                        x, y))
+                    continue
+                obj = make_obj(x, y, (rec['fwhm_x'], rec['fwhm_y'],
+                                      rec['objx'], rec['objy'],
+                                      rec['sdx'], rec['sdy'],
+                                      rec['maxx'], rec['maxy']))
+                objlist.append(obj)
+
+                if cb_fn != None:
+                    cb_fn(obj)
+
+        return objlist
+
+    def _evaluate_peaks_parallel(self, peaks, data, median, fwhm_radius,
+                                 make_obj, cb_fn, ev_intr, pool):
+        # The cuts are small, so they are made here and only they are
+        # sent to the workers, rather than the data
+        cuts = []
+        for x, y in peaks:
+            x0, y0, xarr, yarr = self.cut_cross(x, y, fwhm_radius, data)
+            cuts.append((x0, y0, xarr, yarr, median))
+
+        # many small batches, to balance the load and give regular
+        # progress updates
+        batch_size = max(1, min(self.parallel_batch_size, len(cuts) // 64))
+        batches = [ cuts[i:i+batch_size]
+                    for i in xrange(0, len(cuts), batch_size) ]
+        self.logger.debug("evaluating %d peaks in %d batches" % (
+            len(peaks), len(batches)))
+
+        objlist = []
+        i = 0
+        for results in pool.imap(_fit_cuts_batch, batches):
+            for res in results:
+                x, y = peaks[i]
+                i += 1
+                if ev_intr and ev_intr.isSet():
+                    raise IQCalcError("Evaluation interrupted!")
+
+                try:
+                    if isinstance(res, basestring):
+                        raise IQCalcError(res)
+                    obj = make_obj(x, y, res)
+
+                except Exception, e:
+                    # Error doing FWHM, skip this object
+                    self.logger.debug("Error doing FWHM on object at %.2f,%.2f: %s" % (
+                        x, y, str(e)))
+                    continue
+
+                objlist.append(obj)
+
+                if cb_fn != None:
+                    cb_fn(obj)
+
+        return objlist
+
     # def _compare(self, obj1, obj2):
     #     val1 = obj1.brightness * obj1.pos/math.sqrt(obj1.fwhm)
     #     val2 = obj2.brightness * obj2.pos/math.sqrt(obj2.fwhm)
@@ -342,22 +710,47 @@ class IQCalc(object):
     def pick_field(self, data, peak_radius=5, bright_radius=2, fwhm_radius=15,
                    threshold=None,
                    minfwhm=2.0, maxfwhm=50.0, minelipse=0.5,
-                   edgew=0.01):
+                   edgew=0.01, fwhm_method=1, tile_size=None):
+        """Find the best object in (data) for measuring image quality.
 
+        If (tile_size) is given, the field is scanned in tiles of that
+        size (see iter_bright_peaks()) and the background is estimated
+        from a sample, so that fields too large to process at once (e.g.
+        whole memory mapped frames) can be handled.
+        """
         height, width = data.shape
 
-        # Find the bright peaks in the image
-        peaks = self.find_bright_peaks(data, radius=peak_radius,
-                                       threshold=threshold)
-        #print "peaks=", peaks
-        self.logger.info("peaks=%s" % str(peaks))
-        if len(peaks) == 0:
-            raise IQCalcError("Cannot find bright peaks")
-
-        # Evaluate those peaks
-        objlist = self.evaluate_peaks(peaks, data,
-                                      bright_radius=bright_radius,
-                                      fwhm_radius=fwhm_radius)
+        if tile_size == None:
+            # Find the bright peaks in the image
+            peaks = self.find_bright_peaks(data, radius=peak_radius,
+                                           threshold=threshold)
+            #print "peaks=", peaks
+            self.logger.info("peaks=%s" % str(peaks))
+            if len(peaks) == 0:
+                raise IQCalcError("Cannot find bright peaks")
+
+            # Evaluate those peaks
+            objlist = self.evaluate_peaks(peaks, data,
+                                          bright_radius=bright_radius,
+                                          fwhm_radius=fwhm_radius,
+                                          fwhm_method=fwhm_method)
+        else:
+            # Evaluate the peaks in each tile as they are found
+            median = numpy.median(self.get_sample(data))
+            num_peaks, objlist = 0, []
+            for peaks in self.iter_bright_peaks(data, radius=peak_radius,
+                                                threshold=threshold,
+                                                tile_size=tile_size):
+                num_peaks += len(peaks)
+                objlist.extend(self.evaluate_peaks(peaks, data,
+                                                   bright_radius=bright_radius,
+                                                   fwhm_radius=fwhm_radius,
+                                                   fwhm_method=fwhm_method,
+                                                   median=median))
+            self.logger.info("%d peaks found" % (num_peaks))
+            if num_peaks == 0:
+                raise IQCalcError("Cannot find bright peaks")
+
         if len(objlist) == 0:
             raise IQCalcError("Error evaluating bright peaks")
         
@@ -373,17 +766,28 @@ class IQCalc(object):
     def qualsize(self, image, x1=None, y1=None, x2=None, y2=None,
                  radius=5, bright_radius=2, fwhm_radius=15, threshold=None, 
                  minfwhm=2.0, maxfwhm=50.0, minelipse=0.5,
-                 edgew=0.01):
-        
+                 edgew=0.01, fwhm_method=1, tile_size=None):
+        """Find the best object in the region (x1, y1)-(x2, y2) of
+        `image` (by default, the whole image) for measuring image
+        quality.  See pick_field() for the meaning of `tile_size`.
+        """
+        width, height = image.get_size()
+        if x1 == None:
+            x1, y1, x2, y2 = 0, 0, width, height
         x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
-        data = image.cutout_data(x1, y1, x2, y2, astype='float32')
+        if tile_size == None:
+            data = image.cutout_data(x1, y1, x2, y2, astype='float32')
+        else:
+            # tiles are converted to float as they are scanned
+            data = image.cutout_data(x1, y1, x2, y2)
 
         qs = self.pick_field(data, peak_radius=radius,
                              bright_radius=bright_radius,
                              fwhm_radius=fwhm_radius,
                              threshold=threshold,
                              minfwhm=minfwhm, maxfwhm=maxfwhm,
-                             minelipse=minelipse, edgew=edgew)
+                             minelipse=minelipse, edgew=edgew,
+                             fwhm_method=fwhm_method, tile_size=tile_size)
 
         # Add back in offsets into image to get correct values with respect
         # to the entire image
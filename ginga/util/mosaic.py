@@ -1,6 +1,6 @@
 #! /usr/bin/env python
 #
-# mosaic.py -- Example of quick and dirty mosaicing of FITS images
+# mosaic.py -- Mosaicing of FITS images according to their WCS
 #
 # Eric Jeschke (eric@naoj.org)
 #
@@ -8,29 +8,653 @@
 # This is open-source software licensed under a BSD license.
 # Please see the file LICENSE.txt for details.
 #
+"""
+Builds a mosaic of FITS images, which may number in the thousands and
+together be larger than memory.
+
+The mosaic is made in two passes.  The first reads only the headers of
+the files, and works out the footprint of each image on the pixel grid
+of a reference image (by default the first one), and from them the
+extent of the mosaic.  The second reprojects each image onto its part
+of the mosaic grid, with bilinear (or nearest neighbor) resampling,
+and adds it into the output, which can be a FITS file that is memory
+mapped rather than held in memory.  The images are reprojected in
+parallel by worker processes.
+
+A map of the weight (number of images) contributing to each pixel is
+kept, and the mosaic is the weighted mean of the images.  Pixels not
+covered by any image are NaN.
+
+Usage:
+  $ mosaic.py -o mosaic.fits [--weight-out=weight.fits] file1.fits ...
+  $ find . -name '*.fits' | mosaic.py -o mosaic.fits --list=-
+"""
 import sys, os
-import logging
+import math
+import time
+import logging, logging.handlers
+import threading
+import multiprocessing
+import numpy
+
 from ginga import AstroImage
-from ginga.util import io_fits
-io_fits.use('astropy')
+from ginga.misc import Bunch
+from ginga.misc.log import NullLogger
+from ginga.util import wcs
+
+# NOTE: the files are read with astropy/pyfits directly, rather than
+# through io_fits, to get at the headers without loading the data
+try:
+    from astropy.io import fits as pyfits
+except ImportError:
+    import pyfits
 
 STD_FORMAT = '%(asctime)s | %(levelname)1.1s | %(filename)s:%(lineno)d (%(funcName)s) | %(message)s'
 
+# header keywords describing the data layout, which are not copied from
+# the reference image to the mosaic
+structural_kwds = set(['SIMPLE', 'BITPIX', 'NAXIS', 'EXTEND', 'XTENSION',
+                       'PCOUNT', 'GCOUNT', 'BZERO', 'BSCALE', 'BLANK',
+                       'CHECKSUM', 'DATASUM', 'END', 'COMMENT', 'HISTORY',
+                       ''])
+
+
+class MosaicError(Exception):
+    pass
+
+
+def get_header(filepath, numhdu=None):
+    """Returns (header, numhdu) for the first image HDU in `filepath` (or
+    HDU `numhdu`), where header is a dict.  The data is not read.
+    """
+    fits_f = pyfits.open(filepath, 'readonly', memmap=True)
+    try:
+        if numhdu == None:
+            for i in xrange(len(fits_f)):
+                if fits_f[i].header.get('NAXIS', 0) >= 2:
+                    numhdu = i
+                    break
+            else:
+                raise MosaicError("No image HDU found in '%s'" % (filepath))
+        header = dict(fits_f[numhdu].header.items())
+    finally:
+        fits_f.close()
+    return (header, numhdu)
+
+
+def get_data(filepath, numhdu):
+    """Returns the first 2D plane of the data in HDU `numhdu` of
+    `filepath`.
+    """
+    fits_f = pyfits.open(filepath, 'readonly', memmap=True)
+    try:
+        data = fits_f[numhdu].data
+        while len(data.shape) > 2:
+            data = data[0]
+        # NOTE: gets the data into memory, as the file is closed
+        data = numpy.array(data, dtype=numpy.float32)
+    finally:
+        fits_f.close()
+    return data
 
-def mosaic(paths, logger, outfile=None):
-    logger.info("Mosaicing images...")
-    image = AstroImage.AstroImage(logger=logger)
-    mosaic = image.mosaic(paths)
 
-    if outfile:
+def make_wcs(header):
+    wcsobj = wcs.WCS(NullLogger())
+    wcsobj.load_header(header)
+    return wcsobj
+
+
+def _naxispath(header):
+    # extra axes beyond the first two are taken at their first plane
+    return [0] * max(int(header.get('NAXIS', 2)) - 2, 0)
+
+def pixtopix(src_wcs, src_header, dst_wcs, dst_header, pts):
+    """Transform an N x 2 array of pixel coordinates in the image
+    described by `src_wcs` to pixel coordinates in the image described
+    by `dst_wcs`.
+    """
+    pts = numpy.asarray(pts, dtype=numpy.float_)
+    naxispath = _naxispath(src_header)
+    if len(naxispath) > 0:
+        extra = numpy.zeros((len(pts), len(naxispath)))
+        pts = numpy.hstack((pts, extra))
+    radec = src_wcs.pixtoradec_many(pts)
+    return dst_wcs.radectopix_many(radec, naxispath=_naxispath(dst_header))
+
+
+def get_footprint(header, src_wcs, ref_header, ref_wcs, num=8):
+    """Returns an array of points around the edge of the image described
+    by `header`, in the pixel coordinates of the reference image.  `num`
+    points are taken along each side, to allow for distortion.
+    """
+    wd, ht = int(header['NAXIS1']), int(header['NAXIS2'])
+    xs = numpy.linspace(-0.5, wd - 0.5, num + 1)
+    ys = numpy.linspace(-0.5, ht - 0.5, num + 1)
+    pts = numpy.vstack((numpy.column_stack((xs, ys[0] + 0 * xs)),
+                        numpy.column_stack((xs, ys[-1] + 0 * xs)),
+                        numpy.column_stack((xs[0] + 0 * ys, ys)),
+                        numpy.column_stack((xs[-1] + 0 * ys, ys))))
+    return pixtopix(src_wcs, header, ref_wcs, ref_header, pts)
+
+
+def get_bbox(pts, tol=1.0e-6):
+    """Returns the region (x1, y1, x2, y2) of pixels whose centers lie
+    within the footprint `pts` (x2 and y2 exclusive).  Footprint points
+    within `tol` pixels of a pixel edge are taken to lie on it.
+    """
+    # footprints of images on the same grid fall exactly on pixel edges,
+    # where rounding errors of the transforms would add or drop pixels
+    pts = numpy.round(pts / tol) * tol
+    x1 = int(math.floor(pts[:, 0].min() + 0.5))
+    y1 = int(math.floor(pts[:, 1].min() + 0.5))
+    x2 = int(math.ceil(pts[:, 0].max() - 0.5)) + 1
+    y2 = int(math.ceil(pts[:, 1].max() - 0.5)) + 1
+    return (x1, y1, x2, y2)
+
+
+def plan_mosaic(paths, logger, numhdu=None, ref_path=None):
+    """Work out the extent of the mosaic of the images in `paths` (an
+    iterable of file paths), from their headers.  The mosaic has the
+    pixel grid of the image in `ref_path` (by default the first one).
+
+    Returns a tuple (header, tiles), where header (a dict) describes the
+    mosaic, and tiles is a list of (path, numhdu, header, bbox) for the
+    images, where bbox (x1, y1, x2, y2) is the region of the mosaic that
+    each covers (x2 and y2 exclusive).
+    """
+    ref_header = ref_wcs = None
+    if ref_path != None:
+        ref_header, n = get_header(ref_path, numhdu=numhdu)
+        ref_wcs = make_wcs(ref_header)
+
+    tiles = []
+    xmin = ymin = xmax = ymax = None
+    time_start = time.time()
+    for path in paths:
         try:
-            os.remove(outfile)
-        except:
+            header, n = get_header(path, numhdu=numhdu)
+            src_wcs = make_wcs(header)
+            if ref_header == None:
+                ref_header, ref_wcs = header, src_wcs
+            pts = get_footprint(header, src_wcs, ref_header, ref_wcs)
+            if not numpy.all(numpy.isfinite(pts)):
+                raise MosaicError("WCS gives no position for the image")
+
+        except Exception, e:
+            logger.warn("Skipping '%s': %s" % (path, str(e)))
+            continue
+
+        x1, y1, x2, y2 = get_bbox(pts)
+        tiles.append((path, n, header, (x1, y1, x2, y2)))
+
+        if xmin == None:
+            xmin, ymin, xmax, ymax = x1, y1, x2, y2
+        else:
+            xmin, ymin = min(xmin, x1), min(ymin, y1)
+            xmax, ymax = max(xmax, x2), max(ymax, y2)
+
+        if len(tiles) % 1000 == 0:
+            logger.info("%d headers read" % (len(tiles)))
+
+    if len(tiles) == 0:
+        raise MosaicError("No images to mosaic")
+
+    # relocate the mosaic so that it starts at pixel 0
+    xoff, yoff = -xmin, -ymin
+    width, height = xmax - xmin, ymax - ymin
+    tiles = [ (p, hdu, hdr, (bx1 + xoff, by1 + yoff, bx2 + xoff, by2 + yoff))
+              for p, hdu, hdr, (bx1, by1, bx2, by2) in tiles ]
+
+    header = {}
+    for key, value in ref_header.items():
+        if (key in structural_kwds) or key.startswith('NAXIS'):
+            continue
+        header[key] = value
+    header.update(dict(NAXIS=2, NAXIS1=width, NAXIS2=height,
+                       CRPIX1=float(ref_header['CRPIX1']) + xoff,
+                       CRPIX2=float(ref_header['CRPIX2']) + yoff))
+
+    logger.info("mosaic of %d images is %dx%d (%.3f sec to plan)" % (
+        len(tiles), width, height, time.time() - time_start))
+    return (header, tiles)
+
+
+def _interp_grid(gx, gy, vals, xs, ys):
+    # bilinear interpolation of `vals` given on the grid `gx` x `gy` to
+    # all of the points in the grid `xs` x `ys`
+    jx = numpy.clip(numpy.searchsorted(gx, xs, side='right') - 1,
+                    0, len(gx) - 2)
+    fx = (xs - gx[jx]) / (gx[jx+1] - gx[jx])
+    iy = numpy.clip(numpy.searchsorted(gy, ys, side='right') - 1,
+                    0, len(gy) - 2)
+    fy = ((ys - gy[iy]) / (gy[iy+1] - gy[iy]))[:, numpy.newaxis]
+    rows = vals[:, jx] * (1.0 - fx) + vals[:, jx+1] * fx
+    return rows[iy] * (1.0 - fy) + rows[iy+1] * fy
+
+def _grid_points(p1, p2, step):
+    # points from p1 to p2-1 every `step` pixels, always including the
+    # ends (and at least two points)
+    pts = range(p1, p2, step)
+    if pts[-1] != p2 - 1:
+        pts.append(p2 - 1)
+    if len(pts) < 2:
+        pts.append(pts[-1] + 1)
+    return numpy.array(pts, dtype=numpy.float_)
+
+def map_coords(src_wcs, src_header, dst_wcs, dst_header, bbox,
+               grid_step=16):
+    """Returns arrays (xs, ys) with the pixel coordinates in the source
+    image of each pixel in region `bbox` of the destination image.  The
+    WCS transformations are calculated every `grid_step` pixels and
+    interpolated in between.
+    """
+    x1, y1, x2, y2 = bbox
+    gx = _grid_points(x1, x2, grid_step)
+    gy = _grid_points(y1, y2, grid_step)
+    pts = numpy.array(numpy.meshgrid(gx, gy)).reshape((2, -1)).T
+    res = pixtopix(dst_wcs, dst_header, src_wcs, src_header, pts)
+    shape = (len(gy), len(gx))
+    xs = numpy.arange(x1, x2, dtype=numpy.float_)
+    ys = numpy.arange(y1, y2, dtype=numpy.float_)
+    return (_interp_grid(gx, gy, res[:, 0].reshape(shape), xs, ys),
+            _interp_grid(gx, gy, res[:, 1].reshape(shape), xs, ys))
+
+
+def resample(data, xs, ys, method='bilinear'):
+    """Sample `data` at the (fractional) pixel coordinates in arrays
+    `xs` and `ys`.  Returns (values, weights), where weights is 1 where
+    the value is valid and 0 where it falls outside of the data or on a
+    non-finite pixel (and is set to 0).
+    """
+    ht, wd = data.shape
+    inside = ((xs >= -0.5) & (xs < wd - 0.5) &
+              (ys >= -0.5) & (ys < ht - 0.5))
+
+    if method == 'nearest':
+        xi = numpy.clip(numpy.floor(xs + 0.5).astype(numpy.int), 0, wd - 1)
+        yi = numpy.clip(numpy.floor(ys + 0.5).astype(numpy.int), 0, ht - 1)
+        values = data[yi, xi]
+        good = inside & numpy.isfinite(values)
+        weights = good.astype(numpy.float32)
+        values = numpy.where(good, values, 0.0).astype(numpy.float32)
+        return (values, weights)
+
+    if method != 'bilinear':
+        raise MosaicError("Unknown resampling method '%s'" % (method))
+
+    # pixels either side, with the fractions clipped at the edges
+    x0 = numpy.clip(numpy.floor(xs).astype(numpy.int), 0, max(wd - 2, 0))
+    y0 = numpy.clip(numpy.floor(ys).astype(numpy.int), 0, max(ht - 2, 0))
+    x1 = numpy.minimum(x0 + 1, wd - 1)
+    y1 = numpy.minimum(y0 + 1, ht - 1)
+    fx = numpy.clip(xs - x0, 0.0, 1.0)
+    fy = numpy.clip(ys - y0, 0.0, 1.0)
+
+    values = numpy.zeros(xs.shape, dtype=numpy.float_)
+    wsum = numpy.zeros(xs.shape, dtype=numpy.float_)
+    for yi, xi, w in ((y0, x0, (1.0 - fx) * (1.0 - fy)),
+                      (y0, x1, fx * (1.0 - fy)),
+                      (y1, x0, (1.0 - fx) * fy),
+                      (y1, x1, fx * fy)):
+        v = data[yi, xi]
+        # leave out non-finite pixels, and renormalize the rest
+        good = numpy.isfinite(v)
+        w = numpy.where(good, w, 0.0)
+        values += numpy.where(good, v, 0.0) * w
+        wsum += w
+
+    good = inside & (wsum > 0.0)
+    values = numpy.where(good, values / numpy.where(good, wsum, 1.0), 0.0)
+    return (values.astype(numpy.float32), good.astype(numpy.float32))
+
+
+def reproject_tile(path, numhdu, header, out_header, bbox,
+                   method='bilinear', grid_step=16):
+    """Reproject one image onto region `bbox` of the mosaic described by
+    `out_header`.  Returns (values, weights) arrays for the region.
+    """
+    data = get_data(path, numhdu)
+    src_wcs = make_wcs(header)
+    dst_wcs = make_wcs(out_header)
+    xs, ys = map_coords(src_wcs, header, dst_wcs, out_header, bbox,
+                        grid_step=grid_step)
+    return resample(data, xs, ys, method=method)
+
+def _reproject_tile(args):
+    # for use by worker processes: errors are returned, rather than
+    # raised, so that one bad file doesn't stop the mosaic
+    path, numhdu, header, out_header, bbox, method, grid_step = args
+    try:
+        values, weights = reproject_tile(path, numhdu, header, out_header,
+                                         bbox, method=method,
+                                         grid_step=grid_step)
+        return (path, bbox, values, weights, None)
+    except Exception, e:
+        return (path, bbox, None, None, str(e))
+
+
+def create_fits(path, header, width, height):
+    """Create a FITS file at `path` for a `width` x `height` float32
+    image, without writing the data.  Returns a writable memory map of
+    the data, which is all zeros.
+    """
+    hdr = pyfits.Header()
+    hdr['SIMPLE'] = True
+    hdr['BITPIX'] = -32
+    hdr['NAXIS'] = 2
+    hdr['NAXIS1'] = width
+    hdr['NAXIS2'] = height
+    for key, value in header.items():
+        if (key in structural_kwds) or key.startswith('NAXIS'):
+            continue
+        try:
+            hdr[key] = value
+        except Exception:
+            # not something that can go in a FITS header
             pass
-        logger.info("Writing mosaic file to %s ..." % (outfile))
-        mosaic.write_fits(outfile)
-        
-        
+    buf = hdr.tostring()
+
+    # data is padded to a multiple of the FITS block size
+    nbytes = width * height * 4
+    nbytes = int(math.ceil(nbytes / 2880.0)) * 2880
+    with open(path, 'wb') as out_f:
+        out_f.write(buf)
+        # leave the rest of the file sparse (zeros)
+        out_f.seek(len(buf) + nbytes - 1)
+        out_f.write('\0')
+
+    return numpy.memmap(path, dtype='>f4', mode='r+', offset=len(buf),
+                        shape=(height, width))
+
+
+def make_mosaic(paths, logger, outfile=None, weightfile=None,
+                num_workers=1, method='bilinear', grid_step=16,
+                numhdu=None, ref_path=None, block_rows=1024):
+    """Make a mosaic of the FITS images in `paths` (an iterable of file
+    paths).  If `outfile` is given the mosaic is written to it as it is
+    made, otherwise it is made in memory.  Likewise the weight map is
+    written to `weightfile`, if given.  The images are reprojected by
+    `num_workers` processes, with resampling `method` ('bilinear' or
+    'nearest').  See plan_mosaic() for `numhdu` and `ref_path`.
+
+    Returns the mosaic as an AstroImage (with the data memory mapped
+    from `outfile`, if given).
+    """
+    header, tiles = plan_mosaic(paths, logger, numhdu=numhdu,
+                                ref_path=ref_path)
+    width, height = header['NAXIS1'], header['NAXIS2']
+
+    # running sums of the weighted values and the weights
+    tmpfile = None
+    if outfile != None:
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        outsum = create_fits(outfile, header, width, height)
+    else:
+        outsum = numpy.zeros((height, width), dtype=numpy.float32)
+    if weightfile != None:
+        if os.path.exists(weightfile):
+            os.remove(weightfile)
+        outwt = create_fits(weightfile, header, width, height)
+    elif outfile != None:
+        # don't hold the weights in memory either
+        tmpfile = outfile + '.weight.tmp'
+        outwt = numpy.memmap(tmpfile, dtype=numpy.float32, mode='w+',
+                             shape=(height, width))
+    else:
+        outwt = numpy.zeros((height, width), dtype=numpy.float32)
+
+    def tasks():
+        for path, n, hdr, bbox in tiles:
+            yield (path, n, hdr, header, bbox, method, grid_step)
+
+    time_start = time.time()
+    pool = None
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers)
+        results = pool.imap_unordered(_reproject_tile, tasks())
+    else:
+        results = (_reproject_tile(args) for args in tasks())
+
+    try:
+        num_done = 0
+        for path, bbox, values, weights, errmsg in results:
+            num_done += 1
+            if errmsg != None:
+                logger.error("Failed to place image '%s': %s" % (
+                    path, errmsg))
+                continue
+
+            x1, y1, x2, y2 = bbox
+            outsum[y1:y2, x1:x2] += values * weights
+            outwt[y1:y2, x1:x2] += weights
+
+            if num_done % 100 == 0:
+                logger.info("%d/%d images placed (%.1f sec)" % (
+                    num_done, len(tiles), time.time() - time_start))
+    finally:
+        if pool != None:
+            pool.terminate()
+            pool.join()
+
+    # turn the sums into means, a block of rows at a time
+    for y1 in xrange(0, height, block_rows):
+        y2 = min(y1 + block_rows, height)
+        wts = outwt[y1:y2]
+        good = wts > 0
+        outsum[y1:y2] = numpy.where(good,
+                                    outsum[y1:y2] / numpy.where(good, wts,
+                                                                1.0),
+                                    numpy.nan)
+    logger.info("mosaic of %d images made in %.3f sec" % (
+        len(tiles), time.time() - time_start))
+
+    image = AstroImage.AstroImage(logger=logger)
+    if outfile != None:
+        outsum.flush()
+        del outsum
+        if isinstance(outwt, numpy.memmap):
+            outwt.flush()
+        del outwt
+        if tmpfile != None:
+            os.remove(tmpfile)
+        image.load_file(outfile, memmap=True)
+    else:
+        image.set_data(outsum)
+        image.update_keywords(header)
+        image.set(weight=outwt)
+    return image
+
+
+class LiveMosaic(object):
+    """A mosaic that images are added to one at a time (e.g. as they
+    are taken) while it is displayed.
+
+    The mosaic has the pixel grid of the first image added (or the
+    header given to set_reference()).  Its data is allocated in blocks
+    of `chunk_size` pixels on a side, so that it only needs to be
+    reallocated when an image falls outside of the blocks allocated so
+    far.  Pixels not covered by any image are NaN.
+
+    Adding an image is done in two steps: reproject() does the work of
+    resampling the image onto the mosaic grid and may be called from a
+    worker thread, then blend() adds the result to the mosaic, and must
+    be called from the thread that displays the mosaic.  blend() updates
+    the mosaic image in place with update_region(), so that viewers only
+    redraw the part of it that changed, unless the mosaic had to grow.
+    """
+
+    def __init__(self, logger, name='mosaic', chunk_size=1024,
+                 method='bilinear', grid_step=16):
+        self.logger = logger
+        self.name = name
+        self.chunk_size = chunk_size
+        self.method = method
+        self.grid_step = grid_step
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        """Start a new mosaic."""
+        with self.lock:
+            self.image = None
+            self.weight = None
+            self.ref_header = None
+            self.ref_wcs = None
+            # reference pixel coordinates of the mosaic pixel 0, 0
+            self.x0 = self.y0 = 0
+            self.count = 0
+
+    def get_image(self):
+        """Returns the mosaic as an AstroImage, or None if no images
+        have been added yet.
+        """
+        return self.image
+
+    def get_weight(self):
+        return self.weight
+
+    def set_reference(self, header):
+        """Use the pixel grid described by `header` (a dict) for the
+        mosaic.  Must be called before any images are added.
+        """
+        header = dict([ (key, value) for key, value in header.items()
+                        if not ((key in structural_kwds) or
+                                key.startswith('NAXIS')) ])
+        with self.lock:
+            self.ref_header = header
+            self.ref_wcs = make_wcs(header)
+
+    def reproject(self, image):
+        """Reproject AstroImage `image` onto the pixel grid of the
+        mosaic.  Returns a Bunch with the region (`bbox`) of the grid
+        covered, and the resampled `data` and `weights` for it.
+        """
+        header = image.get_header().asdict()
+        with self.lock:
+            if self.ref_header == None:
+                self.set_reference(header)
+            ref_header, ref_wcs = self.ref_header, self.ref_wcs
+
+        src_wcs = make_wcs(header)
+        pts = get_footprint(header, src_wcs, ref_header, ref_wcs)
+        if not numpy.all(numpy.isfinite(pts)):
+            raise MosaicError("WCS gives no position for the image")
+        bbox = get_bbox(pts)
+
+        data = image.get_data()
+        while len(data.shape) > 2:
+            data = data[0]
+        xs, ys = map_coords(src_wcs, header, ref_wcs, ref_header, bbox,
+                            grid_step=self.grid_step)
+        values, weights = resample(data, xs, ys, method=self.method)
+        return Bunch.Bunch(name=image.get('name', 'NoName'), bbox=bbox,
+                           data=values, weights=weights)
+
+    def _chunk_range(self, p1, p2):
+        # range of whole chunks covering p1 to p2
+        n = self.chunk_size
+        return ((p1 // n) * n, -(-p2 // n) * n)
+
+    def blend(self, res):
+        """Add an image reprojected by reproject() to the mosaic.
+        Returns a Bunch with the region of the mosaic updated (`bbox`),
+        whether the mosaic grew (`grown`) and if so, the amount that its
+        existing pixels moved by (`shift`) as it grew.
+        """
+        x1, y1, x2, y2 = res.bbox
+        with self.lock:
+            image = self.image
+            if image == None:
+                x0, xe = self._chunk_range(x1, x2)
+                y0, ye = self._chunk_range(y1, y2)
+                ht, wd = 0, 0
+            else:
+                ht, wd = self.weight.shape
+                x0, xe = self._chunk_range(min(x1, self.x0),
+                                           max(x2, self.x0 + wd))
+                y0, ye = self._chunk_range(min(y1, self.y0),
+                                           max(y2, self.y0 + ht))
+            grown = (x0, y0, xe - x0, ye - y0) != (self.x0, self.y0, wd, ht)
+            shift = (self.x0 - x0, self.y0 - y0)
+
+            if grown:
+                self.logger.debug("growing mosaic to %dx%d" % (
+                    xe - x0, ye - y0))
+                data = numpy.empty((ye - y0, xe - x0), dtype=numpy.float32)
+                data.fill(numpy.nan)
+                weight = numpy.zeros((ye - y0, xe - x0),
+                                     dtype=numpy.float32)
+                if image != None:
+                    dx, dy = shift
+                    data[dy:dy+ht, dx:dx+wd] = image.get_data()
+                    weight[dy:dy+ht, dx:dx+wd] = self.weight
+                self.x0, self.y0 = x0, y0
+                self.weight = weight
+            else:
+                data = image.get_data()
+
+            # weighted mean of the pixels already there and the new ones
+            cx1, cy1, cx2, cy2 = x1 - x0, y1 - y0, x2 - x0, y2 - y0
+            old_wts = self.weight[cy1:cy2, cx1:cx2]
+            old_vals = data[cy1:cy2, cx1:cx2]
+            wts = old_wts + res.weights
+            good = wts > 0
+            vals = (numpy.where(old_wts > 0, old_vals, 0.0) * old_wts +
+                    res.data * res.weights)
+            data[cy1:cy2, cx1:cx2] = numpy.where(
+                good, vals / numpy.where(good, wts, 1.0), old_vals)
+            self.weight[cy1:cy2, cx1:cx2] = wts
+            self.count += 1
+
+            if not grown:
+                image.update_region(cx1, cy1, cx2, cy2)
+            else:
+                header = dict(self.ref_header)
+                header.update(dict(NAXIS=2, NAXIS1=xe - x0, NAXIS2=ye - y0,
+                                   CRPIX1=float(header['CRPIX1']) - x0,
+                                   CRPIX2=float(header['CRPIX2']) - y0))
+                if image == None:
+                    image = AstroImage.AstroImage(data, logger=self.logger)
+                    image.set(name=self.name)
+                    image.update_keywords(header)
+                    self.image = image
+                else:
+                    # WCS is updated first, for viewers redrawing on
+                    # the change of data
+                    image.update_keywords(header)
+                    image.set_data(data)
+
+        return Bunch.Bunch(bbox=(cx1, cy1, cx2, cy2), grown=grown,
+                           shift=shift)
+
+    def add_image(self, image):
+        """Reproject AstroImage `image` and add it to the mosaic.  See
+        blend() for the return value.
+        """
+        return self.blend(self.reproject(image))
+
+
+def mosaic(paths, logger, outfile=None, **kwdargs):
+    logger.info("Mosaicing images...")
+    return make_mosaic(paths, logger, outfile=outfile, **kwdargs)
+
+
+def _read_paths(listfile):
+    # yields the paths listed one per line in `listfile` ('-' for stdin)
+    if listfile == '-':
+        in_f = sys.stdin
+    else:
+        in_f = open(listfile, 'r')
+    try:
+        for line in in_f:
+            line = line.strip()
+            if len(line) > 0 and not line.startswith('#'):
+                yield line
+    finally:
+        if in_f != sys.stdin:
+            in_f.close()
+
 def main(options, args):
 
     logger = logging.getLogger("mosaic")
@@ -48,30 +672,56 @@ def main(options, args):
         stderrHdlr.setFormatter(fmt)
         logger.addHandler(stderrHdlr)
 
-    if len(args) > 0:
-        mosaic(args, logger, outfile=options.outfile)
-        
-    
+    paths = list(args)
+    if options.listfile:
+        paths.extend(_read_paths(options.listfile))
+
+    if len(paths) > 0:
+        num_workers = options.workers
+        if num_workers == None:
+            num_workers = multiprocessing.cpu_count()
+        mosaic(paths, logger, outfile=options.outfile,
+               weightfile=options.weightfile, num_workers=num_workers,
+               method=options.method, grid_step=options.grid_step,
+               numhdu=options.numhdu, ref_path=options.ref_path)
+
+
 if __name__ == "__main__":
-   
+
     # Parse command line options with nifty optparse module
     from optparse import OptionParser
 
     usage = "usage: %prog [options] cmd [args]"
     optprs = OptionParser(usage=usage, version=('%%prog'))
-    
+
     optprs.add_option("--debug", dest="debug", default=False, action="store_true",
                       help="Enter the pdb debugger on main()")
+    optprs.add_option("--grid-step", dest="grid_step", type='int',
+                      default=16, metavar="NUM",
+                      help="Calculate the WCS every NUM pixels")
+    optprs.add_option("--hdu", dest="numhdu", type='int', default=None,
+                      metavar="NUM", help="Use HDU NUM of each file")
+    optprs.add_option("--list", dest="listfile", metavar="FILE",
+                      help="Read paths of images, one per line, from FILE ('-' for stdin)")
     optprs.add_option("--log", dest="logfile", metavar="FILE",
                       help="Write logging output to FILE")
     optprs.add_option("--loglevel", dest="loglevel", metavar="LEVEL",
                       type='int', default=logging.INFO,
                       help="Set logging level to LEVEL")
+    optprs.add_option("--method", dest="method", default='bilinear',
+                      help="Resample with METHOD (bilinear|nearest)")
     optprs.add_option("-o", "--outfile", dest="outfile", metavar="FILE",
                       help="Write mosaic output to FILE")
+    optprs.add_option("--ref", dest="ref_path", metavar="FILE",
+                      help="Use the pixel grid of FILE for the mosaic")
     optprs.add_option("--stderr", dest="logstderr", default=False,
                       action="store_true",
                       help="Copy logging also to stderr")
+    optprs.add_option("--weight-out", dest="weightfile", metavar="FILE",
+                      help="Write weight map to FILE")
+    optprs.add_option("--workers", dest="workers", type='int',
+                      default=None, metavar="NUM",
+                      help="Reproject images with NUM processes")
     optprs.add_option("--profile", dest="profile", action="store_true",
                       default=False,
                       help="Run the profiler on main()")
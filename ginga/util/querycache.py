@@ -0,0 +1,408 @@
+#
+# querycache.py -- on-disk cache of catalog and image server queries
+#
+# Eric Jeschke (eric@naoj.org)
+#
+# Copyright (c) Eric R. Jeschke.  All rights reserved.
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+Results of queries to catalog and image servers are kept in a directory,
+one file per query, named by a hash of the server key and the query
+parameters.  Entries expire after a time-to-live and the least recently
+used ones are removed when the cache grows beyond its size limit.
+
+A cache in offline mode never lets a query go to the network, and
+serves its entries regardless of their age.  This allows a session to be
+replayed from a directory of cached results, e.g. one copied from the
+observing machine.
+
+`LocalServer` is an HTTP server for a local directory, which can stand
+in for a remote server (e.g. for testing).
+"""
+import os
+import time
+import json
+import hashlib
+import shutil
+import tempfile
+import threading
+import cPickle as pickle
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+import urllib
+import posixpath
+
+
+class QueryCacheError(Exception):
+    pass
+
+
+def normalize_params(params):
+    """Returns a canonical string for a set of query parameters (a dict
+    or a string such as a URL), so that equivalent queries give the same
+    cache key.
+    """
+    if isinstance(params, basestring):
+        return params.strip()
+
+    res = []
+    for key, value in params.items():
+        if isinstance(value, float):
+            value = '%.10g' % value
+        else:
+            value = str(value).strip()
+        res.append('%s=%s' % (str(key).lower(), value))
+    res.sort()
+    return '&'.join(res)
+
+
+class QueryCache(object):
+    """A persistent cache of query results in directory `cachedir`.
+
+    Entries older than `ttl` seconds are ignored (None: they never
+    expire).  If `maxsize` (bytes) is given, the least recently used
+    entries are removed to keep the cache within it.  If `offline` is
+    True, entries never expire and `check_online` raises an error.
+    """
+
+    def __init__(self, logger, cachedir, ttl=None, maxsize=None,
+                 offline=False):
+        self.logger = logger
+        self.cachedir = cachedir
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.offline = offline
+        self.lock = threading.RLock()
+
+    def make_key(self, server_key, params):
+        """Returns the cache key for a query to a server."""
+        text = '%s|%s' % (server_key, normalize_params(params))
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def _get_paths(self, key):
+        path = os.path.join(self.cachedir, key)
+        return (path + '.dat', path + '.json')
+
+    def check_online(self):
+        """Raises an error if the cache is offline, i.e. queries that are
+        not in the cache cannot be made.
+        """
+        if self.offline:
+            raise QueryCacheError("Query is not in the cache and the "
+                                  "cache is offline")
+
+    def lookup(self, key):
+        """Returns the path of the file holding the entry for `key`, or
+        None if there is no such entry or it has expired.
+        """
+        datapath, metapath = self._get_paths(key)
+        with self.lock:
+            if not os.path.exists(datapath):
+                return None
+
+            if (not self.offline) and (self.ttl != None):
+                try:
+                    with open(metapath, 'r') as in_f:
+                        meta = json.load(in_f)
+                    created = meta['time']
+                except Exception:
+                    created = os.path.getmtime(datapath)
+                if time.time() - created > self.ttl:
+                    self.logger.debug("cache entry %s has expired" % (key))
+                    self.remove(key)
+                    return None
+
+            # mark entry as recently used
+            try:
+                os.utime(datapath, None)
+            except OSError:
+                # cache may be read-only (e.g. a replay directory)
+                pass
+            return datapath
+
+    def get_data(self, key):
+        """Returns the data cached for `key`, or None."""
+        path = self.lookup(key)
+        if path == None:
+            return None
+        with open(path, 'rb') as in_f:
+            data = in_f.read()
+        self.logger.debug("read %d bytes from cache" % (len(data)))
+        return data
+
+    def get_object(self, key):
+        """Returns the object cached for `key`, or None."""
+        data = self.get_data(key)
+        if data == None:
+            return None
+        try:
+            return pickle.loads(data)
+        except Exception, e:
+            self.logger.warn("Error loading cached object: %s" % (str(e)))
+            return None
+
+    def get_file(self, key, dstpath):
+        """Copies the file cached for `key` to `dstpath`.  Returns
+        `dstpath`, or None if there is no entry.
+        """
+        path = self.lookup(key)
+        if path == None:
+            return None
+        shutil.copyfile(path, dstpath)
+        return dstpath
+
+    def _write(self, key, write_fn, meta):
+        datapath, metapath = self._get_paths(key)
+        with self.lock:
+            if not os.path.isdir(self.cachedir):
+                os.makedirs(self.cachedir)
+
+            # write to temporary files and rename, so that a partly
+            # written entry is never seen
+            fd, tmppath = tempfile.mkstemp(dir=self.cachedir,
+                                           suffix='.tmp')
+            with os.fdopen(fd, 'wb') as out_f:
+                write_fn(out_f)
+            os.rename(tmppath, datapath)
+
+            meta = dict(meta)
+            meta['time'] = time.time()
+            fd, tmppath = tempfile.mkstemp(dir=self.cachedir,
+                                           suffix='.tmp')
+            with os.fdopen(fd, 'w') as out_f:
+                json.dump(meta, out_f)
+            os.rename(tmppath, metapath)
+
+            self._eject_old()
+
+    def put_data(self, key, data, **meta):
+        """Cache `data` (a string) for `key`.  Keyword arguments are
+        saved with the entry, for information.
+        """
+        self._write(key, lambda out_f: out_f.write(data), meta)
+
+    def put_object(self, key, obj, **meta):
+        """Cache `obj`, which must be picklable, for `key`."""
+        data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        self.put_data(key, data, **meta)
+
+    def put_file(self, key, srcpath, **meta):
+        """Cache a copy of file `srcpath` for `key`."""
+        def write_fn(out_f):
+            with open(srcpath, 'rb') as in_f:
+                shutil.copyfileobj(in_f, out_f)
+        self._write(key, write_fn, meta)
+
+    def remove(self, key):
+        with self.lock:
+            for path in self._get_paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _get_entries(self):
+        # returns (mtime, size, key) of each entry, least recently used
+        # first
+        res = []
+        for name in os.listdir(self.cachedir):
+            if not name.endswith('.dat'):
+                continue
+            path = os.path.join(self.cachedir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            res.append((st.st_mtime, st.st_size, name[:-4]))
+        res.sort()
+        return res
+
+    def _eject_old(self):
+        if self.maxsize == None:
+            return
+        entries = self._get_entries()
+        cursize = sum(map(lambda entry: entry[1], entries))
+        # never remove the most recent entry
+        for mtime, size, key in entries[:-1]:
+            if cursize <= self.maxsize:
+                break
+            self.logger.debug("removing cache entry %s" % (key))
+            self.remove(key)
+            cursize -= size
+
+    def get_size(self):
+        with self.lock:
+            if not os.path.isdir(self.cachedir):
+                return 0
+            return sum(map(lambda entry: entry[1], self._get_entries()))
+
+    def clear(self):
+        with self.lock:
+            if not os.path.isdir(self.cachedir):
+                return
+            for mtime, size, key in self._get_entries():
+                self.remove(key)
+
+    def get_maxsize(self):
+        return self.maxsize
+
+    def set_maxsize(self, maxsize):
+        with self.lock:
+            self.maxsize = maxsize
+            self._eject_old()
+
+
+class _LocalRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+
+    def translate_path(self, path):
+        # serve files from the server's directory instead of the current
+        # one; query strings are ignored
+        path = path.split('?', 1)[0].split('#', 1)[0]
+        path = posixpath.normpath(urllib.unquote(path))
+        words = filter(None, path.split('/'))
+        res = self.server.datadir
+        for word in words:
+            if word in (os.curdir, os.pardir):
+                continue
+            res = os.path.join(res, word)
+        return res
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append(self.path)
+        return SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+    def log_message(self, format, *args):
+        self.server.logger.debug("local server: %s" % (format % args))
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class LocalServer(object):
+    """An HTTP server for the files in directory `datadir`, which can
+    stand in for a remote catalog or image server.  The query string of
+    a request is ignored, so a server URL such as
+    'http://localhost:<port>/catalog.txt?ra=%(ra)s&dec=%(dec)s' always
+    returns the file 'catalog.txt'.  `get_requests` returns the paths of
+    the requests served so far.
+    """
+
+    def __init__(self, logger, datadir, host='localhost', port=0):
+        self.logger = logger
+        self.datadir = datadir
+        self.host = host
+        self.port = port
+        self.server = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.requests = []
+
+    def start(self):
+        server = _ThreadingHTTPServer((self.host, self.port),
+                                      _LocalRequestHandler)
+        server.datadir = self.datadir
+        server.logger = self.logger
+        server.lock = self.lock
+        server.requests = self.requests
+        self.server = server
+        # get the port, in case one was picked for us
+        self.port = server.server_address[1]
+
+        self.thread = threading.Thread(target=server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.info("serving %s at %s" % (self.datadir,
+                                               self.get_url('')))
+
+    def stop(self):
+        if self.server != None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        self.thread = None
+
+    def get_url(self, path):
+        return 'http://%s:%d/%s' % (self.host, self.port, path)
+
+    def get_requests(self):
+        with self.lock:
+            return list(self.requests)
+
+
+def selftest(logger):
+    """Checks a URL catalog server fetching through a cache from a
+    LocalServer: a miss, a hit, an expired entry and an offline cache.
+    Raises AssertionError if the cache misbehaves.
+    """
+    # NOTE: imported here, the catalog module uses this one
+    from ginga.util import catalog
+
+    datadir = tempfile.mkdtemp()
+    cachedir = os.path.join(datadir, 'cache')
+    server = LocalServer(logger, datadir)
+    try:
+        with open(os.path.join(datadir, 'catalog.txt'), 'w') as out_f:
+            out_f.write("star1 10.0 20.0 12.5\n")
+        server.start()
+
+        cache = QueryCache(logger, cachedir, ttl=3600)
+        urlsrv = catalog.URLServer(logger, 'Local', 'local',
+                                   server.get_url('catalog.txt?ra=%(ra)s'),
+                                   "Local test server")
+        urlsrv.cache = cache
+        url1 = urlsrv.base_url % dict(ra='10.0')
+        url2 = urlsrv.base_url % dict(ra='11.0')
+
+        # miss: goes to the server
+        data = urlsrv.fetch(url1)
+        assert data.startswith('star1'), "wrong data fetched"
+        assert len(server.get_requests()) == 1, "miss not fetched"
+
+        # hit: served from the cache, also into a file
+        assert urlsrv.fetch(url1) == data, "wrong data in cache"
+        filepath = os.path.join(datadir, 'result.txt')
+        urlsrv.fetch(url1, filepath=filepath)
+        with open(filepath, 'r') as in_f:
+            assert in_f.read() == data, "wrong data in cache file"
+        assert len(server.get_requests()) == 1, "hit went to the server"
+
+        # expired: goes to the server again
+        cache.ttl = 0
+        time.sleep(0.01)
+        assert urlsrv.fetch(url1) == data, "wrong data refetched"
+        assert len(server.get_requests()) == 2, "expired entry was used"
+
+        # offline: entries never expire, and misses are errors
+        cache.offline = True
+        time.sleep(0.01)
+        assert urlsrv.fetch(url1) == data, "wrong data in offline cache"
+        try:
+            urlsrv.fetch(url2)
+            raise AssertionError("offline miss went to the server")
+        except QueryCacheError:
+            pass
+        assert len(server.get_requests()) == 2, "offline cache fetched"
+
+    finally:
+        server.stop()
+        shutil.rmtree(datadir, ignore_errors=True)
+
+
+def main():
+    from ginga.misc import log
+
+    logger = log.get_logger(log_stderr=True)
+    selftest(logger)
+    print "query cache OK"
+
+
+if __name__ == '__main__':
+    main()
+
+#END
@@ -0,0 +1,197 @@
+#
+# thumbfarm.py -- rendering of thumbnails in background threads
+#
+# Eric Jeschke (eric@naoj.org)
+#
+# Copyright (c) Eric R. Jeschke.  All rights reserved.
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+Thumbnails are rendered by a pool of worker threads, each with its own
+viewer that has no window.  A viewer renders from a decimated sample of
+the image data, no larger than needed for the thumbnail, and the result
+is an RGB array that the GUI thread only has to turn into a widget.
+"""
+import threading
+import Queue
+
+from ginga import ImageView
+from ginga.misc import Bunch
+
+
+class ThumbFarmError(Exception):
+    pass
+
+
+class ThumbViewer(ImageView.ImageViewBase):
+    """A viewer with no window, which renders images into RGB arrays in
+    the given `rgb_order` (e.g. 'RGB' or 'BGRA').
+    """
+
+    def __init__(self, logger=None, rgbmap=None, settings=None,
+                 rgb_order='RGB'):
+        ImageView.ImageViewBase.__init__(self, logger=logger,
+                                         rgbmap=rgbmap,
+                                         settings=settings)
+        self._rgb_order = rgb_order
+
+        # for images rendered without the attributes of another view
+        self.default_attrs = Bunch.Bunch(transforms=(False, False, False),
+                                         cuts=None, rgbmap=self.rgbmap)
+
+    def set_view_attrs(self, attrs):
+        """Set the transforms, cut levels (unless None) and color map
+        from `attrs` (see get_view_attrs()).
+        """
+        flip_x, flip_y, swap_xy = attrs.transforms
+        self.transform(flip_x, flip_y, swap_xy, redraw=False)
+        if attrs.cuts != None:
+            loval, hival = attrs.cuts
+            self.cut_levels(loval, hival, redraw=False)
+        self.rgbmap = attrs.rgbmap
+
+    def get_rgb_order(self):
+        return self._rgb_order
+
+    def get_image_as_array(self):
+        """Returns the image as it would be displayed in the window.
+        Does not include overlaid graphics.
+        """
+        rgbobj = self.get_rgb_object(whence=0)
+        return rgbobj.get_array(self._rgb_order)
+
+    # NOTE: there is no window, so the image is only ever rendered on
+    # request, by get_image_as_array()
+
+    def update_image(self):
+        pass
+
+    def render_image(self, rgbobj, dst_x, dst_y):
+        pass
+
+    def reschedule_redraw(self, time_sec):
+        pass
+
+
+def get_sample(image, size):
+    """Returns an image with a sample of the data of `image`, decimated
+    so that it is no smaller than `size` pixels on the long side.  The
+    sample shares the metadata (e.g. header) of `image`.
+    """
+    wd, ht = image.get_size()
+    step = max(1, max(wd, ht) // size)
+    data = image.get_data()
+    if step > 1:
+        data = data[::step, ::step, ...].copy()
+    # NOTE: a new image is made even if the data is not decimated, so
+    # that the viewers don't register callbacks on `image`
+    sample = image.__class__(data_np=data, metadata=image.get_metadata(),
+                             logger=image.logger)
+    return sample
+
+
+def get_view_attrs(fitsimage):
+    """Returns the transforms, cut levels and color map of viewer
+    `fitsimage`, for making thumbnails that look like its view.  The
+    color map is a copy, so that it can't change during rendering.
+    """
+    t_ = fitsimage.get_settings()
+    return Bunch.Bunch(transforms=(t_['flip_x'], t_['flip_y'],
+                                   t_['swap_xy']),
+                       cuts=t_['cuts'],
+                       rgbmap=fitsimage.get_rgbmap().copy())
+
+
+class ThumbFarm(object):
+    """Renders thumbnails with `num_workers` threads.  Thumbnails are
+    rendered into a `width` x `height` window as RGB arrays in
+    `rgb_order`.  start() must be called before jobs are added.
+
+    add_job() queues an image to be rendered.  When it is done, the
+    callback is called (from the worker thread) with the array, or None
+    if the image could not be rendered, and any extra arguments given to
+    add_job().
+    """
+
+    def __init__(self, logger, num_workers=2, width=200, height=200,
+                 rgb_order='RGB'):
+        self.logger = logger
+        self.num_workers = num_workers
+        self.width = width
+        self.height = height
+        self.rgb_order = rgb_order
+        self.queue = Queue.Queue()
+        self.workers = []
+
+    def make_viewer(self):
+        viewer = ThumbViewer(logger=self.logger, rgb_order=self.rgb_order)
+        viewer.set_window_size(self.width, self.height, redraw=False)
+        viewer.enable_autozoom('on')
+        viewer.enable_autocuts('on')
+        viewer.enable_auto_orient(True)
+        viewer.set_makebg(False)
+        return viewer
+
+    def start(self):
+        for i in xrange(self.num_workers):
+            viewer = self.make_viewer()
+            thread = threading.Thread(target=self.worker_loop,
+                                      args=(viewer,))
+            thread.daemon = True
+            thread.start()
+            self.workers.append(thread)
+
+    def stop(self):
+        # one for each worker
+        for thread in self.workers:
+            self.queue.put(None)
+        self.workers = []
+
+    def add_job(self, image, attrs, callback, *args, **kwdargs):
+        """Queue `image` to be rendered.  `attrs` (see get_view_attrs())
+        gives the transforms, cut levels and color map to use, or None
+        to use auto cut levels and the default color map.
+        """
+        if len(self.workers) == 0:
+            raise ThumbFarmError("Thumbnail workers are not running")
+        self.queue.put(Bunch.Bunch(image=image, attrs=attrs,
+                                   callback=callback, args=args,
+                                   kwdargs=kwdargs))
+
+    def render(self, viewer, image, attrs):
+        size = max(self.width, self.height)
+        sample = get_sample(image, size)
+        if attrs == None:
+            # orientation and cut levels are set from the image
+            viewer.set_view_attrs(viewer.default_attrs)
+            viewer.set_image(sample, redraw=False)
+        else:
+            viewer.set_image(sample, redraw=False)
+            viewer.set_view_attrs(attrs)
+        return viewer.get_image_as_array()
+
+    def worker_loop(self, viewer):
+        while True:
+            job = self.queue.get()
+            if job == None:
+                break
+
+            try:
+                rgbarr = self.render(viewer, job.image, job.attrs)
+            except Exception, e:
+                name = job.image.get('name', 'NoName')
+                self.logger.error("Error rendering thumbnail for '%s': %s" % (
+                    name, str(e)))
+                rgbarr = None
+            finally:
+                # don't hold on to the image
+                viewer.image = None
+
+            try:
+                job.callback(rgbarr, *job.args, **job.kwdargs)
+            except Exception, e:
+                self.logger.error("Error in thumbnail callback: %s" % (
+                    str(e)))
+
+#END
@@ -170,6 +170,36 @@ class BaseWCS(object):
             #self.header.update('CUNIT2', 'deg')
             self.header['CUNIT2'] = 'deg'
 
+    def pixtoradec_many(self, idxs, coords='data'):
+        """Convert an N x 2 array of pixel coordinates (each row as
+        given to pixtoradec()) to an N x 2 array of (ra, dec) in degrees.
+
+        Subclasses override this to transform all of the points in one
+        call; this version calls pixtoradec() for each point.
+        """
+        idxs = numpy.asarray(idxs, dtype=numpy.float_)
+        res = [ self.pixtoradec(idx, coords=coords) for idx in idxs ]
+        return numpy.array(res, dtype=numpy.float_).reshape((-1, 2))
+
+    def radectopix_many(self, radec, coords='data', naxispath=None):
+        """Convert an N x 2 array of (ra, dec) in degrees to an N x 2
+        array of (x, y) pixel coordinates.  See pixtoradec_many().
+        """
+        radec = numpy.asarray(radec, dtype=numpy.float_)
+        res = [ self.radectopix(ra_deg, dec_deg, coords=coords,
+                                naxispath=naxispath)
+                for ra_deg, dec_deg in radec ]
+        return numpy.array(res, dtype=numpy.float_).reshape((-1, 2))
+
+    def pixtosystem_many(self, idxs, system=None, coords='data'):
+        """Like pixtoradec_many(), but returns (lon, lat) in coordinate
+        system `system` (see pixtosystem()).
+        """
+        idxs = numpy.asarray(idxs, dtype=numpy.float_)
+        res = [ self.pixtosystem(idx, system=system, coords=coords)
+                for idx in idxs ]
+        return numpy.array(res, dtype=numpy.float_).reshape((-1, 2))
+
     
 class AstropyWCS(BaseWCS):
     """A WCS interface for astropy.wcs
@@ -276,6 +306,43 @@ class AstropyWCS(BaseWCS):
         y = float(pix[0, 1])
         return (x, y)
 
+    def pixtoradec_many(self, idxs, coords='data'):
+
+        if coords == 'data':
+            origin = 0
+        else:
+            origin = 1
+        pixcrd = numpy.asarray(idxs, dtype=numpy.float_)
+        try:
+            sky = self.wcs.all_pix2world(pixcrd, origin)
+
+        except Exception, e:
+            self.logger.error("Error calculating pixtoradec: %s" % (str(e)))
+            raise WCSError(e)
+
+        return sky[:, :2]
+
+    def radectopix_many(self, radec, coords='data', naxispath=None):
+
+        if coords == 'data':
+            origin = 0
+        else:
+            origin = 1
+
+        skycrd = numpy.asarray(radec, dtype=numpy.float_)
+        if naxispath:
+            zeros = numpy.zeros((len(skycrd), len(naxispath)))
+            skycrd = numpy.hstack((skycrd[:, :2], zeros))
+
+        try:
+            pix = self.wcs.wcs_world2pix(skycrd, origin)
+
+        except Exception, e:
+            self.logger.error("Error calculating radectopix: %s" % (str(e)))
+            raise WCSError(e)
+
+        return pix[:, :2]
+
     def pixtocoords(self, idxs, system=None, coords='data'):
 
         if self.coordsys == 'raw':
@@ -437,6 +504,38 @@ class AstLibWCS(BaseWCS):
 
         return (x, y)
 
+    def pixtoradec_many(self, idxs, coords='data'):
+        idxs = numpy.asarray(idxs, dtype=numpy.float_)
+        xs, ys = idxs[:, 0], idxs[:, 1]
+        if coords == 'fits':
+            # Via astWCS.NUMPY_MODE, we've forced pixels referenced from 0
+            xs, ys = xs - 1, ys - 1
+
+        try:
+            # astLib transforms lists of coordinates in one call
+            res = self.wcs.pix2wcs(list(xs), list(ys))
+
+        except Exception, e:
+            self.logger.error("Error calculating pixtoradec: %s" % (str(e)))
+            raise WCSError(e)
+
+        return numpy.array(res, dtype=numpy.float_).reshape((-1, 2))
+
+    def radectopix_many(self, radec, coords='data', naxispath=None):
+        radec = numpy.asarray(radec, dtype=numpy.float_)
+        try:
+            res = self.wcs.wcs2pix(list(radec[:, 0]), list(radec[:, 1]))
+
+        except Exception, e:
+            self.logger.error("Error calculating radectopix: %s" % (str(e)))
+            raise WCSError(e)
+
+        pix = numpy.array(res, dtype=numpy.float_).reshape((-1, 2))
+        if coords == 'fits':
+            # Via astWCS.NUMPY_MODE, we've forced pixels referenced from 0
+            pix += 1
+        return pix
+
     def pixtosystem(self, idxs, system=None, coords='data'):
 
         if self.coordsys == 'raw':
@@ -551,6 +650,41 @@ class KapteynWCS(BaseWCS):
         x, y = pix[0], pix[1]
         return (x, y)
 
+    def pixtoradec_many(self, idxs, coords='data'):
+        idxs = numpy.asarray(idxs, dtype=numpy.float_)
+        # Kapteyn's WCS needs pixels referenced from 1
+        if coords == 'data':
+            idxs = idxs + 1
+
+        try:
+            # a tuple of arrays is transformed in one call
+            res = self.wcs.toworld(tuple(idxs.T))
+
+        except Exception, e:
+            self.logger.error("Error calculating pixtoradec: %s" % (str(e)))
+            raise WCSError(e)
+
+        return numpy.array((res[0], res[1]), dtype=numpy.float_).T
+
+    def radectopix_many(self, radec, coords='data', naxispath=None):
+        radec = numpy.asarray(radec, dtype=numpy.float_)
+        args = [radec[:, 0], radec[:, 1]]
+        if naxispath:
+            args += [numpy.zeros(len(radec))] * len(naxispath)
+
+        try:
+            pix = self.wcs.topixel(tuple(args))
+
+        except Exception, e:
+            self.logger.error("Error calculating radectopix: %s" % (str(e)))
+            raise WCSError(e)
+
+        pix = numpy.array((pix[0], pix[1]), dtype=numpy.float_).T
+        if coords == 'data':
+            # Kapteyn's WCS returns pixels referenced from 1
+            pix -= 1
+        return pix
+
     def pixtosystem(self, idxs, system=None, coords='data'):
 
         if self.coordsys == 'raw':
@@ -676,6 +810,43 @@ class StarlinkWCS(BaseWCS):
 
         return (x, y)
 
+    def pixtoradec_many(self, idxs, coords='data'):
+        idxs = numpy.asarray(idxs, dtype=numpy.float_)
+        # Starlink's WCS needs pixels referenced from 1
+        if coords == 'data':
+            idxs = idxs + 1
+
+        try:
+            # pixel to sky coords (in the WCS specified transform)
+            res = self.wcs.tran([ idxs[:, 0], idxs[:, 1] ], 1)
+
+            # whatever sky coords to icrs coords
+            res = self.icrs_trans.tran([ res[0], res[1] ], 1)
+
+        except Exception, e:
+            self.logger.error("Error calculating pixtoradec: %s" % (str(e)))
+            raise WCSError(e)
+
+        return numpy.degrees(numpy.array((res[0], res[1]),
+                                         dtype=numpy.float_).T)
+
+    def radectopix_many(self, radec, coords='data', naxispath=None):
+        radec = numpy.radians(numpy.asarray(radec, dtype=numpy.float_))
+        try:
+            # sky coords to pixel (in the WCS specified transform)
+            # 0 as second arg -> inverse transform
+            res = self.wcs.tran([ radec[:, 0], radec[:, 1] ], 0)
+
+        except Exception, e:
+            self.logger.error("Error calculating radectopix: %s" % (str(e)))
+            raise WCSError(e)
+
+        pix = numpy.array((res[0], res[1]), dtype=numpy.float_).T
+        if coords == 'data':
+            # Starlink's WCS returns pixels referenced from 1
+            pix -= 1
+        return pix
+
     def pixtosystem(self, idxs, system=None, coords='data'):
 
         if self.coordsys == 'raw':
@@ -831,6 +1002,59 @@ class BareBonesWCS(BaseWCS):
             x, y = x - 1, y - 1
         return (x, y)
 
+    def pixtoradec_many(self, idxs, coords='data'):
+        """Like pixtoradec(), for an N x 2 array of (x, y) pixel
+        coordinates.  Returns an N x 2 array of (ra, dec).
+        """
+        idxs = numpy.asarray(idxs, dtype=numpy.float_)
+        x, y = idxs[:, 0], idxs[:, 1]
+
+        # account for DATA->FITS coordinate space
+        if coords == 'data':
+            x, y = x + 1, y + 1
+
+        crpix1, crpix2 = self.get_reference_pixel()
+        crval1, crval2 = self.get_physical_reference_pixel()
+        cd11, cd12, cd21, cd22 = self.get_pixel_coordinates()
+
+        res = numpy.empty((len(idxs), 2), dtype=numpy.float_)
+        res[:, 0] = (cd11 * (x - crpix1) + cd12 *
+                     (y - crpix2)) / math.cos(math.radians(crval2)) + crval1
+        res[:, 1] = cd21 * (x - crpix1) + cd22 * (y - crpix2) + crval2
+        return res
+
+    def radectopix_many(self, radec, coords='data', naxispath=None):
+        """Like radectopix(), for an N x 2 array of (ra, dec) in
+        degrees.  Returns an N x 2 array of (x, y).
+        """
+        radec = numpy.asarray(radec, dtype=numpy.float_)
+
+        crpix1, crpix2 = self.get_reference_pixel()
+        crval1, crval2 = self.get_physical_reference_pixel()
+        cd11, cd12, cd21, cd22 = self.get_pixel_coordinates()
+
+        # reverse matrix
+        rmatrix = (cd11 * cd22) - (cd12 * cd21)
+
+        if not cmp(rmatrix, 0.0):
+            raise WCSError("WCS Matrix Error: check values")
+
+        # Adjust RA as necessary
+        dra = radec[:, 0] - crval1
+        dra = numpy.where(dra > 180.0, dra - 360.0, dra)
+        dra = numpy.where(dra < -180.0, dra + 360.0, dra)
+        ddec = radec[:, 1] - crval2
+
+        cos_crval2 = math.cos(crval2 * math.pi/180.0)
+        res = numpy.empty((len(radec), 2), dtype=numpy.float_)
+        res[:, 0] = (cd22 * cos_crval2 * dra - cd12 * ddec)/rmatrix + crpix1
+        res[:, 1] = (cd11 * ddec - cd21 * cos_crval2 * dra)/rmatrix + crpix2
+
+        # account for FITS->DATA space
+        if coords == 'data':
+            res -= 1
+        return res
+
     def pixtocoords(self, idxs, system='icrs', coords='data'):
         return None
     
@@ -1020,6 +1244,48 @@ def dmsStrToDeg(dec):
     dec_deg = decTimeToDeg(sign, int(deg), int(min), float(sec))
     return dec_deg
 
+def _splitSexagesimal(strs):
+    """Split a sequence of 'a:b:c' strings into an N x 3 array of floats.
+    Rows for strings that cannot be parsed are NaN."""
+    num = len(strs)
+    arr = numpy.fromstring(' '.join(strs).replace(':', ' '),
+                           dtype=numpy.float, sep=' ')
+    if arr.size == num * 3:
+        return arr.reshape((num, 3))
+
+    # some string is malformed--parse the well-formed ones together
+    # and the rest one by one
+    arr = numpy.empty((num, 3), dtype=numpy.float)
+    arr.fill(numpy.nan)
+    good = numpy.array([s.count(':') == 2 for s in strs], dtype=numpy.bool)
+    idx = numpy.nonzero(good)[0]
+    vals = numpy.fromstring(' '.join([strs[i] for i in idx]).replace(':', ' '),
+                            dtype=numpy.float, sep=' ')
+    if vals.size == len(idx) * 3:
+        arr[idx] = vals.reshape((len(idx), 3))
+    else:
+        for i in idx:
+            try:
+                arr[i] = map(float, strs[i].split(':'))
+            except ValueError:
+                pass
+    return arr
+
+def hmsStrToDegArray(ras):
+    """Convert a sequence of string representations of RA into an
+    array of degrees.  Unparseable values give NaN."""
+    arr = _splitSexagesimal(ras)
+    return hmsToDeg(arr[:, 0], arr[:, 1], arr[:, 2])
+
+def dmsStrToDegArray(decs):
+    """Convert a sequence of string representations of DEC into an
+    array of degrees.  Unparseable values give NaN."""
+    arr = _splitSexagesimal(decs)
+    # NOTE: the sign bit is used, so that e.g. '-00' (-0.0) is negative
+    deg = arr[:, 0]
+    sign = numpy.where(numpy.signbit(deg), -1.0, 1.0)
+    return dmsToDeg(sign, numpy.abs(deg), arr[:, 1], arr[:, 2])
+
 def raDegToString(ra_deg, format='%02d:%02d:%06.3f'):
     if ra_deg > 360.0:
         ra_deg = math.fmod(ra_deg, 360.0)
@@ -1098,6 +1364,26 @@ def eqToEq2000(ra_deg, dec_deg, eq):
  
     return (new_ra_deg, new_dec_deg)
 
+def eqToEq2000Array(ra_deg, dec_deg, eq):
+    """Like eqToEq2000(), for arrays of RA and DEC."""
+    ra_rad = numpy.radians(ra_deg)
+    dec_rad = numpy.radians(dec_deg)
+
+    x = numpy.cos(dec_rad) * numpy.cos(ra_rad)
+    y = numpy.cos(dec_rad) * numpy.sin(ra_rad)
+    z = numpy.sin(dec_rad)
+
+    p11, p12, p13, p21, p22, p23, p31, p32, p33 = trans_coeff(eq, x, y, z)
+
+    x0 = p11*x + p21*y + p31*z
+    y0 = p12*x + p22*y + p32*z
+    z0 = p13*x + p23*y + p33*z
+
+    new_dec = numpy.arcsin(numpy.clip(z0, -1.0, 1.0))
+    new_ra = numpy.mod(numpy.arctan2(y0, x0), 2.0*math.pi)
+
+    return (numpy.degrees(new_ra), numpy.degrees(new_dec))
+
 def get_rotation_and_scale(header):
     """
     CREDIT: See IDL code at
@@ -1157,6 +1443,166 @@ def get_rotation_and_scale(header):
     return (rot, cdelt1, cdelt2)
 
 
+def _unwrap_lon(lon, lon_ref):
+    # returns `lon` shifted by a multiple of 360 deg to within 180 deg
+    # of `lon_ref`
+    return lon_ref + (lon - lon_ref + 180.0) % 360.0 - 180.0
+
+
+class CoordGrid(object):
+    """A grid of sky coordinates over the pixel region (x1, y1)-(x2, y2)
+    of an image, from which the coordinates of any pixel in the region
+    can be interpolated much faster than a WCS calculation.
+
+    `coords_fn` is called with an N x 2 array of pixel coordinates and
+    returns an N x 2 array of (lon, lat) in degrees.  Grid points are
+    placed about `spacing` pixels apart.  The bilinear interpolation is
+    checked against `coords_fn` in the middle of each cell and of its
+    edges.  Cells where it is out by more than `tolerance` arcsec get a
+    finer grid of their own, with cells down to `min_spacing` pixels.
+    Where even those are not good enough, pixtosystem() returns None and
+    the caller must do the WCS calculation itself.
+    """
+
+    def __init__(self, coords_fn, x1, y1, x2, y2, spacing=64,
+                 tolerance=0.01, min_spacing=4):
+        self.x1, self.y1 = float(x1), float(y1)
+        self.x2, self.y2 = float(x2), float(y2)
+        self.nx = max(1, int(math.ceil((self.x2 - self.x1) / spacing)))
+        self.ny = max(1, int(math.ceil((self.y2 - self.y1) / spacing)))
+        self.dx = max(self.x2 - self.x1, 1.0) / self.nx
+        self.dy = max(self.y2 - self.y1, 1.0) / self.ny
+        self.tolerance = tolerance
+
+        xs = self.x1 + numpy.arange(self.nx + 1) * self.dx
+        ys = self.y1 + numpy.arange(self.ny + 1) * self.dy
+        pts = numpy.array(numpy.meshgrid(xs, ys)).reshape((2, -1)).T
+        res = coords_fn(pts)
+        self.lon = res[:, 0].reshape((self.ny + 1, self.nx + 1))
+        self.lat = res[:, 1].reshape((self.ny + 1, self.nx + 1))
+
+        # (i, j) of each cell that is too coarse -> a finer grid over
+        # that cell, or None if the WCS must be used there
+        self.subgrids = {}
+        self._refine(coords_fn, min_spacing)
+
+        # lookups of single values are faster in lists
+        self._lon = self.lon.tolist()
+        self._lat = self.lat.tolist()
+
+    def _refine(self, coords_fn, min_spacing):
+        nx, ny = self.nx, self.ny
+        lon, lat = self.lon, self.lat
+        xs = self.x1 + numpy.arange(nx + 1) * self.dx
+        ys = self.y1 + numpy.arange(ny + 1) * self.dy
+        xm = xs[:-1] + self.dx / 2.0
+        ym = ys[:-1] + self.dy / 2.0
+
+        # cell centers, middles of horizontal edges, middles of vertical
+        # edges
+        shapes = ((ny, nx), (ny + 1, nx), (ny, nx + 1))
+        pts = [ numpy.array(numpy.meshgrid(xm, ym)),
+                numpy.array(numpy.meshgrid(xm, ys)),
+                numpy.array(numpy.meshgrid(xs, ym)) ]
+        pts = numpy.hstack([ p.reshape((2, -1)) for p in pts ]).T
+        res = coords_fn(pts)
+
+        # interpolated values at the same points
+        lon00 = lon[:-1, :-1]
+        interp = [ ((lon00 + _unwrap_lon(lon[:-1, 1:], lon00) +
+                     _unwrap_lon(lon[1:, :-1], lon00) +
+                     _unwrap_lon(lon[1:, 1:], lon00)) / 4.0,
+                    (lat[:-1, :-1] + lat[:-1, 1:] + lat[1:, :-1] +
+                     lat[1:, 1:]) / 4.0),
+                   ((lon[:, :-1] + _unwrap_lon(lon[:, 1:], lon[:, :-1])) / 2.0,
+                    (lat[:, :-1] + lat[:, 1:]) / 2.0),
+                   ((lon[:-1, :] + _unwrap_lon(lon[1:, :], lon[:-1, :])) / 2.0,
+                    (lat[:-1, :] + lat[1:, :]) / 2.0) ]
+
+        errs = []
+        start = 0
+        for shape, (ilon, ilat) in zip(shapes, interp):
+            n = shape[0] * shape[1]
+            tlon = res[start:start+n, 0].reshape(shape)
+            tlat = res[start:start+n, 1].reshape(shape)
+            start += n
+            dlon = (_unwrap_lon(tlon, ilon) - ilon) * numpy.cos(
+                numpy.radians(tlat))
+            dlat = tlat - ilat
+            errs.append(numpy.sqrt(dlon**2 + dlat**2) * 3600.0)
+
+        center, hmid, vmid = errs
+        err = numpy.maximum(center, numpy.maximum(hmid[:-1, :], hmid[1:, :]))
+        err = numpy.maximum(err, numpy.maximum(vmid[:, :-1], vmid[:, 1:]))
+        # NOTE: catches NaNs as well
+        bad = numpy.logical_not(err <= self.tolerance)
+
+        size = min(self.dx, self.dy)
+        for i, j in zip(*numpy.nonzero(bad)):
+            # The error of the interpolation goes as the square of the
+            # cell size, so estimate the number of divisions needed
+            # (a finer grid will refine itself further if need be)
+            if numpy.isfinite(err[i, j]):
+                num = math.ceil(1.2 * math.sqrt(err[i, j] / self.tolerance))
+            else:
+                num = 2
+            num = min(num, math.floor(size / min_spacing))
+            if num < 2:
+                self.subgrids[(i, j)] = None
+                continue
+            spacing = size / num
+            x1, y1 = xs[j], ys[i]
+            self.subgrids[(i, j)] = CoordGrid(coords_fn, x1, y1,
+                                              x1 + self.dx, y1 + self.dy,
+                                              spacing=spacing,
+                                              tolerance=self.tolerance,
+                                              min_spacing=min_spacing)
+
+    def get_num_cells(self):
+        """Returns the number of cells in the grid, including those of
+        finer grids.
+        """
+        num = self.nx * self.ny
+        for grid in self.subgrids.values():
+            if grid != None:
+                num += grid.get_num_cells() - 1
+        return num
+
+    def pixtosystem(self, x, y):
+        """Returns the interpolated (lon, lat) of pixel (x, y), or None
+        if it is outside the grid or in a cell where the interpolation is
+        not good enough.
+        """
+        fx = (x - self.x1) / self.dx
+        fy = (y - self.y1) / self.dy
+        if (fx < 0) or (fy < 0) or (fx > self.nx) or (fy > self.ny):
+            return None
+        i, j = min(int(fy), self.ny - 1), min(int(fx), self.nx - 1)
+
+        key = (i, j)
+        if key in self.subgrids:
+            grid = self.subgrids[key]
+            if grid == None:
+                return None
+            return grid.pixtosystem(x, y)
+
+        u, v = fx - j, fy - i
+        w00, w01 = (1.0 - u) * (1.0 - v), u * (1.0 - v)
+        w10, w11 = (1.0 - u) * v, u * v
+
+        lon0, lon1 = self._lon[i], self._lon[i+1]
+        lon00 = lon0[j]
+        lon01 = _unwrap_lon(lon0[j+1], lon00)
+        lon10 = _unwrap_lon(lon1[j], lon00)
+        lon11 = _unwrap_lon(lon1[j+1], lon00)
+        lon_deg = (w00 * lon00 + w01 * lon01 + w10 * lon10 +
+                   w11 * lon11) % 360.0
+        lat0, lat1 = self._lat[i], self._lat[i+1]
+        lat_deg = (w00 * lat0[j] + w01 * lat0[j+1] +
+                   w10 * lat1[j] + w11 * lat1[j+1])
+        return (lon_deg, lat_deg)
+
+
 class WcsMatch(object):
     """
     CREDIT: Code modified from